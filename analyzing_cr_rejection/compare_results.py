@@ -63,7 +63,8 @@ def create_data_objects(flist):
 	return obj
 
 
-def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None):
+def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None,
+			 reader=None):
 	"""
 	Parameters
 	----------
@@ -73,6 +74,8 @@ def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None):
 	    Description
 	hdf5file2 : None, optional
 	    Description
+	reader : utils.datahandler.DataReader, optional
+	    Reader used to look up the affected pixels
 	"""
 	LOG.info(f'Creating a MEF for {fname}')
 	dset = os.path.basename(fname)
@@ -90,7 +93,8 @@ def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None):
 		label1, metadata1 = label_from_file(
 			hdf5file=hdf5file1, 
 			dset_name=dset, 
-			shape=sci.shape
+			shape=sci.shape,
+			reader=reader
 		)
 		hdr1 = fits.Header(cards=[], copy=False)
 		params = '_'.join(os.path.basename(hdf5file1).split('.hdf5')[0].split('_')[-3:])
@@ -102,7 +106,8 @@ def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None):
 		label2, metadata2 = label_from_file(
 			hdf5file=hdf5file2,
 			dset_name=dset,
-			shape=sci.shape
+			shape=sci.shape,
+			reader=reader
 		)
 	
 		hdr2 = fits.Header(cards=[], copy=False)
@@ -115,7 +120,7 @@ def make_MEF(fname, hdf5file1=None, hdf5file2=None, params1=None, params2=None):
 	hdu_list.writeto(f"{fname.replace('_flt.fits', '_all.fits')}", overwrite=True)
 	
 
-def label_from_file(hdf5file, dset_name, shape=None):
+def label_from_file(hdf5file, dset_name, shape=None, reader=None):
 	"""
 	Parameters
 	----------
@@ -125,14 +130,19 @@ def label_from_file(hdf5file, dset_name, shape=None):
 	    Description
 	shape : None, optional
 	    Description
+	reader : utils.datahandler.DataReader, optional
+	    Reader to reuse. If None, a new one is created and closed.
 	
 	Returns
 	-------
 	TYPE
 	    Description
 	"""
-	dh1 = dh.DataReader(instr='stis_ccd', statistic='cr_affected_pixels')
-	cr_affected_pixels, metadata = dh1.read_single_dst(hdf5file, dset_name)
+	if reader is None:
+		with dh.DataReader(instr='stis_ccd',
+						   statistic='cr_affected_pixels') as reader:
+			return label_from_file(hdf5file, dset_name, shape, reader)
+	cr_affected_pixels, metadata = reader.read_single_dst(hdf5file, dset_name)
 	template = np.zeros(shape)
 	for (y,x) in cr_affected_pixels:
 		template[int(y)][int(x)] +=1
@@ -167,9 +177,14 @@ def examine_label(dirname=_RESULTS_DIR, exptime=60.0):
 	dataset2 = glob.glob(dir2+'/*flt.fits')
 	print(len(dataset1), len(dataset2))
 
-	for f1, f2 in zip(dataset1, dataset2):
-		make_MEF(fname=f1, hdf5file1=file1, params1=params1)
-		make_MEF(fname=f2, hdf5file2=file2, params2=params2)
+	# Share one reader so both results files stay open across the datasets
+	with dh.DataReader(instr='stis_ccd',
+					   statistic='cr_affected_pixels') as reader:
+		for f1, f2 in zip(dataset1, dataset2):
+			make_MEF(fname=f1, hdf5file1=file1, params1=params1,
+					 reader=reader)
+			make_MEF(fname=f2, hdf5file2=file2, params2=params2,
+					 reader=reader)
 		
 
 def exptime_summary(dh, title=''):
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+"""
+This module implements the on-disk caches used by the
+:py:class:`~download.download.Downloader`.
+
+:py:class:`DownloadCache` is a content-addressed cache of downloaded files.
+
+Each file is stored once as a blob named after the SHA-256 of its contents,
+
+    <cache_dir>/objects/<sha256[:2]>/<sha256>
+
+and a small reference file maps the dataset filename (e.g. `j8xyz1abq_flt.fits`)
+and the checksum reported by MAST to its blob,
+
+    <cache_dir>/refs/<filename>.json
+
+Files are checked out of the cache by hard linking the blob into place, so
+checking out a month of data costs no disk space or copying. Blobs are made
+read-only, and code that modifies a checked out file in place must first
+break the link with :py:func:`detach`.
+
+The total size of the blobs is kept under a disk budget by evicting the least
+recently used blobs. A blob's modification time is updated every time it is
+checked out.
+
+:py:class:`QueryCache` stores the filtered product tables returned by MAST,
+so a month that has already been queried is not queried again. Together the
+two caches let the pipeline rerun a month without network access.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import time
+import uuid
+
+from astropy.table import Table
+from astropy.time import Time
+
+
+logging.basicConfig(format='%(levelname)-4s '
+                           '[%(module)s:%(funcName)s:%(lineno)d]'
+                           ' %(message)s')
+LOG = logging.getLogger('DownloadCache')
+LOG.setLevel(logging.INFO)
+
+
+def sha256sum(fname, block_size=2**20):
+    """Compute the SHA-256 of a file"""
+    hasher = hashlib.sha256()
+    with open(fname, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Hard link `src` to `dest`, copying it if they are on different devices
+
+    `dest` is replaced atomically if it already exists.
+    """
+    tmp = '{}.{}.tmp'.format(dest, uuid.uuid4().hex)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+def detach(fname):
+    """Replace a hard linked file with a private copy
+
+    Must be called before modifying a file checked out of the cache in
+    place, otherwise the cached copy would be modified as well.
+    """
+    if os.stat(fname).st_nlink > 1:
+        tmp = '{}.{}.tmp'.format(fname, uuid.uuid4().hex)
+        shutil.copyfile(fname, tmp)
+        os.replace(tmp, fname)
+
+
+class DownloadCache(object):
+    """
+    A content-addressed cache of downloaded files with LRU eviction
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to store the cache in
+
+    max_bytes : int, optional
+        Disk budget for the cached files. If None, nothing is evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'refs'), exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        """Directory the cache is stored in"""
+        return self._cache_dir
+
+    @property
+    def max_bytes(self):
+        """Disk budget for the cached files"""
+        return self._max_bytes
+
+    def blob_path(self, digest):
+        """Path of the blob with the SHA-256 `digest`"""
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def ref_path(self, name):
+        """Path of the reference file for the dataset `name`"""
+        return os.path.join(self.cache_dir, 'refs',
+                            '{}.json'.format(os.path.basename(name)))
+
+    def lookup(self, name, checksum=None, size=None):
+        """Find the blob holding a dataset
+
+        Parameters
+        ----------
+        name : str
+            Filename of the dataset
+
+        checksum : str, optional
+            Checksum reported by the archive. If given, it must match the one
+            the file was cached with.
+
+        size : int, optional
+            Expected size of the file in bytes
+
+        Returns
+        -------
+        blob : str or None
+            Path of the blob, or None on a cache miss
+        """
+        try:
+            with open(self.ref_path(name), 'r') as fobj:
+                ref = json.load(fobj)
+        except (IOError, ValueError):
+            return None
+        if checksum is not None and ref.get('checksum') != checksum:
+            return None
+        blob = self.blob_path(ref['sha256'])
+        try:
+            nbytes = os.path.getsize(blob)
+        except OSError:
+            # The blob was evicted
+            return None
+        if size is not None and nbytes != size:
+            return None
+        return blob
+
+    def checkout(self, name, dest, checksum=None, size=None):
+        """Hard link a cached dataset to `dest`
+
+        Parameters
+        ----------
+        name : str
+            Filename of the dataset
+
+        dest : str
+            Full path to check the file out to
+
+        checksum, size
+            See :py:meth:`lookup`
+
+        Returns
+        -------
+        blob : str or None
+            Path of the blob, or None if the dataset is not in the cache
+        """
+        blob = self.lookup(name, checksum=checksum, size=size)
+        if blob is None:
+            return None
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        link_or_copy(blob, dest)
+        # Mark the blob as recently used
+        os.utime(blob, None)
+        return blob
+
+    def add(self, fname, checksum=None):
+        """Add a downloaded file to the cache
+
+        The file itself is hard linked into the cache, so it is not copied.
+
+        Parameters
+        ----------
+        fname : str
+            Full path to the file. Its basename is used as the dataset name.
+
+        checksum : str, optional
+            Checksum reported by the archive
+
+        Returns
+        -------
+        blob : str
+            Path of the blob
+        """
+        digest = sha256sum(fname)
+        blob = self.blob_path(digest)
+        if not os.path.isfile(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            link_or_copy(fname, blob)
+            os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        else:
+            os.utime(blob, None)
+        ref = {'sha256': digest, 'checksum': checksum}
+        tmp = '{}.{}.tmp'.format(self.ref_path(fname), uuid.uuid4().hex)
+        with open(tmp, 'w') as fobj:
+            json.dump(ref, fobj)
+        os.replace(tmp, self.ref_path(fname))
+        return blob
+
+    def blobs(self):
+        """List the (path, size, last use) of every blob in the cache"""
+        entries = []
+        for dirpath, _, fnames in os.walk(os.path.join(self.cache_dir,
+                                                       'objects')):
+            for fname in fnames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    @property
+    def nbytes(self):
+        """Total size of the cached files"""
+        return sum(nbytes for _, nbytes, _ in self.blobs())
+
+    def evict(self, keep=()):
+        """Remove the least recently used blobs until the cache fits within
+        :py:attr:`max_bytes`
+
+        References to evicted blobs are left behind and are treated as
+        misses by :py:meth:`lookup`.
+
+        Parameters
+        ----------
+        keep : iterable
+            Paths of blobs that must not be evicted (e.g. the ones checked
+            out for the current month)
+
+        Returns
+        -------
+        nbytes : int
+            Number of bytes freed
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.blobs(), key=lambda entry: entry[2])
+        total = sum(nbytes for _, nbytes, _ in entries)
+        keep = set(keep)
+        freed = 0
+        for path, nbytes, _ in entries:
+            if total - freed <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            freed += nbytes
+        if freed:
+            LOG.info('Evicted {:.1f} MB from {}'.format(freed / 1e6,
+                                                        self.cache_dir))
+        return freed
+
+
+class QueryCache(object):
+    """
+    A cache of the product tables returned by MAST queries
+
+    Each table is stored as a gzipped ECSV file, which keeps the column
+    types and masks, named after a hash of the query. Tables for date ranges
+    that ended more than `recent_days` ago never expire, since the archive
+    no longer changes for them. Tables for more recent date ranges expire
+    after `ttl` seconds.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to store the cache in
+
+    ttl : float
+        Lifetime in seconds of the tables for recent date ranges
+
+    recent_days : float
+        Date ranges ending less than this many days ago are considered recent
+    """
+
+    def __init__(self, cache_dir, ttl=86400, recent_days=90):
+        self._cache_dir = cache_dir
+        self._ttl = ttl
+        self._recent_days = recent_days
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def cache_dir(self):
+        """Directory the cache is stored in"""
+        return self._cache_dir
+
+    @staticmethod
+    def key(instr, date_range, params):
+        """Build the key of a query
+
+        Parameters
+        ----------
+        instr : str
+            Instrument name
+
+        date_range : tuple
+            (start, stop) `astropy.time.Time` objects
+
+        params : dict
+            Every other parameter of the query and of the product filter
+
+        Returns
+        -------
+        key : str
+        """
+        start, stop = date_range
+        payload = json.dumps(
+            {'instr': instr, 'start': start.iso, 'stop': stop.iso,
+             'params': params},
+            sort_keys=True, default=str
+        )
+        digest = hashlib.sha256(payload.encode()).hexdigest()[:16]
+        return '{}_{}_{}_{}'.format(instr.replace('/', '_'),
+                                    start.datetime.date().isoformat(),
+                                    stop.datetime.date().isoformat(),
+                                    digest)
+
+    def path(self, key):
+        """Path of the file holding the table for `key`"""
+        return os.path.join(self.cache_dir, '{}.ecsv.gz'.format(key))
+
+    def is_fresh(self, key, stop):
+        """Check if the cached table for `key` has not expired
+
+        Parameters
+        ----------
+        key : str
+            Key of the query
+
+        stop : `astropy.time.Time`
+            End of the date range of the query
+        """
+        fname = self.path(key)
+        if not os.path.isfile(fname):
+            return False
+        if (Time.now() - stop).jd > self._recent_days:
+            return True
+        return time.time() - os.path.getmtime(fname) < self._ttl
+
+    def get(self, key, stop=None):
+        """Load a cached table
+
+        Parameters
+        ----------
+        key : str
+            Key of the query
+
+        stop : `astropy.time.Time`, optional
+            End of the date range of the query. If given, expired tables are
+            treated as misses. Pass None to accept a table of any age (e.g.
+            when running offline).
+
+        Returns
+        -------
+        table : `astropy.table.Table` or None
+        """
+        if not os.path.isfile(self.path(key)):
+            return None
+        if stop is not None and not self.is_fresh(key, stop):
+            return None
+        try:
+            return Table.read(self.path(key), format='ascii.ecsv')
+        except (IOError, ValueError) as e:
+            LOG.warning('Unable to read {}: {}'.format(self.path(key), e))
+            return None
+
+    def put(self, key, table):
+        """Store a table"""
+        tmp = '{}.{}.tmp'.format(self.path(key), uuid.uuid4().hex)
+        with gzip.open(tmp, 'wt') as fobj:
+            table.write(fobj, format='ascii.ecsv')
+        os.replace(tmp, self.path(key))
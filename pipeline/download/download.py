@@ -7,10 +7,21 @@ import logging
 import os
 import warnings
 
+from astropy.table import MaskedColumn, Table, vstack
 from astropy.time import Time
 from astroquery.mast import Observations
+import numpy as np
 import yaml
 
+try:
+    from . import cache
+    from . import prefetch
+    from . import transfer
+except ImportError:
+    import cache
+    import prefetch
+    import transfer
+
 
 
 __taskname__ = "download"
@@ -26,6 +37,45 @@ LOG = logging.getLogger('Downloader')
 LOG.setLevel(logging.INFO)
 
 
+def footprint_area(s_region):
+    """Compute the area of an observation's footprint on the sky
+
+    Parameters
+    ----------
+    s_region : str
+        STC-S footprint from the MAST `s_region` column, made of one or
+        more polygons (e.g. one per chip). The polygons are small, so they
+        are projected onto a plane tangent to their first vertex.
+
+    Returns
+    -------
+    area : float
+        Area in square degrees, or NaN if the footprint is missing or is
+        not made of polygons
+    """
+    if s_region is None or np.ma.is_masked(s_region):
+        return np.nan
+    area = 0.
+    found = False
+    for shape in str(s_region).upper().split('POLYGON')[1:]:
+        values = []
+        for token in shape.split():
+            try:
+                values.append(float(token))
+            except ValueError:
+                continue # frame name, e.g. ICRS
+        if len(values) < 6 or len(values) % 2:
+            return np.nan
+        ra, dec = np.array(values[::2]), np.array(values[1::2])
+        # Handle polygons crossing RA = 0
+        ra = (ra - ra[0] + 180.) % 360. - 180.
+        x = ra * np.cos(np.radians(dec.mean()))
+        area += 0.5 * abs(np.dot(x, np.roll(dec, 1)) -
+                          np.dot(dec, np.roll(x, 1)))
+        found = True
+    return area if found else np.nan
+
+
 
 class Downloader(object):
     """
@@ -39,9 +89,24 @@ class Downloader(object):
     instr_cfg : dict
         Instrument configuration
 
+    download_cfg : dict
+        Settings for the transfers, corresponding to the `download` section
+        of the configuration file
+
+    store_downloads : bool
+        If True, downloaded files are kept in the
+        :py:class:`~download.cache.DownloadCache` and files found in it are
+        checked out instead of being downloaded again
+
+    offline : bool
+        If True, MAST is never contacted. Product tables are only taken from
+        the :py:class:`~download.cache.QueryCache` and files only from the
+        :py:class:`~download.cache.DownloadCache`.
+
     """
 
-    def __init__(self, instr, instr_cfg=None):
+    def __init__(self, instr, instr_cfg=None, download_cfg=None,
+                 store_downloads=False, offline=False):
 
 
         self._mod_dir = os.path.dirname(os.path.abspath(__file__))
@@ -58,9 +123,18 @@ class Downloader(object):
                 cfg = yaml.load(fobj)
 
             self._instr_cfg = cfg[instr]
+            if download_cfg is None:
+                download_cfg = cfg.get('download')
         else:
             self._instr_cfg = instr_cfg
 
+        self._download_cfg = download_cfg or {}
+        self._store_downloads = store_downloads or offline
+        self._offline = offline
+        self._aws = False
+        self._cache = None
+        self._query_cache = None
+
 
         self._dates = None
 
@@ -93,6 +167,11 @@ class Downloader(object):
         self._target_name = 'DARK*'
         self._t_exptime = [0.5, 10000] # Exposure times to include
 
+    mast_url = 'https://mast.stsci.edu/api/v0.1/Download/file?uri='
+
+    # Observation columns copied onto the product tables for exclude()
+    obs_columns = ['s_region']
+
 
     @property
     def instr_cfg(self):
@@ -109,6 +188,112 @@ class Downloader(object):
         return self._instr_cfg
 
 
+    @property
+    def download_cfg(self):
+        return self._download_cfg
+
+    @download_cfg.getter
+    def download_cfg(self):
+        """Settings for the transfers (`base_url`, `num_workers`,
+        `max_retries`, `backoff`, and `timeout`)"""
+        return self._download_cfg
+
+    @property
+    def base_url(self):
+        return self._download_cfg.get('base_url', self.mast_url)
+
+    @base_url.getter
+    def base_url(self):
+        """URL each product's `dataURI` is appended to
+
+        Set it to the address of a local HTTP server to test against a
+        stand-in for MAST.
+        """
+        return self._download_cfg.get('base_url', self.mast_url)
+
+    @property
+    def aws(self):
+        return self._aws
+
+    @aws.getter
+    def aws(self):
+        """True if the products were queried with `aws=True`, in which case
+        they are downloaded from the HST public dataset in S3 instead of
+        MAST"""
+        return self._aws
+
+    @property
+    def s3_url(self):
+        return self._s3_url()
+
+    @s3_url.getter
+    def s3_url(self):
+        """HTTPS address of the `s3_prefix` set in the `download` section of
+        the configuration file
+
+        The bucket is reached through the `s3_endpoint_url` if one is set,
+        and through its virtual-hosted address on AWS otherwise.
+        """
+        return self._s3_url()
+
+    def _s3_url(self):
+        prefix = self.download_cfg.get('s3_prefix',
+                                       's3://stpubdata/hst/public')
+        bucket, _, path = prefix.split('://')[-1].strip('/').partition('/')
+        endpoint = self.download_cfg.get('s3_endpoint_url')
+        if endpoint:
+            return '/'.join([endpoint.rstrip('/'), bucket, path])
+        return 'https://{}.s3.amazonaws.com/{}'.format(bucket, path)
+
+    @staticmethod
+    def s3_path(row):
+        """Path of a product relative to the `s3_prefix`, i.e.
+        `<obs_id[:4]>/<obs_id>/<filename>`"""
+        obs_id = str(row['obs_id']).lower()
+        return '/'.join([obs_id[:4], obs_id, str(row['productFilename'])])
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @cache.getter
+    def cache(self):
+        """The :py:class:`~download.cache.DownloadCache`, or None if
+        `store_downloads` is False or no `cache_dir` is configured"""
+        cache_dir = self.download_cfg.get('cache_dir')
+        if self._cache is None and self._store_downloads and cache_dir:
+            self._cache = cache.DownloadCache(
+                os.path.join(self._base, *cache_dir.split('/')),
+                max_bytes=self.download_cfg.get('cache_max_bytes')
+            )
+        return self._cache
+
+    @property
+    def offline(self):
+        return self._offline
+
+    @offline.getter
+    def offline(self):
+        """Switch for running without contacting MAST"""
+        return self._offline
+
+    @property
+    def query_cache(self):
+        return self._query_cache
+
+    @query_cache.getter
+    def query_cache(self):
+        """The :py:class:`~download.cache.QueryCache`, or None if no
+        `query_cache_dir` is configured"""
+        cache_dir = self.download_cfg.get('query_cache_dir')
+        if self._query_cache is None and cache_dir:
+            self._query_cache = cache.QueryCache(
+                os.path.join(self._base, *cache_dir.split('/')),
+                ttl=self.download_cfg.get('query_ttl', 86400),
+                recent_days=self.download_cfg.get('query_recent_days', 90)
+            )
+        return self._query_cache
+
     @property
     def download_dir(self):
         return self._download_dir
@@ -212,9 +397,45 @@ class Downloader(object):
         """Name of target to download"""
         return self._target_name
 
+    def _query_params(self, date_range):
+        """Parameters passed to `Observations.query_criteria`"""
+        start, stop = date_range
+        # there shouldn't be any data taken after the most recent file
+        return {
+            'project': self.project,
+            'dataproduct_type': self.product_type,
+            'intentType': self.obstype,
+            'target_name': self.target_name,
+            'instrument_name': self.instr,
+            't_min': [start.mjd, stop.mjd],
+            't_exptime': self.t_exptime
+        }
+
+    def _filter_params(self):
+        """Parameters passed to `Observations.filter_products`"""
+        return {
+            'mrp_only': False,
+            'productSubGroupDescription':self.SubGroupDescription
+        }
+
+    def _cache_key(self, date_range, aws=False):
+        """Key of the query for `date_range` in the
+        :py:attr:`~download.Downloader.query_cache`"""
+        return self.query_cache.key(
+            self.instr, date_range,
+            {'query': self._query_params(date_range),
+             'filter': self._filter_params(), 'aws': aws}
+        )
+
     def query(self, date_range, aws=False):
         """ Submit a query to MAST for observations in the date range
 
+        If the :py:attr:`~download.Downloader.query_cache` holds an unexpired
+        product table for the same query, it is used instead. When running
+        :py:attr:`~download.Downloader.offline`, a cached table of any age is
+        used and MAST is never contacted. Intervals already covered by
+        :py:meth:`~download.Downloader.plan` are skipped.
+
         Parameters
         ----------
         date_range : tuple
@@ -225,24 +446,39 @@ class Downloader(object):
             If True, query returns references to data hosted in S3.
 
         """
+        self._aws = aws
+        start, stop = date_range
+        key = start.datetime.date().isoformat() # 'YYYY-MM-DD'
+        if key in self.products:
+            return
+
+        cache_key = None
+        if self.query_cache is not None:
+            cache_key = self._cache_key(date_range, aws=aws)
+            filt_products = self.query_cache.get(
+                cache_key, stop=None if self.offline else stop
+            )
+            if filt_products is not None:
+                LOG.info('Using cached query results for [{}, {}]'.format(
+                    start.iso, stop.iso)
+                )
+                self.products[key] = filt_products
+                return
+        if self.offline:
+            LOG.error('No cached query results for [{}, {}] and running '
+                      'offline\n {}'.format(start.iso, stop.iso,
+                                            self._msg_div))
+            return
+
         LOG.info('Submitting query to MAST')
         if aws:
             Observations.enable_s3_hst_dataset()
-        start, stop = date_range
-        # there shouldn't be any data taken after the most recent file
-        query_params = {
-            'project': self.project,
-            'dataproduct_type': self.product_type,
-            'intentType': self.obstype,
-            'target_name': self.target_name,
-            'instrument_name': self.instr,
-            't_min': [start.mjd, stop.mjd],
-            't_exptime': self.t_exptime
-        }
         with warnings.catch_warnings():
             warnings.simplefilter('error')
             try:
-                obsTable = Observations.query_criteria(**query_params)
+                obsTable = Observations.query_criteria(
+                    **self._query_params(date_range)
+                )
             except Exception as e:
                 msg = ('{}\n Date range [{}, {}]\n {}'.format(e,
                                                               start.iso,
@@ -252,16 +488,401 @@ class Downloader(object):
             else:
                 LOG.info('Filtering observations...')
                 products = Observations.get_product_list(obsTable)
-                filter_params = {
-                    'mrp_only': False,
-                    'productSubGroupDescription':self.SubGroupDescription
-                }
+                filt_products = Observations.filter_products(
+                    products, **self._filter_params()
+                )
+                filt_products = self.annotate(filt_products, obsTable)
 
-                filt_products = Observations.filter_products(products,
-                                                             **filter_params)
-
-                key = start.datetime.date().isoformat() # 'YYYY-MM-DD'
                 self.products[key] = filt_products
+                if cache_key is not None:
+                    self.query_cache.put(cache_key, filt_products)
+
+    def _query_span(self, span, page_size, batch_size):
+        """Query every observation in `span`, one page at a time
+
+        Returns
+        -------
+        obs_table : `astropy.table.Table`
+
+        products : `astropy.table.Table`
+            Filtered products of every observation in the span
+        """
+        params = self._query_params(span)
+        count = int(Observations.query_criteria_count(**params))
+        LOG.info('Querying {} observations from {} to {}'.format(
+            count, span[0].iso, span[1].iso)
+        )
+        pages = [
+            Observations.query_criteria(page=page, pagesize=page_size,
+                                        **params)
+            for page in range(1, -(-count // page_size) + 1)
+        ]
+        if not pages:
+            return Table(), Table()
+        obs_table = vstack(pages)
+        products = [
+            Observations.get_product_list(obs_table[i:i + batch_size])
+            for i in range(0, len(obs_table), batch_size)
+        ]
+        products = Observations.filter_products(vstack(products),
+                                                **self._filter_params())
+        return obs_table, self.annotate(products, obs_table)
+
+    def plan(self, date_ranges, aws=False):
+        """Query MAST for many intervals with a few large queries
+
+        The intervals are merged into spans of at most `plan_span_days` days
+        (set in the `download` section of the configuration file), and each
+        span is queried page by page. The products are then split locally
+        into the intervals, using the start time of the observation they
+        belong to, and stored in the
+        :py:attr:`~download.Downloader.products` attribute and the
+        :py:attr:`~download.Downloader.query_cache`. Afterwards,
+        :py:meth:`~download.Downloader.query` no longer needs to contact MAST
+        for any of the intervals.
+
+        Intervals that already have unexpired results in the query cache are
+        not queried again.
+
+        Parameters
+        ----------
+        date_ranges : list
+            List of (start, stop) `astropy.time.Time` tuples, in order
+
+        aws : bool
+            If True, query returns references to data hosted in S3.
+        """
+        self._aws = aws
+        if self.offline:
+            return
+        span_days = self.download_cfg.get('plan_span_days', 1826)
+        page_size = self.download_cfg.get('plan_page_size', 50000)
+        batch_size = self.download_cfg.get('plan_batch_size', 1000)
+
+        todo = []
+        for date_range in date_ranges:
+            if self.query_cache is not None and self.query_cache.get(
+                    self._cache_key(date_range, aws=aws),
+                    stop=date_range[1]) is not None:
+                continue
+            todo.append(date_range)
+
+        spans = []
+        for date_range in todo:
+            if spans and spans[-1][-1][1] == date_range[0] and \
+                    (date_range[1] - spans[-1][0][0]).jd <= span_days:
+                spans[-1].append(date_range)
+            else:
+                spans.append([date_range])
+        LOG.info('Planning {} intervals with {} queries ({} already '
+                 'cached)'.format(len(todo), len(spans),
+                                  len(date_ranges) - len(todo)))
+
+        if aws and spans:
+            Observations.enable_s3_hst_dataset()
+        for windows in spans:
+            span = (windows[0][0], windows[-1][1])
+            try:
+                obs_table, products = self._query_span(span, page_size,
+                                                       batch_size)
+            except Exception as e:
+                LOG.error('{}\n Date range [{}, {}]\n {}'.format(
+                    e, span[0].iso, span[1].iso, self._msg_div)
+                )
+                continue
+
+            if len(products):
+                obs_start = dict(zip(obs_table['obsid'].astype(str),
+                                     obs_table['t_min']))
+                t_min = np.array([
+                    obs_start.get(str(obsid), np.nan)
+                    for obsid in products['parent_obsid']
+                ])
+            for i, (start, stop) in enumerate(windows):
+                if not len(products):
+                    window_products = products
+                else:
+                    # The last interval includes its stop time, matching
+                    # the range used by query()
+                    last = i == len(windows) - 1
+                    keep = (t_min >= start.mjd) & (
+                        (t_min <= stop.mjd) if last else (t_min < stop.mjd)
+                    )
+                    window_products = products[keep]
+                key = start.datetime.date().isoformat()
+                self.products[key] = window_products
+                if self.query_cache is not None:
+                    self.query_cache.put(
+                        self._cache_key((start, stop), aws=aws),
+                        window_products
+                    )
+
+    def annotate(self, products, obs_table):
+        """Copy the observation metadata needed by
+        :py:meth:`~download.Downloader.exclude` onto the product table
+
+        Each column in :py:attr:`obs_columns` is added as `obs_<name>`,
+        matched through the `parent_obsid` of each product.
+        """
+        if not len(products) or 'parent_obsid' not in products.colnames:
+            return products
+        rows = {str(obsid): i for i, obsid in enumerate(obs_table['obsid'])}
+        idx = np.array([rows.get(str(obsid), -1)
+                        for obsid in products['parent_obsid']])
+        for name in self.obs_columns:
+            if name not in obs_table.colnames:
+                continue
+            values = np.ma.asarray(obs_table[name])[np.clip(idx, 0, None)]
+            products['obs_{}'.format(name)] = MaskedColumn(
+                values, mask=np.ma.getmaskarray(values) | (idx < 0)
+            )
+        return products
+
+    def exclude(self, products):
+        """Find the products that would be discarded after downloading them
+
+        Flags subarray frames, i.e. observations whose footprint covers less
+        than `subarray_fraction` of the largest footprint in the table. For
+        observations without a footprint, the size of the science files is
+        compared instead. Short exposures are not checked, since
+        :py:meth:`query` only asks MAST for exposures of at least 0.5s.
+
+        The footprint area is only a proxy for the `SUBARRAY` keyword that
+        :py:meth:`~process.process.ProcessCCD.check_for_artifact` checks: in
+        a table holding only subarray frames nothing is flagged, and a full
+        frame with an unusually small footprint would be. It is therefore
+        only applied if `prefilter` is True in the `download` section of the
+        configuration file, which it isn't by default. Set `header_prefetch`
+        instead to apply the header rule itself before downloading (see
+        :py:meth:`prefetch_headers`).
+
+        Every product of an excluded observation is excluded. Nothing is
+        excluded if the table lacks the columns for the rule.
+
+        Parameters
+        ----------
+        products : `astropy.table.Table`
+            Product table annotated by :py:meth:`annotate`
+
+        Returns
+        -------
+        excluded : `numpy.ndarray`
+            Boolean mask over the rows of `products`
+        """
+        excluded = np.zeros(len(products), dtype=bool)
+        if not len(products) or not self.download_cfg.get('prefilter', False):
+            return excluded
+        colnames = products.colnames
+        fraction = self.download_cfg.get('subarray_fraction', 0.9)
+
+        subarray = np.zeros(len(products), dtype=bool)
+        missing = np.ones(len(products), dtype=bool)
+        if 'obs_s_region' in colnames:
+            area = np.array([footprint_area(region)
+                             for region in products['obs_s_region']])
+            missing = ~np.isfinite(area)
+            if not missing.all():
+                subarray = ~missing & (area < fraction * np.nanmax(area))
+        if missing.any() and 'size' in colnames:
+            # Only compare files of the same type, e.g. FLT with FLT
+            size = np.ma.asarray(products['size'], dtype=float).filled(np.nan)
+            kind = np.asarray(products['productSubGroupDescription'],
+                              dtype=str)
+            science = kind == str(self.SubGroupDescription[0])
+            if np.isfinite(size[science]).any():
+                subarray |= missing & science & (
+                    size < fraction * np.nanmax(size[science])
+                )
+        excluded |= subarray
+
+        # Drop every product of an excluded observation
+        obs_ids = np.asarray(products['obs_id'], dtype=str)
+        return np.isin(obs_ids, obs_ids[excluded])
+
+    def transfers(self, key):
+        """Build the list of files to download for an interval
+
+        The files are laid out as `mastDownload/HST/<obs_id>/<filename>`
+        within the :py:attr:`~download.Downloader.download_dir`, matching
+        the layout produced by `Observations.download_products`. Products
+        flagged by :py:meth:`~download.Downloader.exclude` are left out.
+
+        Files are fetched from :py:attr:`~download.Downloader.base_url` +
+        `dataURI`, or from :py:attr:`~download.Downloader.s3_url` if the
+        products were queried with `aws=True`.
+
+        Parameters
+        ----------
+        key : str
+            Date in ISO format (YYYY-MM-DD) of a given intervals start time
+
+        Returns
+        -------
+        transfers : list
+            List of :py:class:`~download.transfer.Transfer` objects
+        """
+        products = self.products[key]
+        colnames = products.colnames
+        excluded = self.exclude(products)
+        transfers = []
+        for row, skip in zip(products, excluded):
+            if skip or str(row['productSubGroupDescription']) not in \
+                    self.SubGroupDescription:
+                continue
+            size = row['size'] if 'size' in colnames else None
+            if np.ma.is_masked(size):
+                size = None
+            checksum = None
+            for algorithm in ['md5', 'sha256']:
+                if algorithm in colnames and \
+                        not np.ma.is_masked(row[algorithm]):
+                    checksum = '{}:{}'.format(algorithm, row[algorithm])
+            dest = os.path.join(self.download_dir, 'mastDownload',
+                                self.project, str(row['obs_id']),
+                                str(row['productFilename']))
+            if self.aws:
+                url = '/'.join([self.s3_url, self.s3_path(row)])
+            else:
+                url = self.base_url + str(row['dataURI'])
+            transfers.append(
+                transfer.Transfer(url=url, dest=dest, size=size,
+                                  checksum=checksum)
+            )
+        return transfers
+
+    def remote_files(self, key):
+        """List the URLs of the science files for an interval in the HST
+        public dataset, for reading them without downloading
+
+        The URLs are `<s3_prefix>/<obs_id[:4]>/<obs_id>/<filename>`, where
+        `s3_prefix` is set in the `download` section of the configuration
+        file. The telemetry (SPT) files sit next to them, so
+        :py:class:`~utils.metadata.GenerateMetadata` finds them by the same
+        suffix replacement it uses for local files. Products flagged by
+        :py:meth:`~download.Downloader.exclude` are left out.
+
+        Streamed files never go through
+        :py:meth:`~process.process.ProcessCCD.sort`, so the header rules of
+        :py:meth:`~process.process.ProcessCCD.check_for_artifact` are applied
+        here instead, by reading the headers of each file from
+        :py:attr:`~download.Downloader.s3_url`. The DQ arrays are not
+        scanned for compression artifacts.
+
+        Parameters
+        ----------
+        key : str
+            Date in ISO format (YYYY-MM-DD) of a given intervals start time
+
+        Returns
+        -------
+        urls : list
+        """
+        prefix = self.download_cfg.get('s3_prefix',
+                                       's3://stpubdata/hst/public').rstrip('/')
+        science = str(self.SubGroupDescription[0])
+        try:
+            products = self.products[key]
+        except KeyError as e:
+            LOG.error('{}\n{}'.format(e, self._msg_div))
+            return []
+        excluded = self.exclude(products)
+        urls = []
+        sources = {}
+        for row, skip in zip(products, excluded):
+            if skip or str(row['productSubGroupDescription']) != science:
+                continue
+            path = self.s3_path(row)
+            urls.append('/'.join([prefix, path]))
+            sources[str(row['productFilename'])] = '/'.join([self.s3_url,
+                                                             path])
+        if sources:
+            manifest = prefetch.header_manifest(
+                sources,
+                num_workers=self.download_cfg.get('num_workers', 8),
+                min_exptime=self.download_cfg.get('min_exptime', 0.1),
+                timeout=self.download_cfg.get('timeout', 60)
+            )
+            rejected = set(
+                manifest.loc[manifest['reason'].notna(), 'filename']
+            )
+            urls = [url for url in urls
+                    if url.rsplit('/', 1)[-1] not in rejected]
+            LOG.info('Excluded {} files by their headers, {} more would have '
+                     'had their DQ arrays scanned'.format(
+                         len(rejected),
+                         int((manifest['reason'].isna() &
+                              manifest['scan_dq'].astype(bool)).sum())))
+        LOG.info('Streaming {} files from {}\n{}'.format(len(urls), prefix,
+                                                         self._msg_div))
+        return urls
+
+    def prefetch_headers(self, key, transfers, cached=()):
+        """Read the headers of the science files and drop the observations
+        their headers rule out
+
+        Only the primary and first extension headers of each file still to
+        be downloaded are fetched, using
+        :py:func:`~download.prefetch.header_manifest`. Files already checked
+        out of the cache or downloaded by an earlier run are read locally.
+        The resulting manifest is written to `header_manifest_<key>.csv` in
+        the :py:attr:`~download.Downloader.download_dir`, where
+        :py:meth:`~process.process.ProcessCCD.build_manifest` picks it up.
+
+        Parameters
+        ----------
+        key : str
+            Date in ISO format (YYYY-MM-DD) of a given intervals start time
+
+        transfers : list
+            :py:class:`~download.transfer.Transfer` objects still to be
+            downloaded
+
+        cached : list
+            Paths of the files checked out of the cache
+
+        Returns
+        -------
+        transfers : list
+            The transfers that passed
+        """
+        science = str(self.SubGroupDescription[0]).lower()
+        sources = {}
+        for t in transfers:
+            name = os.path.basename(t.dest)
+            if science in name.lower():
+                sources[name] = t.dest if t.is_complete() else t.url
+        for fname in cached:
+            name = os.path.basename(fname)
+            if science in name.lower():
+                sources[name] = fname
+        if not sources:
+            return transfers
+
+        manifest = prefetch.header_manifest(
+            sources,
+            num_workers=self.download_cfg.get('num_workers', 8),
+            min_exptime=self.download_cfg.get('min_exptime', 0.1),
+            timeout=self.download_cfg.get('timeout', 60)
+        )
+        os.makedirs(self.download_dir, exist_ok=True)
+        manifest.to_csv(prefetch.manifest_path(self.download_dir, key),
+                        index=False)
+
+        # Observations are identified by the rootname shared by their files
+        rejected = set(
+            name.split('_')[0]
+            for name in manifest.loc[manifest['reason'].notna(), 'filename']
+        )
+        keep = [t for t in transfers
+                if os.path.basename(t.dest).split('_')[0] not in rejected]
+        saved = sum(t.size or 0 for t in transfers) - \
+            sum(t.size or 0 for t in keep)
+        LOG.info('Read {} headers ({:.1f} kB), excluded {} observations '
+                 '({} files, {:.1f} MB)\n{}'.format(
+                     len(manifest), manifest['nbytes'].sum() / 1e3,
+                     len(rejected), len(transfers) - len(keep), saved / 1e6,
+                     self._msg_div))
+        return keep
 
     def download(self, key):
         """Download the data
@@ -271,6 +892,11 @@ class Downloader(object):
         :py:attr:`~download.Downloader.products` attribute. If it is not,
         then a KeyError will be raised and the download will be skipped.
 
+        Files are downloaded concurrently by
+        :py:func:`~download.transfer.download_files`. Each file is retried
+        on failure and resumed from where the last attempt stopped, and files
+        that were already downloaded are skipped, so running the download
+        again only fetches what is missing.
 
         Parameters
         ----------
@@ -279,7 +905,8 @@ class Downloader(object):
 
         Returns
         -------
-        None
+        summary : dict
+            Summary returned by :py:func:`~download.transfer.download_files`.
             Downloaded data will be stored in directory specified by the
             :py:attr:`~download.Downloader.download_dir` attribute
         """
@@ -287,16 +914,77 @@ class Downloader(object):
                'Download Directory: {}\n {}'.format(self.download_dir,
                                                     self._msg_div))
         LOG.info(msg)
-        download_params = {
-            'download_dir': self.download_dir,
-            'mrp_only': False,
-            'dataproduct_type': self.product_type,
-            'productSubGroupDescription': self.SubGroupDescription
-        }
         try:
-            download_list = self.products[key]['obsID'].tolist()
+            transfers = self.transfers(key)
         except KeyError as e:
             LOG.error('{}\n{}'.format(e, self._msg_div))
-        else:
-            Observations.download_products(download_list, **download_params)
-
+            return None
+
+        products = self.products[key]
+        excluded = self.exclude(products)
+        excluded_nbytes = 0
+        if excluded.any() and 'size' in products.colnames:
+            excluded_nbytes = int(np.ma.asarray(
+                products['size'][excluded], dtype=float).filled(0).sum())
+
+        cached = []
+        checked_out = []
+        if self.cache is not None:
+            to_fetch = []
+            for t in transfers:
+                blob = self.cache.checkout(t.dest, t.dest,
+                                           checksum=t.checksum, size=t.size)
+                if blob is None:
+                    to_fetch.append(t)
+                else:
+                    cached.append(blob)
+                    checked_out.append(t.dest)
+            transfers = to_fetch
+
+        if self.download_cfg.get('header_prefetch', False) and \
+                not self.offline:
+            transfers = self.prefetch_headers(key, transfers, checked_out)
+
+        unavailable = []
+        if self.offline and transfers:
+            LOG.warning('Running offline, {} files are not in the download '
+                        'cache'.format(len(transfers)))
+            for t in transfers:
+                t.error = IOError('Not in the download cache')
+            unavailable, transfers = transfers, []
+
+        params = {
+            name: self.download_cfg[name]
+            for name in ['num_workers', 'max_retries', 'backoff', 'timeout']
+            if name in self.download_cfg
+        }
+        summary = transfer.download_files(transfers, **params)
+        summary['cached'] = len(cached)
+        summary['excluded'] = int(excluded.sum())
+        summary['excluded_nbytes'] = excluded_nbytes
+        summary['failed'].extend(unavailable)
+
+        if self.cache is not None:
+            failed = set(id(t) for t in summary['failed'])
+            for t in transfers:
+                if id(t) not in failed:
+                    cached.append(self.cache.add(t.dest, checksum=t.checksum))
+            self.cache.evict(keep=cached)
+
+        LOG.info(
+            'Downloaded {} files ({:.1f} MB) in {:.1f}s, skipped {}, '
+            'checked out {} from the cache, failed {}\n{}'.format(
+                summary['downloaded'], summary['nbytes'] / 1e6,
+                summary['duration'], summary['skipped'], summary['cached'],
+                len(summary['failed']), self._msg_div)
+        )
+        if excluded.any():
+            # Estimate the time saved from the throughput of this download
+            rate = summary['nbytes'] / summary['duration'] \
+                if summary['nbytes'] and summary['duration'] else None
+            LOG.info('Excluded {} products ({:.1f} MB) before downloading, '
+                     'saving {}\n{}'.format(
+                         summary['excluded'], excluded_nbytes / 1e6,
+                         '~{:.1f}s'.format(excluded_nbytes / rate) if rate
+                         else 'an unknown amount of time', self._msg_div))
+        return summary
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+This module reads the FITS headers of remote files without downloading them.
+
+FITS files are made of 2880 byte blocks, and each header ends with an `END`
+card. The primary header is read from the start of the file with an HTTP
+Range request, extended one request at a time until its `END` card is found.
+The size of the data that follows is computed from the header, and the first
+extension header is then read from the next block boundary. For an FLT file
+this costs a few tens of kilobytes instead of the whole file.
+
+:py:func:`header_manifest` reads the headers of many files in parallel and
+applies the header rules of
+:py:meth:`~process.process.ProcessCCD.check_for_artifact`, so files that
+would be discarded after downloading them are never downloaded.
+"""
+import logging
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+import numpy as np
+import pandas as pd
+
+
+logging.basicConfig(format='%(levelname)-4s '
+                           '[%(module)s:%(funcName)s:%(lineno)d]'
+                           ' %(message)s')
+LOG = logging.getLogger('prefetch')
+LOG.setLevel(logging.INFO)
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Header keywords recorded in the manifest
+MANIFEST_KEYS = ['EXPTIME', 'CCDAMP', 'CCDTAB', 'SUBARRAY', 'QUALITY']
+
+
+class RemoteFile(object):
+    """
+    Random access to a remote file through HTTP Range requests
+
+    Bytes that have already been fetched are kept, so reading the headers
+    one after the other only requests each byte once. If the server ignores
+    the Range header, only the bytes needed are read from the response
+    before the connection is closed.
+
+    Parameters
+    ----------
+    url : str
+        URL of the file
+
+    timeout : float
+        Timeout in seconds for connecting and for each read
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self.nbytes = 0
+        self.requests = 0
+        self._start = 0
+        self._buffer = b''
+
+    def _fetch(self, start, stop):
+        request = urllib.request.Request(
+            self.url, headers={'Range': 'bytes={}-{}'.format(start, stop - 1)}
+        )
+        self.requests += 1
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            if response.status == 206:
+                data = response.read()
+            else:
+                data = response.read(stop)[start:]
+        self.nbytes += len(data)
+        return data
+
+    def read(self, start, stop):
+        """Read bytes `start` to `stop`
+
+        Fewer bytes are returned if the file ends before `stop`.
+        """
+        end = self._start + len(self._buffer)
+        if not self._start <= start <= end:
+            self._start, self._buffer = start, b''
+            end = start
+        if stop > end:
+            self._buffer += self._fetch(end, stop)
+        return self._buffer[start - self._start:stop - self._start]
+
+
+def _data_size(header):
+    """Size in bytes of the data following `header`, padded to a block"""
+    naxis = header.get('NAXIS', 0)
+    if not naxis:
+        return 0
+    npix = np.prod([header.get('NAXIS{}'.format(i), 0)
+                    for i in range(1, naxis + 1)], dtype=np.int64)
+    nbytes = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * \
+        (header.get('PCOUNT', 0) + npix)
+    return int(-(-nbytes // BLOCK_SIZE) * BLOCK_SIZE)
+
+
+def read_headers(url, nheaders=2, timeout=60, nblocks=8):
+    """Read the first `nheaders` headers of a remote FITS file
+
+    Parameters
+    ----------
+    url : str
+        URL of the file
+
+    nheaders : int
+        Number of headers to read (2 for the primary and first extension)
+
+    timeout : float
+        Timeout in seconds for each request
+
+    nblocks : int
+        Number of 2880 byte blocks requested at a time
+
+    Returns
+    -------
+    headers : list
+        List of `astropy.io.fits.Header` objects
+
+    nbytes : int
+        Number of bytes transferred
+    """
+    remote = RemoteFile(url, timeout=timeout)
+    headers = []
+    offset = 0
+    while len(headers) < nheaders:
+        stop = offset
+        end = None
+        while end is None:
+            data = remote.read(offset, stop + nblocks * BLOCK_SIZE)
+            if len(data) <= stop - offset:
+                raise IOError('{} ended before the END card of header '
+                              '{}'.format(url, len(headers)))
+            # END is always at the start of a card
+            for i in range(stop - offset, len(data) - CARD_SIZE + 1,
+                           CARD_SIZE):
+                if data[i:i + 8] == b'END     ':
+                    end = i + CARD_SIZE
+                    break
+            stop = offset + len(data) - len(data) % CARD_SIZE
+        header = fits.Header.fromstring(data[:end].decode('ascii'))
+        headers.append(header)
+        offset += -(-end // BLOCK_SIZE) * BLOCK_SIZE + _data_size(header)
+    return headers, remote.nbytes
+
+
+def header_rules(prhdr, scihdr, min_exptime=0.1):
+    """Apply the header rules of
+    :py:meth:`~process.process.ProcessCCD.check_for_artifact`
+
+    Parameters
+    ----------
+    prhdr, scihdr : `astropy.io.fits.Header`
+        Primary and first extension headers
+
+    min_exptime : float
+        Images with shorter exposures are discarded
+
+    Returns
+    -------
+    reason : str or None
+        Why the image would be discarded, or None if it is kept
+
+    scan_dq : bool
+        True if the headers did not decide and the DQ arrays have to be
+        scanned for compression artifacts
+    """
+    exptime = prhdr.get('EXPTIME', scihdr.get('EXPTIME'))
+    if 'SUBARRAY' in prhdr:
+        return ('subarray' if prhdr['SUBARRAY'] else None), False
+    if len(prhdr['QUALCOM*']):
+        for key in prhdr['QUALCOM*']:
+            if len(str(prhdr[key])) > 30:
+                return 'quality comment', False
+        if 'ok' in str(prhdr.get('QUALITY', '')).lower():
+            return None, False
+    if exptime is not None and exptime < min_exptime:
+        return 'exptime', False
+    return None, True
+
+
+def header_decision(prhdr, scihdr, min_exptime=0.1):
+    """Find why an image would be discarded based on its headers alone
+
+    See :py:func:`header_rules`.
+
+    Returns
+    -------
+    reason : str or None
+        Why the image would be discarded, or None if it has to be
+        downloaded (its DQ arrays may still need to be checked)
+    """
+    return header_rules(prhdr, scihdr, min_exptime=min_exptime)[0]
+
+
+def _manifest_row(item, min_exptime, timeout):
+    """Read the headers of a single file and apply the header rules"""
+    name, source = item
+    row = {'filename': name, 'nbytes': 0, 'reason': None, 'scan_dq': True}
+    try:
+        if os.path.isfile(source):
+            with fits.open(source) as hdu:
+                prhdr = hdu[0].header
+                scihdr = hdu[1].header
+        else:
+            (prhdr, scihdr), row['nbytes'] = read_headers(source,
+                                                          timeout=timeout)
+    except Exception as e:
+        LOG.warning('Unable to read the headers of {}: {}'.format(name, e))
+        row['error'] = str(e)
+        return row
+    for key in MANIFEST_KEYS:
+        row[key.lower()] = prhdr.get(key, scihdr.get(key))
+    row['reason'], row['scan_dq'] = header_rules(prhdr, scihdr,
+                                                 min_exptime=min_exptime)
+    return row
+
+
+def manifest_path(download_dir, key):
+    """Path of the manifest written by
+    :py:meth:`~download.download.Downloader.prefetch_headers` for the
+    interval starting on `key` (YYYY-MM-DD)"""
+    return os.path.join(download_dir, 'header_manifest_{}.csv'.format(key))
+
+
+def read_manifest(fname):
+    """Read a manifest written by :py:func:`header_manifest`
+
+    Missing values are returned as None, as in a freshly built manifest.
+    """
+    manifest = pd.read_csv(fname)
+    return manifest.astype(object).where(manifest.notna(), None)
+
+
+def header_manifest(sources, num_workers=8, min_exptime=0.1, timeout=60):
+    """Read the headers of many files in parallel
+
+    Parameters
+    ----------
+    sources : dict
+        Maps the filename of each image to its local path or URL. Local
+        files are read directly and remote ones through
+        :py:func:`read_headers`.
+
+    num_workers : int
+        Number of files to read concurrently
+
+    min_exptime : float
+        See :py:func:`header_rules`
+
+    timeout : float
+        Timeout in seconds for each request
+
+    Returns
+    -------
+    manifest : `pandas.DataFrame`
+        One row per file with the keywords in :py:data:`MANIFEST_KEYS`, the
+        bytes transferred, the reason the file would be discarded (None
+        for the files to download), and whether its DQ arrays still have to
+        be scanned. Files whose headers could not be read are kept, with the
+        reason in an `error` column.
+    """
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        rows = list(executor.map(
+            lambda item: _manifest_row(item, min_exptime, timeout),
+            sources.items()
+        ))
+    columns = ['filename'] + [key.lower() for key in MANIFEST_KEYS] + \
+        ['reason', 'scan_dq', 'nbytes', 'error']
+    manifest = pd.DataFrame(rows)
+    for column in columns:
+        if column not in manifest:
+            manifest[column] = None
+    return manifest
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+This module handles the transfer of individual files over HTTP.
+
+Files are fetched concurrently by a bounded pool of threads. Each file is
+written to a `<name>.part` file, which is only renamed to its final name once
+its size (and checksum, if one is known) has been verified. If a transfer
+fails, it is retried with an exponential backoff, and the retry resumes from
+the end of the partial file with an HTTP Range request. A file that already
+exists with the expected size is not downloaded again.
+
+Only the standard library is used, so any HTTP server can stand in for MAST
+in tests and benchmarks, e.g. ``python -m http.server`` serving a copy of the
+expected directory tree.
+"""
+import hashlib
+import http.client
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+logging.basicConfig(format='%(levelname)-4s '
+                           '[%(module)s:%(funcName)s:%(lineno)d]'
+                           ' %(message)s')
+LOG = logging.getLogger('transfer')
+LOG.setLevel(logging.INFO)
+
+
+class Transfer(object):
+    """
+    A single file to be downloaded
+
+    Parameters
+    ----------
+    url : str
+        URL of the file
+
+    dest : str
+        Full path to write the file to
+
+    size : int, optional
+        Expected size of the file in bytes
+
+    checksum : str, optional
+        Expected checksum of the file, given as `<algorithm>:<hex digest>`
+        (e.g. `md5:0f343b...`). A bare hex digest is assumed to be an MD5.
+    """
+
+    def __init__(self, url, dest, size=None, checksum=None):
+        self.url = url
+        self.dest = dest
+        self.size = int(size) if size is not None and size >= 0 else None
+        self.checksum = checksum
+        self.nbytes = 0
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def part(self):
+        """Path of the partial file written during the transfer"""
+        return '{}.part'.format(self.dest)
+
+    def verify(self, fname):
+        """Check the size and checksum of `fname` against the expected ones
+
+        Raises
+        ------
+        IOError
+            If either of them do not match
+        """
+        if self.size is not None:
+            nbytes = os.path.getsize(fname)
+            if nbytes != self.size:
+                raise IOError('{} is {} bytes, expected {}'.format(
+                    os.path.basename(self.dest), nbytes, self.size)
+                )
+        if self.checksum:
+            algorithm, _, digest = self.checksum.rpartition(':')
+            hasher = hashlib.new(algorithm or 'md5')
+            with open(fname, 'rb') as fobj:
+                for block in iter(lambda: fobj.read(2**20), b''):
+                    hasher.update(block)
+            if hasher.hexdigest() != digest.lower():
+                raise IOError('{} failed {} verification'.format(
+                    os.path.basename(self.dest), algorithm or 'md5')
+                )
+
+    def is_complete(self):
+        """Check if the file has already been downloaded
+
+        Without a known size or checksum, an existing file is assumed to be
+        complete since it can only have been written by a verified transfer.
+        """
+        if not os.path.isfile(self.dest):
+            return False
+        try:
+            self.verify(self.dest)
+        except IOError:
+            return False
+        return True
+
+
+def fetch(transfer, timeout=60, chunk_size=2**20):
+    """Download a single file, resuming from its partial file if it exists
+
+    Parameters
+    ----------
+    transfer : :py:class:`Transfer`
+        File to download
+
+    timeout : float
+        Timeout in seconds for connecting and for each read
+
+    chunk_size : int
+        Number of bytes to read and write at a time
+
+    Returns
+    -------
+    nbytes : int
+        Number of bytes transferred
+    """
+    os.makedirs(os.path.dirname(transfer.dest), exist_ok=True)
+    offset = 0
+    if os.path.isfile(transfer.part):
+        offset = os.path.getsize(transfer.part)
+        if transfer.size is not None and offset > transfer.size:
+            os.remove(transfer.part)
+            offset = 0
+        elif offset and offset == transfer.size:
+            # An earlier attempt was interrupted before the rename
+            try:
+                transfer.verify(transfer.part)
+            except IOError:
+                os.remove(transfer.part)
+                offset = 0
+            else:
+                os.replace(transfer.part, transfer.dest)
+                return 0
+
+    request = urllib.request.Request(transfer.url)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+
+    nbytes = 0
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        # The partial file already holds every byte, which can only be
+        # trusted if there is something to verify it against
+        if e.code != 416:
+            raise
+        if transfer.size is None and not transfer.checksum:
+            os.remove(transfer.part)
+            raise IOError('Range not satisfiable for {}, and the partial '
+                          'file can not be verified'.format(
+                              os.path.basename(transfer.dest)))
+    else:
+        with response:
+            # A server that ignores the Range header sends the whole file
+            mode = 'ab' if response.status == 206 else 'wb'
+            with open(transfer.part, mode) as fobj:
+                for block in iter(lambda: response.read(chunk_size), b''):
+                    fobj.write(block)
+                    nbytes += len(block)
+            length = response.headers.get('Content-Length')
+            if length is not None and nbytes != int(length):
+                raise IOError('Connection closed after {} of {} bytes'.format(
+                    nbytes, length)
+                )
+
+    try:
+        transfer.verify(transfer.part)
+    except IOError:
+        # Corrupt data can not be resumed from
+        os.remove(transfer.part)
+        raise
+    os.replace(transfer.part, transfer.dest)
+    return nbytes
+
+
+def fetch_with_retries(transfer, max_retries=5, backoff=2., **kwargs):
+    """Download a single file, retrying failed attempts
+
+    The n-th retry waits `backoff * 2**(n - 1)` seconds before resuming the
+    transfer.
+
+    Parameters
+    ----------
+    transfer : :py:class:`Transfer`
+        File to download
+
+    max_retries : int
+        Number of times to retry a failed transfer
+
+    backoff : float
+        Seconds to wait before the first retry
+
+    kwargs
+        Passed to :py:func:`fetch`
+
+    Returns
+    -------
+    transfer : :py:class:`Transfer`
+        The `error` attribute is set if every attempt failed
+    """
+    if transfer.is_complete():
+        return transfer
+    for attempt in range(max_retries + 1):
+        transfer.attempts += 1
+        try:
+            transfer.nbytes += fetch(transfer, **kwargs)
+        except (IOError, OSError, http.client.HTTPException) as e:
+            # urllib.error.URLError and socket timeouts are OSErrors, a
+            # connection dropped mid-body raises http.client.IncompleteRead
+            transfer.error = e
+            if attempt < max_retries:
+                wait = backoff * 2**attempt
+                LOG.warning('{} (attempt {}), retrying in {:.1f}s'.format(
+                    e, transfer.attempts, wait)
+                )
+                time.sleep(wait)
+        else:
+            transfer.error = None
+            break
+    return transfer
+
+
+def download_files(transfers, num_workers=8, max_retries=5, backoff=2.,
+                   timeout=60, chunk_size=2**20):
+    """Download a list of files concurrently
+
+    Parameters
+    ----------
+    transfers : list
+        List of :py:class:`Transfer` objects
+
+    num_workers : int
+        Maximum number of concurrent transfers
+
+    max_retries : int
+        Number of times to retry each failed transfer
+
+    backoff : float
+        Seconds to wait before the first retry of a transfer
+
+    timeout : float
+        Timeout in seconds for connecting and for each read
+
+    chunk_size : int
+        Number of bytes to read and write at a time
+
+    Returns
+    -------
+    summary : dict
+        Number of files downloaded, skipped, and failed, the bytes
+        transferred, the elapsed time, and the failed :py:class:`Transfer`
+        objects
+    """
+    start_time = time.time()
+    summary = {'downloaded': 0, 'skipped': 0, 'nbytes': 0, 'failed': []}
+    if not transfers:
+        summary['duration'] = 0.
+        return summary
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(fetch_with_retries, transfer,
+                            max_retries=max_retries, backoff=backoff,
+                            timeout=timeout, chunk_size=chunk_size)
+            for transfer in transfers
+        ]
+        for future in as_completed(futures):
+            transfer = future.result()
+            if transfer.error is not None:
+                LOG.error('Failed to download {}: {}'.format(transfer.url,
+                                                             transfer.error))
+                summary['failed'].append(transfer)
+            elif transfer.attempts:
+                summary['downloaded'] += 1
+            else:
+                summary['skipped'] += 1
+            summary['nbytes'] += transfer.nbytes
+    summary['duration'] = time.time() - start_time
+    return summary
@@ -7,7 +7,6 @@ class for arbtirary label objects and one specific to cosmic rays
 from collections import Iterable
 import logging
 
-from astropy.io import fits
 from astropy.stats import sigma_clipped_stats, median_absolute_deviation
 from astropy.visualization import ImageNormalize, LinearStretch, ZScaleInterval, LogStretch
 import matplotlib.pyplot as plt
@@ -16,6 +15,8 @@ import matplotlib.patches as patches
 import numpy as np
 from scipy import ndimage
 
+from utils import remote
+
 
 logging.basicConfig(format='%(levelname)-4s '
                            '[%(module)s.%(funcName)s:%(lineno)d]'
@@ -31,14 +32,19 @@ class Label(object):
     Parameters
     ----------
     fname : str
-        Name of FITS file
+        Name of FITS file, or its URL
+
+    storage_options : dict, optional
+        Options for reading `fname` when it is a URL, see
+        :py:func:`utils.remote.storage_options`
 
     """
-    def __init__(self, fname, gain_keyword=None):
+    def __init__(self, fname, gain_keyword=None, storage_options=None):
 
 
         self._fname = fname
         self._gain_keyword = gain_keyword
+        self._storage_options = storage_options
         self._label = None
         self._dq = None
         self._sci = None
@@ -113,7 +119,8 @@ class Label(object):
         """
         ext_tuples = [(extname, num) for num in extnums]
         ext_data = []
-        with fits.open(self.fname) as hdu:
+        with remote.open_fits(self.fname,
+                              storage_options=self._storage_options) as hdu:
             units = hdu[1].header['BUNIT']
             if self.gain_keyword is not None:
                 # For CCD's with multiple readout amplifiers the line below
@@ -469,11 +476,13 @@ class CosmicRayLabel(Label):
         conversion of DN to ELECTRONS. Additionally, the conversion is only
         applied if the BUNIT keyword is DN or COUNTS.
 
-
+    storage_options : dict, optional
+        Options for reading `fname` when it is a URL, see
+        :py:func:`utils.remote.storage_options`
 
     """
-    def __init__(self, fname, gain_keyword=None):
-        super().__init__(fname, gain_keyword)
+    def __init__(self, fname, gain_keyword=None, storage_options=None):
+        super().__init__(fname, gain_keyword, storage_options)
 
 
     def run_ccd_label(self, deblend=False, use_dq=True, extnums=[1,2],
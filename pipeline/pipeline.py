@@ -18,12 +18,14 @@ import yaml
 
 # local packages
 import download.download as download
+import download.prefetch as prefetch
 import label.labeler as labeler
 import process.process as process
 import stat_utils.statshandler as statshandler
 import utils.datahandler as datahandler
 import utils.initialize as initialize
 import utils.metadata as metadata
+import utils.remote as remote
 import utils.sendit as sendit
 
 
@@ -39,8 +41,10 @@ parser = argparse.ArgumentParser()
 
 parser.add_argument('-aws',
                     action='store_true',
-                    help='Flag for using AWS for downloads. Only to be used '
-                         'when the pipeline is run on EC2',
+                    help='Flag for using AWS for downloads. Files are '
+                         'fetched from the HST public dataset at s3_prefix '
+                         'instead of MAST. Only to be used when the pipeline '
+                         'is run on EC2',
                     default=False)
 
 parser.add_argument('-download',
@@ -70,7 +74,11 @@ parser.add_argument('-chunks',
                          'half of the dataset will be written to file 1 and the '
                          'second half will be written to file 2. This is to '
                          'offset the degradation in write time as the number of '
-                         'datasets stored in the HDF5 increases.',
+                         'datasets stored in the HDF5 increases. If `-chunks 0` '
+                         'is passed, a new file is started whenever the current '
+                         'one exceeds the `max_shard_size` or '
+                         '`max_shard_datasets` limits in the `results` section '
+                         'of the config file instead.',
                     type=int,
                     default=4)
 
@@ -90,6 +98,44 @@ parser.add_argument('-instr',
                     help='HST instrument to process (acs_wfc, '
                          'wfc3_uvis, stis_ccd, acs_hrc)')
 
+parser.add_argument('-on_duplicate',
+                    default='skip',
+                    choices=['skip', 'replace', 'error'],
+                    help='What to do with an image whose results have already '
+                         'been written (e.g. when a month is re-run after a '
+                         'crash). `skip` keeps the stored results, `replace` '
+                         'overwrites them, and `error` stops the pipeline.')
+
+parser.add_argument('-store_downloads',
+                    action='store_true',
+                    default=False,
+                    help='Keep the downloaded files in the download cache '
+                         'listed in the `download` section of the config file.'
+                         ' Files already in the cache are not downloaded '
+                         'again.')
+
+parser.add_argument('-offline',
+                    action='store_true',
+                    default=False,
+                    help='Run without contacting MAST, using only the cached '
+                         'query results and the download cache.')
+
+parser.add_argument('-stream',
+                    action='store_true',
+                    default=False,
+                    help='Read the files straight from the HST public dataset '
+                         'on S3 instead of downloading them. Cannot be '
+                         'combined with -process, since CR rejection writes '
+                         'to the files.')
+
+parser.add_argument('-allow_unprocessed',
+                    action='store_true',
+                    default=False,
+                    help='Allow -stream with -ccd. The streamed images skip '
+                         'the CR rejection and the DQ artifact checks of '
+                         '-process, so their results are written to separate '
+                         '`*_unrejected.hdf5` files.')
+
 parser.add_argument('-initialize',
                     action='store_true',
                     default=False,
@@ -110,7 +156,9 @@ LOG.setLevel(logging.INFO)
 class CosmicRayPipeline(object):
     def __init__(self, aws=None, analyze=None, download=None, ccd=None,
                  chunks=None, ir=None, instr=None, initialize=None,
-                 process=None, store_downloads=None, use_dq=None, test=None):
+                 offline=None, on_duplicate='skip', process=None,
+                 store_downloads=None, stream=None, allow_unprocessed=None,
+                 use_dq=None, test=None):
         """ Class for combining the individual tasks into a single pipeline.
         """
         # Initialize Args
@@ -118,12 +166,22 @@ class CosmicRayPipeline(object):
         self._analyze = analyze
         self._download = download
         self._ccd = ccd
-        self._chunks = chunks
+        # Without a fixed number of chunks, shards are rolled over by size
+        self._chunks = chunks or None
         self._ir = ir
         self._instr = instr.upper()
         self._initialize = initialize
+        self._offline = offline
+        self._on_duplicate = on_duplicate
         self._process = process
         self._store_downloads = store_downloads
+        self._stream = stream
+        if stream and process:
+            raise ValueError('-stream can not be combined with -process, '
+                             'the CR rejection step writes to the input files')
+        if stream and ccd and not allow_unprocessed:
+            raise ValueError('-stream skips the CR rejection of CCD images, '
+                             'pass -allow_unprocessed to analyze them anyway')
         self._use_dq = use_dq
 
         # Necessary evil to dynamically build absolute paths
@@ -283,6 +341,24 @@ class CosmicRayPipeline(object):
         """Switch for toggling on the IR analysis"""
         return self._ir
 
+    @property
+    def offline(self):
+        return self._offline
+
+    @offline.getter
+    def offline(self):
+        """Switch for running without contacting MAST"""
+        return self._offline
+
+    @property
+    def on_duplicate(self):
+        return self._on_duplicate
+
+    @on_duplicate.getter
+    def on_duplicate(self):
+        """Policy for handling images whose results were already written"""
+        return self._on_duplicate
+
     @property
     def process(self):
         return self._process
@@ -337,9 +413,57 @@ class CosmicRayPipeline(object):
 
     @store_downloads.getter
     def store_downloads(self):
-        """Switch for saving the downloaded files"""
+        """Switch for saving the downloaded files
+
+        When True, downloaded files are kept in the download cache. The
+        copies in the download directory are hard links to the cache, so they
+        are still removed at the end of each month.
+        """
         return self._store_downloads
 
+    @property
+    def stream(self):
+        return self._stream
+
+    @stream.getter
+    def stream(self):
+        """Switch for reading the files from S3 instead of downloading them"""
+        return self._stream
+
+    @property
+    def results_cfg(self):
+        return self._results_cfg()
+
+    @results_cfg.getter
+    def results_cfg(self):
+        """Configuration object passed to the
+        :py:class:`~utils.datahandler.DataWriter`
+
+        When streaming, the CCD images are not CR rejected, so their results
+        go to `<name>_unrejected.hdf5` instead of the files listed in the
+        `hdf5_files` section, and are never mixed with the processed ones.
+        """
+        return self._results_cfg()
+
+    def _results_cfg(self):
+        if not (self.stream and self.ccd):
+            return self.cfg
+        cfg = dict(self.cfg)
+        cfg[self.instr] = dict(self.instr_cfg)
+        cfg[self.instr]['hdf5_files'] = {
+            statistic: path.replace('.hdf5', '_unrejected.hdf5')
+            for statistic, path in self.instr_cfg['hdf5_files'].items()
+        }
+        return cfg
+
+    @property
+    def storage_options(self):
+        """Options for reading the streamed files, see
+        :py:func:`utils.remote.storage_options`"""
+        prefix = self.cfg.get('download', {}).get('s3_prefix', 's3://')
+        return remote.storage_options(self.cfg.get('download'),
+                                      protocol=prefix.split('://')[0])
+
     @property
     def use_dq(self):
         return self._use_dq
@@ -352,6 +476,10 @@ class CosmicRayPipeline(object):
     def run_downloader(self, date_range, downloader):
         """Download the data
 
+        When streaming, nothing is downloaded and the
+        :py:attr:`~pipeline.CosmicRayPipeline.flist` is set to the URLs of
+        the files instead.
+
         Parameters
         ----------
         date_range : Tuple
@@ -366,7 +494,11 @@ class CosmicRayPipeline(object):
         """
         start_time = time.time()
         downloader.query(date_range=date_range, aws=self.aws)
-        downloader.download(date_range[0].datetime.date().isoformat())
+        key = date_range[0].datetime.date().isoformat()
+        if self.stream:
+            self.flist = downloader.remote_files(key)
+        else:
+            downloader.download(key)
         end_time = time.time()
         return (end_time - start_time)/60
 
@@ -390,9 +522,13 @@ class CosmicRayPipeline(object):
             Dictionary containing the computed statistics
         """
 
-        file_metadata = metadata.GenerateMetadata(fname,
-                                                  instr=self.instr,
-                                                  instr_cfg=self.instr_cfg)
+        storage_options = self.storage_options if self.stream else None
+        file_metadata = metadata.GenerateMetadata(
+            fname,
+            instr=self.instr,
+            instr_cfg=self.instr_cfg,
+            storage_options=storage_options
+        )
 
         # Get image metadata
         file_metadata.get_image_data()
@@ -405,7 +541,8 @@ class CosmicRayPipeline(object):
 
         cr_label = labeler.CosmicRayLabel(
             fname,
-            gain_keyword=self.instr_cfg['instr_params']['gain_keyword']
+            gain_keyword=self.instr_cfg['instr_params']['gain_keyword'],
+            storage_options=storage_options
         )
 
         label_params = {
@@ -452,9 +589,10 @@ class CosmicRayPipeline(object):
 
         Parameters
         ----------
-        chunk_num : int
+        chunk_num : int or None
             Current chunk number we are analyzing. Used to write the results to
-            the proper file
+            the proper file. If None, the results are written to the current
+            shard listed in the shard manifest.
 
         Returns
         -------
@@ -478,11 +616,12 @@ class CosmicRayPipeline(object):
 
         cr_stats, file_metdata = zip(*results)
 
-        datawriter = datahandler.DataWriter(cfg=self.cfg,
+        datawriter = datahandler.DataWriter(cfg=self.results_cfg,
                                             chunk_num=chunk_num,
                                             cr_stats=cr_stats,
                                             file_metadata=file_metdata,
-                                            instr=self.instr)
+                                            instr=self.instr,
+                                            on_duplicate=self.on_duplicate)
         datawriter.write_results()
         end_time = time.time()
 
@@ -510,9 +649,17 @@ class CosmicRayPipeline(object):
 
         # Process only if there are files to process
         if self.ccd and self.flist:
-            processor = process.ProcessCCD(instr=self.instr,
-                                           instr_cfg=self.instr_cfg,
-                                           flist=self.flist)
+            download_dir = os.path.join(
+                self.base,
+                *self.instr_cfg['astroquery']['download_dir'].split('/')
+            )
+            processor = process.ProcessCCD(
+                instr=self.instr,
+                instr_cfg=self.instr_cfg,
+                flist=self.flist,
+                header_manifest=prefetch.manifest_path(
+                    download_dir, start.datetime.date().isoformat())
+            )
             processor.sort()
             processor.cr_reject()
             if 'failed' in processor.output.keys():
@@ -664,12 +811,32 @@ class CosmicRayPipeline(object):
             initializer_obj.initialize_HDF5(chunks=self.chunks)
 
         # Initialize the downloader
-        downloader = download.Downloader(instr=self.instr,
-                                         instr_cfg=self.instr_cfg)
+        downloader = download.Downloader(
+            instr=self.instr,
+            instr_cfg=self.instr_cfg,
+            download_cfg=self.cfg.get('download'),
+            store_downloads=self.store_downloads,
+            offline=self.offline
+        )
 
-        # Divide up the dates into chunks
-        date_chunks = np.array_split(initializer_obj.dates, self.chunks)
+        # Query MAST for every interval left to analyze up front, so the
+        # monthly downloads below do not need to query it again
+        if self.download or self.stream:
+            todo = [
+                (start, stop) for (start, stop) in initializer_obj.dates
+                if '{} {}'.format(start.iso, stop.iso) not in
+                initializer_obj.previously_analyzed
+            ]
+            downloader.plan(todo, aws=self.aws)
+
+        # Divide up the dates into chunks. Without a fixed number of chunks,
+        # the DataWriter decides when to start a new shard.
+        if self.chunks is None:
+            date_chunks = [initializer_obj.dates]
+        else:
+            date_chunks = np.array_split(initializer_obj.dates, self.chunks)
         for i, chunk in enumerate(date_chunks):
+            chunk_num = None if self.chunks is None else i + 1
             for (start, stop) in chunk:
                 failed = False
                 results = None
@@ -682,12 +849,13 @@ class CosmicRayPipeline(object):
                 # Start the analysis
                 LOG.info('Analyzing data from {} to {}'.format(start.iso,
                                                                stop.iso))
-                if self.download:
+                if self.download or self.stream:
                     download_time = self.run_downloader(date_range=(start, stop),
                                                         downloader=downloader)
                     self.processing_times['download'] = download_time
 
-                self.flist = glob.glob(self.search_pattern)
+                if not self.stream:
+                    self.flist = glob.glob(self.search_pattern)
 
                 if self.process:
                     process_time = self.run_processing(start, stop)
@@ -698,7 +866,7 @@ class CosmicRayPipeline(object):
                 # the analyze flag is True.
                 if self.analyze and self.flist:
                     analysis_time, results = self.run_labeling_all(
-                        chunk_num=i + 1
+                        chunk_num=chunk_num
                     )
                     self.processing_times['analysis'] = analysis_time
                 else:
@@ -43,15 +43,17 @@ from astropy.io import fits
 import dask
 from numpy import array
 from numpy import array_split
-from numpy import concatenate
-from numpy import where
 import numpy.random as random
+import pandas as pd
 import yaml
 
 from acstools import acsrej
 from stistools import ocrreject
 from wfc3tools import wf3rej
 
+from download import prefetch
+from download.cache import detach
+
 
 logging.basicConfig(format='%(levelname)-4s '
                            '[%(module)s:%(funcName)s:%(lineno)d]'
@@ -70,8 +72,13 @@ class ProcessCCD(object):
     flist : list
         List of files to process
 
+    header_manifest : str, optional
+        Path to the manifest written by
+        :py:meth:`~download.download.Downloader.prefetch_headers` when the
+        files were downloaded. The headers it lists are not read again.
+
     """
-    def __init__(self, instr, flist, instr_cfg=None):
+    def __init__(self, instr, flist, instr_cfg=None, header_manifest=None):
 
         # Set up base path
         self._mod_dir = os.path.dirname(os.path.abspath(__file__))
@@ -104,6 +111,8 @@ class ProcessCCD(object):
                                           '')
         self._input = {}
         self._output = defaultdict(list)
+        self._manifest = None
+        self._header_manifest = header_manifest
         self._i = 0
         self._msg_div = '-' * 79
 
@@ -186,6 +195,16 @@ class ProcessCCD(object):
     def output(self, value):
         self._output = value
 
+    @property
+    def manifest(self):
+        return self._manifest
+
+    @manifest.getter
+    def manifest(self):
+        """Table of the header keywords of every file, built by
+        :py:meth:`build_manifest`"""
+        return self._manifest
+
     @property
     def num(self):
         return self._num
@@ -224,64 +243,132 @@ class ProcessCCD(object):
         finally:
             return fout
 
-    def check_for_artifact(self, f, extname='dq', extnums=[1,2]):
-        """ Scan the DQ extension for compression artifacts
+    def build_manifest(self):
+        """Read the headers of every file in :py:attr:`flist` once
 
-        In early ACS images when the option for compressing data was available,
-        there is a possibility of Reed-Solomon decoding errors being incorrectly
-        classified as cosmic rays during the cosmic ray rejection step.
-        """
+        The primary and first extension headers are read in parallel with
+        :py:func:`~download.prefetch.header_manifest`, which also applies the
+        header rules of :py:meth:`check_for_artifact`. Every later step
+        uses the resulting table instead of reopening the files.
 
-        ext_tuples = [(extname, num) for num in extnums]
-        ext_data = []
-        with fits.open(f, mode='update') as hdu:
-            prhdr = hdu[0].header
-            scihdr = hdu[1].header
-            for val in ext_tuples:
+        Files listed in the manifest written while downloading them (see the
+        `header_manifest` parameter) are taken from it instead, so only the
+        headers of the remaining files are read.
+
+        Returns
+        -------
+        manifest : `pandas.DataFrame`
+            One row per file, see :py:func:`~download.prefetch.header_manifest`
+        """
+        start_time = time.time()
+        sources = {f: f for f in self.flist}
+        tables = []
+        if self._header_manifest is not None and \
+                os.path.isfile(self._header_manifest):
+            known = prefetch.read_manifest(self._header_manifest)
+            # The manifest lists filenames, and files whose headers could
+            # not be read are read again
+            paths = {os.path.basename(f): f for f in self.flist}
+            known = known[known['filename'].isin(list(paths)) &
+                          known['error'].isna()].copy()
+            known['filename'] = known['filename'].map(paths)
+            for f in known['filename']:
+                del sources[f]
+            tables.append(known)
+            LOG.info('Took the headers of {} files from {}'.format(
+                len(known), self._header_manifest))
+        if sources or not tables:
+            tables.append(prefetch.header_manifest(
+                sources,
+                num_workers=os.cpu_count(),
+                min_exptime=0.1
+            ))
+        order = {f: i for i, f in enumerate(self.flist)}
+        manifest = pd.concat(tables, ignore_index=True)
+        self._manifest = manifest.sort_values(
+            'filename', key=lambda column: column.map(order)
+        ).reset_index(drop=True)
+        LOG.info('Read the headers of {} files in {:.2f}s'.format(
+            len(sources), time.time() - start_time))
+        return self._manifest
+
+    def has_dq_artifact(self, f, extname='dq', extnums=[1,2],
+                        chunk_rows=256):
+        """ Scan the DQ extensions of a file for compression artifacts
+
+        Pixels flagged with a value of 2 in the DQ arrays mark Reed-Solomon
+        decoding errors. The file is opened read-only and memory mapped, and
+        each DQ array is scanned `chunk_rows` rows at a time, so the scan
+        stops at the first chunk containing an artifact without reading the
+        rest of the file.
+        """
+        with fits.open(f, memmap=True) as hdu:
+            for num in extnums:
                 try:
-                    ext = hdu.index_of(val)
+                    ext = hdu.index_of((extname, num))
                 except KeyError:
-                    LOG.warning('{} is missing for {}'.format(val, f))
-                else:
-                    ext_data.append(hdu[ext].data)
+                    LOG.warning('{} is missing for {}'.format((extname, num),
+                                                              f))
+                    continue
+                dq = hdu[ext].data
+                for start in range(0, dq.shape[0], chunk_rows):
+                    if (dq[start:start + chunk_rows] == 2).any():
+                        return True
+        return False
 
-            # Grab the exposure time to ensure we don't get mislabeled darks
-            try:
-                exptime = prhdr['EXPTIME']
-            except KeyError as e:
-                LOG.warning('{}\n Searching SCI header'.format(e))
-                exptime = scihdr['EXPTIME']
+    def scan_for_artifacts(self, flist, extname='dq', extnums=[1,2]):
+        """ Scan the DQ extensions of many files in parallel
 
-            # Remove subarray frames from processing list
-            try:
-                is_subarray = prhdr['subarray']
-            except KeyError:
-                pass
-            else:
-                if is_subarray:
-                    return True
-                else:
-                    return False
-
-            # Check the quality comments of the images
-            if len(prhdr['qualcom*']):
-                for key in prhdr['qualcom*']:
-                    if len(prhdr[key]) > 30:
-                        return True
-                if 'ok' in prhdr['QUALITY'].lower():
-                    return False
+        See :py:meth:`has_dq_artifact`. The scans are mostly waiting on
+        disk reads, so they run in threads.
 
-        # If second DQ ext is missing, only work with the first
-        # Otherwise combine each DQ ext to make full-frame
+        Parameters
+        ----------
+        flist : list
+            Files to scan
 
-        dq = concatenate(ext_data, axis=0)
-        artifacts = where(dq == 2)[0]
+        Returns
+        -------
+        has_artifact : list
+            One flag per file, True if it contains compression artifacts
+        """
+        start_time = time.time()
+        delayed_objects = [
+            dask.delayed(self.has_dq_artifact)(f, extname=extname,
+                                               extnums=extnums)
+            for f in flist
+        ]
+        has_artifact = list(dask.compute(*delayed_objects,
+                                         scheduler='threads',
+                                         num_workers=os.cpu_count()))
+        duration = time.time() - start_time
+        if flist:
+            LOG.info('Scanned the DQ arrays of {} files in {:.2f}s '
+                     '({:.1f} files/s)'.format(len(flist), duration,
+                                               len(flist) / max(duration,
+                                                                1e-6)))
+        return has_artifact
 
-        if artifacts.size > 0 or exptime < 0.1:
-            return True
-        else:
-            return False
+    def check_for_artifact(self, f, extname='dq', extnums=[1,2]):
+        """ Scan the DQ extension for compression artifacts
+
+        In early ACS images when the option for compressing data was available,
+        there is a possibility of Reed-Solomon decoding errors being incorrectly
+        classified as cosmic rays during the cosmic ray rejection step.
 
+        Subarray frames, images with long quality comments, and exposures
+        shorter than 0.1s are rejected based on their headers alone (see
+        :py:func:`~download.prefetch.header_rules`). The DQ arrays are only
+        scanned if the headers do not decide.
+        """
+        with fits.open(f) as hdu:
+            prhdr = hdu[0].header
+            scihdr = hdu[1].header
+        reason, scan_dq = prefetch.header_rules(prhdr, scihdr,
+                                                min_exptime=0.1)
+        if not scan_dq:
+            return reason is not None
+        return self.has_dq_artifact(f, extname=extname, extnums=extnums)
 
     def ACS(self, input, i):
         """ Run ACS cosmic ray rejection
@@ -431,57 +518,39 @@ class ProcessCCD(object):
 
         """
 
-        found_exptimes = []
-        found_formats = []
-        files_to_process = self.flist
+        manifest = self.build_manifest()
+        extnums = self.instr_cfg['instr_params']['extnums']
 
-        # Check for compression artifacts and remove them from the flist
-        for f in files_to_process:
-            has_artifact = self.check_for_artifact(
-                f,
+        # Remove the files ruled out by their headers, or by compression
+        # artifacts in their DQ arrays, from the flist
+        rejected = manifest['reason'].notna() | manifest['error'].notna()
+        scan = ~rejected & manifest['scan_dq'].astype(bool)
+        if scan.any():
+            flagged = self.scan_for_artifacts(
+                list(manifest.loc[scan, 'filename']),
                 extname='dq',
-                extnums=self.instr_cfg['instr_params']['extnums']
+                extnums=extnums
             )
-            if has_artifact:
-                self.output['failed'].append(f)
-                LOG.info('Removing {} from analysis'.format(f))
-                self.flist.remove(f)
-
-        # Make a list of all the EXPTIME and CCDAMP values
-        for f in self.flist:
-            with fits.open(f) as hdu:
-                prhdr = hdu[0].header
-                scihdr = hdu[1].header
-
-            if 'exptime' in prhdr:
-                found_exptimes.append(prhdr['exptime'])
-
-            elif 'exptime' in scihdr:
-                found_exptimes.append(scihdr['exptime'])
-
-            found_formats.append(str(prhdr['CCDAMP']))
-
-        # Find the unique values
-        unique_sizes = set(found_formats)
-        unique_exp = set(found_exptimes)
-
-        # Loop through possible combinations of CCDAMP and EXPTIME
-        for ap in unique_sizes:
-            for t in unique_exp:
-                idx = where((array(found_exptimes) == t) &
-                                 (array(found_formats) == ap))[0]
-                if not idx.any():
-                   pass
-                else:
-                    msg = ('Found {} images with '
-                           'size={} and t={} \n {}'.format(len(idx),
-                                                           ap,
-                                                           t,
-                                                           self._msg_div))
-                    LOG.info(msg)
+            rejected.loc[scan] = array(flagged, dtype=bool)
+        for f in manifest.loc[rejected, 'filename']:
+            self.output['failed'].append(f)
+            LOG.info('Removing {} from analysis'.format(f))
+        self._manifest = manifest[~rejected]
+        self.flist = list(self.manifest['filename'])
+
+        # Group the files with the same CCDAMP and EXPTIME values
+        groups = self.manifest.groupby(['ccdamp', 'exptime'], sort=False,
+                                       dropna=False)
+        for (ap, t), group in groups:
+            msg = ('Found {} images with '
+                   'size={} and t={} \n {}'.format(len(group),
+                                                   ap,
+                                                   t,
+                                                   self._msg_div))
+            LOG.info(msg)
 
-                    # Generate a list of common inputs for CR rejection.
-                    self.input['{}_{}'.format(ap, t)] = array(self.flist)[idx]
+            # Generate a list of common inputs for CR rejection.
+            self.input['{}_{}'.format(ap, t)] = array(group['filename'])
 
         # Now we check to make sure each list of files is less than the limit
         for key, val in self.input.items():
@@ -509,6 +578,27 @@ class ProcessCCD(object):
                 data.append(list(self.input[key]))
         return data
 
+    def _localize_ccdtabs(self, data):
+        """Download the CCDTABs and point each file at its local copy
+
+        The CCDTAB of each file is taken from the :py:attr:`manifest`, so
+        each unique CCDTAB is only downloaded once and only the primary
+        headers that still point at the CRDS path (e.g. `jref$...`) are
+        rewritten.
+        """
+        if self.manifest is None:
+            self.build_manifest()
+        ccdtabs = self.manifest.set_index('filename')['ccdtab']
+        files = [f for dataset in data for f in dataset]
+        for ref_file in set(str(ccdtabs[f]).split('$')[-1] for f in files):
+            self._download_reffile(ref_file)
+        for f in files:
+            if '$' in str(ccdtabs[f]):
+                # Files checked out of the download cache are hard links to it
+                detach(f)
+                fits.setval(f, 'CCDTAB', ext=0,
+                            value=str(ccdtabs[f]).split('$')[-1])
+
     def cr_reject(self):
         """ Run cosmic ray rejection in a parallelized manner.
 
@@ -526,21 +616,12 @@ class ProcessCCD(object):
         pairs = zip(data, randints)
         pipeline_dir = os.getcwd()
         os.chdir(self._data_dir)
-        # TODO: add a cleaner implementation for downloading CCDTAB
-        # TODO: pass data to download_refile(), parse all CCDTAB filenames and
-        # TODO: only download the unique files in the list.
         if 'acs' in self.instr.lower():
             # The full path to the CCDTAB is too long for a FITS header keyword
             # Instead, we change to the data directory and run the analysis there
             # Once we are finished, we change back.
             # For the ACS images we need to download the correct CCDTAB
-            for dataset in data:
-                for f in dataset:
-                    with fits.open(f, mode='update') as hdu:
-                        jref_ccdtab = hdu[0].header['CCDTAB']
-                        jref_ccdtab = jref_ccdtab.split('$')[-1]
-                        local_ccdtab = self._download_reffile(jref_ccdtab)
-                        hdu[0].header['CCDTAB'] = jref_ccdtab
+            self._localize_ccdtabs(data)
 
 
             results = [dask.delayed(self.ACS)(d, i) for d, i in pairs]
@@ -551,13 +632,7 @@ class ProcessCCD(object):
 
         elif 'wfc3' in self.instr.lower():
             # For the ACS images we need to download the correct CCDTAB
-            for dataset in data:
-                for f in dataset:
-                    with fits.open(f, mode='update') as hdu:
-                        jref_ccdtab = hdu[0].header['CCDTAB']
-                        jref_ccdtab = jref_ccdtab.split('$')[-1]
-                        local_ccdtab = self._download_reffile(jref_ccdtab)
-                        hdu[0].header['CCDTAB'] = jref_ccdtab
+            self._localize_ccdtabs(data)
 
             # WFC3 only has one CCDTAB, so we've downlodaed it locally already
             results = [dask.delayed(self.WFC3)(d, i) for d, i in pairs]
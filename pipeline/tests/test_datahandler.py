@@ -0,0 +1,271 @@
+"""Tests for the on-disk formats of :py:mod:`utils.datahandler`"""
+import os
+import sys
+import types
+
+import h5py
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils'))
+
+import datahandler as dh
+
+
+def metadata(day, integration_time=300.):
+    return {
+        'date': '2003-02-{:02d} 00:00:00.000'.format(day),
+        'integration_time': integration_time,
+        'latitude': np.array([10., 20.]),
+        'longitude': np.array([30., 40.]),
+        'altitude': np.array([500., 510.])
+    }
+
+
+def make_writer(tmp_path, num, statistic='energy_deposited', first=0,
+                on_duplicate='skip', **results_cfg):
+    """A DataWriter for `num` images writing below `tmp_path`"""
+    cfg = {
+        'X': {'hdf5_files': {
+            statistic: '/results/x_{}.hdf5'.format(statistic)
+        }},
+        'results': results_cfg
+    }
+    rng = np.random.default_rng(first)
+    file_metadata, cr_stats = [], []
+    for i in range(first, first + num):
+        file_metadata.append(types.SimpleNamespace(
+            fname='/data/o{:03d}_flt.fits'.format(i),
+            metadata=metadata(i % 28 + 1)
+        ))
+        cr_stats.append({statistic: rng.lognormal(7, 1, 50)})
+    writer = dh.DataWriter(cfg=cfg, cr_stats=cr_stats,
+                           file_metadata=file_metadata, instr='X',
+                           on_duplicate=on_duplicate)
+    writer._base = str(tmp_path)
+    os.makedirs(str(tmp_path / 'results'), exist_ok=True)
+    return writer
+
+
+def test_rollover_by_dataset_count(tmp_path):
+    writer = make_writer(tmp_path, 7, max_shard_datasets=3)
+    writer.write_statistic('energy_deposited')
+
+    manifest = dh.ShardManifest(
+        writer.results_path('energy_deposited'), 'energy_deposited').load()
+    assert [shard['num_datasets'] for shard in manifest.shards] == [3, 3, 1]
+    assert [os.path.basename(f) for f in manifest.files] == \
+        ['x_energy_deposited_{}.hdf5'.format(i) for i in [1, 2, 3]]
+    assert manifest.shards[0]['date_min'].startswith('2003-02-01')
+    assert manifest.shards[0]['date_max'].startswith('2003-02-03')
+    for shard, fname in zip(manifest.shards, manifest.files):
+        # Measured while the file is open, before HDF5 trims it
+        assert shard['nbytes'] >= os.path.getsize(fname) > 0
+
+    # A later run carries on in the last shard
+    writer = make_writer(tmp_path, 3, first=7, max_shard_datasets=3)
+    writer.write_statistic('energy_deposited')
+    manifest.load()
+    assert [shard['num_datasets'] for shard in manifest.shards] == \
+        [3, 3, 3, 1]
+    assert len(writer.existing_datasets('energy_deposited')) == 10
+
+
+def test_rollover_by_size(tmp_path):
+    writer = make_writer(tmp_path, 4, max_shard_size=1)
+    writer.write_statistic('energy_deposited')
+    manifest = writer.manifest('energy_deposited')
+    # Every shard holds at least one dataset
+    assert [shard['num_datasets'] for shard in manifest.shards] == \
+        [1, 1, 1, 1]
+
+
+def test_rollover_by_partition(tmp_path):
+    writer = make_writer(tmp_path, 4, partition='month')
+    writer.write_statistic('energy_deposited')
+    manifest = writer.manifest('energy_deposited')
+    assert [shard['partition'] for shard in manifest.shards] == ['2003-02']
+    assert os.path.basename(manifest.files[0]) == \
+        'x_energy_deposited_2003_02_1.hdf5'
+    assert manifest.select(('2003-03-01', '2003-03-31')) == []
+    assert manifest.select(('2003-02-02', '2003-02-02')) == manifest.shards
+
+
+def test_new_shard_never_truncates(tmp_path):
+    manifest = dh.ShardManifest(str(tmp_path / 'x_sizes.hdf5'), 'sizes')
+    with open(str(tmp_path / 'x_sizes_1.hdf5'), 'w') as fobj:
+        fobj.write('not a shard')
+    shard = manifest.new_shard()
+    assert shard['fname'] == 'x_sizes_2.hdf5'
+    with pytest.raises(FileExistsError):
+        manifest.new_shard(suffix=1)
+    with open(str(tmp_path / 'x_sizes_1.hdf5'), 'r') as fobj:
+        assert fobj.read() == 'not a shard'
+
+    manifest.save()
+    loaded = dh.ShardManifest(str(tmp_path / 'x_sizes.hdf5'), 'sizes').load()
+    assert loaded.shards == manifest.shards
+
+
+def random_crs(seed, num=20, offset=0):
+    """Affected pixels and sizes of `num` small cosmic rays"""
+    rng = np.random.default_rng(seed)
+    npix = rng.integers(1, 6, num)
+    pixels = np.concatenate([
+        np.column_stack([rng.integers(0, 200, 1).repeat(n) +
+                         rng.integers(0, 3, n) + offset,
+                         rng.integers(0, 200, 1).repeat(n) +
+                         rng.integers(0, 3, n)])
+        for n in npix
+    ]).astype(float)
+    return pixels, npix
+
+
+def brute_force(images, y_range, x_range):
+    """(image, cosmic ray) pairs whose bounding box overlaps the region"""
+    hits = set()
+    for name, (pixels, npix) in images.items():
+        boxes = dh.cr_bounding_boxes(pixels, npix)
+        hit = (boxes['y_max'] >= y_range[0]) & \
+            (boxes['y_min'] <= y_range[1]) & \
+            (boxes['x_max'] >= x_range[0]) & (boxes['x_min'] <= x_range[1])
+        hits.update((name, i) for i in np.nonzero(hit)[0])
+    return hits
+
+
+def found(rows):
+    return set((row['image'].decode(), int(row['cr_index'])) for row in rows)
+
+
+REGIONS = [((0, 300), (0, 300)), ((50, 60), (100, 140)), ((199, 199), None),
+           ((1000, 2000), (0, 10))]
+
+
+def check_queries(index, images):
+    for y_range, x_range in REGIONS:
+        expected = brute_force(images, y_range, x_range or (0, 10**6))
+        assert found(index.query(y_range=y_range, x_range=x_range)) == \
+            expected
+
+
+def test_spatial_index_segments(tmp_path):
+    index = dh.SpatialIndex(str(tmp_path / 'x_cr_affected_pixels.hdf5'),
+                            cell_size=16)
+    images = {}
+    for batch in range(3):
+        entries = []
+        for i in range(4):
+            name = 'o{}{}_flt.fits'.format(batch, i)
+            images[name] = random_crs(10 * batch + i)
+            entries.append((name,) + images[name])
+        index.update(entries, replaced=[])
+        check_queries(index, images)
+    with h5py.File(index.fname, 'r') as fobj:
+        assert len(fobj['segments']) == 3
+
+    # Writing an image again hides its old rows
+    images['o11_flt.fits'] = random_crs(99, offset=1000)
+    index.update([('o11_flt.fits',) + images['o11_flt.fits']],
+                 replaced=['o11_flt.fits'])
+    check_queries(index, images)
+    assert 'o11_flt.fits' in index.images_hitting(y_range=(1000, 1300))
+
+    before = index.query()
+    index.compact()
+    with h5py.File(index.fname, 'r') as fobj:
+        assert len(fobj['segments']) == 1
+        assert fobj['stale'].shape == (0,)
+        assert fobj['images'].shape == (len(images),)
+    assert np.array_equal(np.sort(index.query()), np.sort(before))
+    check_queries(index, images)
+
+
+def test_spatial_index_written_and_rebuilt(tmp_path):
+    cfg = {
+        'X': {'hdf5_files': {
+            statistic: '/results/x_{}.hdf5'.format(statistic)
+            for statistic in ['sizes', 'cr_affected_pixels']
+        }},
+        'results': {'max_shard_datasets': 4}
+    }
+    os.makedirs(str(tmp_path / 'results'))
+    images = {}
+    file_metadata, cr_stats = [], []
+    for i in range(10):
+        name = 'o{:02d}_flt.fits'.format(i)
+        images[name] = random_crs(i)
+        pixels, npix = images[name]
+        file_metadata.append(types.SimpleNamespace(fname='/data/' + name,
+                                                   metadata=metadata(i + 1)))
+        cr_stats.append({
+            'sizes': np.vstack([np.ones(npix.size), npix]),
+            'cr_affected_pixels': pixels
+        })
+    writer = dh.DataWriter(cfg=cfg, cr_stats=cr_stats,
+                           file_metadata=file_metadata, instr='X')
+    writer._base = str(tmp_path)
+    writer.write_results()
+
+    index = dh.SpatialIndex(writer.results_path('cr_affected_pixels'))
+    check_queries(index, images)
+
+    index.rebuild(writer.manifest('cr_affected_pixels'),
+                  writer.manifest('sizes'))
+    with h5py.File(index.fname, 'r') as fobj:
+        assert len(fobj['segments']) == 1
+    check_queries(index, images)
+
+
+def test_index_round_trip(tmp_path):
+    index = dh.ResultsIndex(str(tmp_path / 'x_sizes.hdf5'), 'sizes')
+    shard = str(tmp_path / ('x_sizes_{}_2003_02_1.hdf5'.format('p' * 90)))
+    rows = dh.ResultsIndex.make_rows([
+        ('o{:02d}_flt.fits'.format(i), metadata(i + 1), 10 * i, shard,
+         1000 * i)
+        for i in range(5)
+    ])
+    index.write(rows)
+
+    loaded = dh.ResultsIndex(index.fname, 'sizes').load()
+    assert np.array_equal(loaded, rows)
+    assert loaded['shard'][0].decode() == os.path.basename(shard)
+    assert loaded['latitude_end'][0] == 20.
+    assert np.isclose(loaded['mjd'][0], 52671.)
+
+    index.upsert(dh.ResultsIndex.make_rows([
+        ('o01_flt.fits', metadata(2, 600.), 7, shard, 1),
+        ('o05_flt.fits', metadata(6), 3, shard, 2)
+    ]))
+    loaded = dh.ResultsIndex(index.fname, 'sizes').load()
+    assert loaded.size == 6
+    assert loaded['integration_time'][1] == 600.
+    assert loaded['name'][-1] == b'o05_flt.fits'
+
+
+def test_index_rejects_names_that_do_not_fit(tmp_path):
+    with pytest.raises(ValueError):
+        dh.ResultsIndex.make_rows([
+            ('o00_flt.fits', metadata(1), 1,
+             str(tmp_path / ('x' * 200 + '.hdf5')), 0)
+        ])
+
+
+def test_index_migrates_narrow_fields(tmp_path):
+    index = dh.ResultsIndex(str(tmp_path / 'x_sizes.hdf5'), 'sizes')
+    old_dtype = np.dtype([
+        (name, 'S80' if name == 'shard' else dh.ResultsIndex.dtype[name])
+        for name in dh.ResultsIndex.dtype.names
+    ])
+    old = dh.ResultsIndex.make_rows([
+        ('o00_flt.fits', metadata(1), 1, 'x_sizes_1.hdf5', 0)
+    ]).astype(old_dtype)
+    with h5py.File(index.fname, 'w') as fobj:
+        fobj.create_dataset('index', data=old, maxshape=(None,), chunks=True)
+
+    shard = 'x_sizes_{}.hdf5'.format('p' * 100)
+    index.upsert(dh.ResultsIndex.make_rows([
+        ('o01_flt.fits', metadata(2), 2, shard, 0)
+    ]))
+    loaded = dh.ResultsIndex(index.fname, 'sizes').load()
+    assert loaded['shard'].tolist() == [b'x_sizes_1.hdf5', shard.encode()]
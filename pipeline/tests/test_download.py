@@ -0,0 +1,148 @@
+"""Tests for :py:meth:`download.download.Downloader.plan`"""
+import os
+import sys
+
+from astropy.table import Table
+from astropy.time import Time
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('astroquery')
+
+from download import download
+
+
+INSTR_CFG = {
+    'astroquery': {
+        'download_dir': '/data/ACS/WFC/',
+        'SubGroupDescription': ['FLT', 'SPT']
+    }
+}
+
+# Observation start times; the one on 2003-02-01 sits on a boundary and the
+# last one on the stop time of the last interval
+OBS_DATES = ['2003-01-05', '2003-01-31 23:00', '2003-02-01', '2003-02-20',
+             '2003-03-10', '2003-04-01', '2003-04-15']
+
+
+class FakeObservations(object):
+    """Answers the calls :py:meth:`~download.Downloader._query_span` makes,
+    from a fixed table of observations"""
+
+    def __init__(self):
+        self.obs = Table({
+            'obsid': np.arange(100, 100 + len(OBS_DATES)),
+            't_min': Time(OBS_DATES).mjd,
+            's_region': ['POLYGON 0 0 1 0 1 1'] * len(OBS_DATES)
+        })
+        self.spans = []
+        self.pages = []
+        self.batches = []
+
+    def select(self, t_min):
+        keep = (self.obs['t_min'] >= t_min[0]) & \
+            (self.obs['t_min'] <= t_min[1])
+        return self.obs[keep]
+
+    def query_criteria_count(self, t_min, **params):
+        self.spans.append(tuple(t_min))
+        return len(self.select(t_min))
+
+    def query_criteria(self, t_min, page, pagesize, **params):
+        self.pages.append((page, pagesize))
+        return self.select(t_min)[(page - 1) * pagesize:page * pagesize]
+
+    def get_product_list(self, obs_table):
+        self.batches.append(len(obs_table))
+        obsids = np.repeat(obs_table['obsid'], 3)
+        return Table({
+            'parent_obsid': obsids,
+            'obsID': obsids,
+            'productSubGroupDescription': ['FLT', 'SPT', 'RAW'] *
+                                          len(obs_table)
+        })
+
+    def filter_products(self, products, productSubGroupDescription,
+                        **params):
+        keep = np.isin(products['productSubGroupDescription'],
+                       productSubGroupDescription)
+        return products[keep]
+
+
+def months(*starts):
+    return [(Time(start), Time(stop))
+            for start, stop in zip(starts[:-1], starts[1:])]
+
+
+@pytest.fixture
+def observations(monkeypatch):
+    fake = FakeObservations()
+    monkeypatch.setattr(download, 'Observations', fake)
+    return fake
+
+
+def make_downloader(tmp_path, **download_cfg):
+    download_cfg.setdefault('query_cache_dir', 'query_cache')
+    downloader = download.Downloader('ACS_WFC', instr_cfg=INSTR_CFG,
+                                     download_cfg=download_cfg)
+    downloader._base = str(tmp_path)
+    return downloader
+
+
+def parents(products):
+    return sorted(set(int(obsid) for obsid in products['parent_obsid']))
+
+
+def test_plan_pages_and_splits(tmp_path, observations):
+    date_ranges = months('2003-01-01', '2003-02-01', '2003-03-01',
+                         '2003-04-01')
+    downloader = make_downloader(tmp_path, plan_page_size=2,
+                                 plan_batch_size=4)
+    downloader.plan(date_ranges)
+
+    # One span, six observations fetched two at a time
+    assert len(observations.spans) == 1
+    assert observations.pages == [(1, 2), (2, 2), (3, 2)]
+    assert observations.batches == [4, 2]
+    assert [parents(downloader.products[key]) for key in
+            ['2003-01-01', '2003-02-01', '2003-03-01']] == \
+        [[100, 101], [102, 103], [104, 105]]
+    subgroups = downloader.products['2003-02-01']['productSubGroupDescription']
+    assert set(subgroups) == {'FLT', 'SPT'}
+    assert 'obs_s_region' in downloader.products['2003-01-01'].colnames
+
+    # query() finds every interval planned, without contacting MAST
+    downloader = make_downloader(tmp_path)
+    for date_range in date_ranges:
+        downloader.query(date_range)
+    assert len(observations.spans) == 1
+    assert parents(downloader.products['2003-03-01']) == [104, 105]
+
+
+def test_plan_limits_spans_and_skips_cached(tmp_path, observations):
+    downloader = make_downloader(tmp_path, plan_span_days=60)
+    downloader.plan(months('2003-01-01', '2003-02-01', '2003-03-01',
+                           '2003-04-01'))
+    assert observations.spans == [
+        (Time('2003-01-01').mjd, Time('2003-03-01').mjd),
+        (Time('2003-03-01').mjd, Time('2003-04-01').mjd)
+    ]
+
+    downloader = make_downloader(tmp_path, plan_span_days=60)
+    downloader.plan(months('2003-01-01', '2003-02-01', '2003-03-01',
+                           '2003-04-01', '2003-05-01'))
+    assert observations.spans[2:] == [
+        (Time('2003-04-01').mjd, Time('2003-05-01').mjd)
+    ]
+    assert list(downloader.products) == ['2003-04-01']
+    assert parents(downloader.products['2003-04-01']) == [105, 106]
+
+
+def test_plan_without_observations(tmp_path, observations):
+    downloader = make_downloader(tmp_path)
+    downloader.plan(months('2004-01-01', '2004-02-01', '2004-03-01'))
+    assert observations.pages == []
+    assert [len(downloader.products[key]) for key in
+            ['2004-01-01', '2004-02-01']] == [0, 0]
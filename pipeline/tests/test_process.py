@@ -0,0 +1,80 @@
+"""Tests for :py:meth:`process.process.ProcessCCD.sort`"""
+import os
+import sys
+
+from astropy.io import fits
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('acstools')
+pytest.importorskip('stistools')
+pytest.importorskip('wfc3tools')
+
+from process import process
+
+
+INSTR_CFG = {
+    'crrejtab': 'data/crrejtab.fits',
+    'instr_params': {'extnums': [1, 2]}
+}
+
+
+def write_flt(fname, exptime, subarray=None, dq_value=0):
+    """Write a small FLT-like file with two SCI/ERR/DQ triplets"""
+    prhdr = fits.Header()
+    prhdr['EXPTIME'] = exptime
+    prhdr['CCDAMP'] = 'ABCD'
+    prhdr['CCDTAB'] = 'jref$ccdtab.fits'
+    if subarray is not None:
+        prhdr['SUBARRAY'] = subarray
+    hdus = [fits.PrimaryHDU(header=prhdr)]
+    for num in [1, 2]:
+        dq = np.zeros((8, 8), dtype=np.int16)
+        dq[4, 4] = dq_value
+        hdus.extend([
+            fits.ImageHDU(np.zeros((8, 8), dtype=np.float32),
+                          name='SCI', ver=num),
+            fits.ImageHDU(np.zeros((8, 8), dtype=np.float32),
+                          name='ERR', ver=num),
+            fits.ImageHDU(dq, name='DQ', ver=num)
+        ])
+    fits.HDUList(hdus).writeto(fname)
+    return fname
+
+
+def test_sort_decided_by_headers(tmp_path, monkeypatch):
+    """Every file has SUBARRAY set, so no DQ array is scanned"""
+    flist = [
+        write_flt(str(tmp_path / 'a_flt.fits'), 100., subarray=False),
+        write_flt(str(tmp_path / 'b_flt.fits'), 100., subarray=False),
+        write_flt(str(tmp_path / 'c_flt.fits'), 50., subarray=False),
+        write_flt(str(tmp_path / 'd_flt.fits'), 100., subarray=True),
+    ]
+
+    def fail(*args, **kwargs):
+        raise AssertionError('scan_for_artifacts should not be called')
+
+    processor = process.ProcessCCD('ACS_WFC', flist, instr_cfg=INSTR_CFG)
+    monkeypatch.setattr(processor, 'scan_for_artifacts', fail)
+    processor.sort()
+
+    assert list(processor.output['failed']) == [flist[3]]
+    assert processor.flist == flist[:3]
+    assert sorted(processor.format_inputs()) == [flist[:2], flist[2:3]]
+
+
+def test_sort_scans_undecided_files(tmp_path):
+    """Files without SUBARRAY are kept unless their DQ arrays hold an
+    artifact"""
+    flist = [
+        write_flt(str(tmp_path / 'a_flt.fits'), 100.),
+        write_flt(str(tmp_path / 'b_flt.fits'), 100., dq_value=2),
+        write_flt(str(tmp_path / 'c_flt.fits'), 100., subarray=False),
+    ]
+    processor = process.ProcessCCD('ACS_WFC', flist, instr_cfg=INSTR_CFG)
+    processor.sort()
+
+    assert list(processor.output['failed']) == [flist[1]]
+    assert processor.format_inputs() == [[flist[0], flist[2]]]
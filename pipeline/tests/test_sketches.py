@@ -0,0 +1,139 @@
+"""Tests for the mergeable sketches in :py:mod:`utils.sketches`"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils'))
+
+from sketches import KLLSketch, LogHistogram, Sketch
+
+
+# Rank error allowed for k=200, a few times the typical 1.7 / k
+RANK_ERROR = 0.025
+QUANTILES = np.linspace(0.01, 0.99, 99)
+
+
+def values(seed, size):
+    """Log-normal values, like the energy deposited by the cosmic rays"""
+    return np.random.default_rng(seed).lognormal(7, 1.5, size)
+
+
+def rank_error(data, estimates, q=QUANTILES):
+    """Largest difference between the rank of each estimate and `q`"""
+    data = np.sort(data)
+    lo = np.searchsorted(data, estimates, side='left') / data.size
+    hi = np.searchsorted(data, estimates, side='right') / data.size
+    return np.max(np.maximum(lo - q, q - hi).clip(0))
+
+
+def kll(data, seed):
+    sketch = KLLSketch(k=200, seed=seed)
+    sketch.update(data)
+    return sketch
+
+
+def test_histogram_matches_numpy():
+    data = values(0, 10000)
+    hist = LogHistogram()
+    hist.update(np.append(data, [0., -1., np.nan, 1e9]))
+    expected, _ = np.histogram(data, bins=hist.edges)
+    assert np.array_equal(hist.counts[1:-1], expected)
+    assert hist.counts[0] == 2
+    assert hist.counts[-1] == 1
+
+
+def test_histogram_merge_is_associative():
+    parts = [values(seed, 1000) for seed in range(3)]
+    hists = []
+    for data in parts:
+        hist = LogHistogram()
+        hist.update(data)
+        hists.append(hist)
+
+    left = LogHistogram()
+    for hist in hists:
+        left.merge(hist)
+    right = LogHistogram()
+    right.merge(hists[2])
+    inner = LogHistogram()
+    inner.merge(hists[1])
+    inner.merge(hists[0])
+    right.merge(inner)
+
+    everything = LogHistogram()
+    everything.update(np.concatenate(parts))
+    assert np.array_equal(left.counts, right.counts)
+    assert np.array_equal(left.counts, everything.counts)
+
+
+def test_histogram_merge_requires_same_bins():
+    with pytest.raises(ValueError):
+        LogHistogram().merge(LogHistogram(bins_per_decade=10))
+
+
+def test_kll_quantile_error():
+    data = values(1, 200000)
+    sketch = kll(data, seed=1)
+    assert sketch.n == data.size
+    # The sketch stays small no matter how many values it has seen
+    assert sketch.items()[0].size < 4 * sketch.k
+    assert rank_error(data, sketch.quantile(QUANTILES)) < RANK_ERROR
+    estimates = sketch.quantile([0.25, 0.5, 0.75])
+    exact = np.quantile(data, [0.25, 0.5, 0.75])
+    assert np.allclose(estimates, exact, rtol=0.1)
+
+
+def test_kll_merge_is_associative():
+    parts = [values(seed, 30000) for seed in range(3)]
+    data = np.concatenate(parts)
+
+    sketches = [kll(part, seed) for seed, part in enumerate(parts)]
+    left = kll([], seed=10)
+    left.merge(sketches[0])
+    left.merge(sketches[1])
+    left.merge(sketches[2])
+
+    sketches = [kll(part, seed) for seed, part in enumerate(parts)]
+    inner = kll([], seed=11)
+    inner.merge(sketches[1])
+    inner.merge(sketches[2])
+    right = kll([], seed=12)
+    right.merge(sketches[0])
+    right.merge(inner)
+
+    for sketch in [left, right]:
+        items, levels = sketch.items()
+        # Compaction keeps the total weight of the items
+        assert sketch.n == data.size
+        assert np.sum(2 ** levels.astype(np.int64)) == data.size
+        assert rank_error(data, sketch.quantile(QUANTILES)) < RANK_ERROR
+    assert rank_error(left.quantile(QUANTILES), right.quantile(QUANTILES)) \
+        < 2 * RANK_ERROR
+
+
+def test_many_small_merges():
+    """Per image sketches merged into a month, as the SketchStore does"""
+    parts = [values(seed, size) for seed, size in
+             enumerate(np.random.default_rng(0).integers(1, 2000, 300))]
+    month = kll([], seed=0)
+    for seed, part in enumerate(parts):
+        month.merge(kll(part, seed))
+    data = np.concatenate(parts)
+    assert month.n == data.size
+    assert rank_error(data, month.quantile(QUANTILES)) < RANK_ERROR
+
+
+def test_sketch_round_trip():
+    data = values(2, 50000)
+    sketch = Sketch()
+    sketch.update(data)
+    restored = Sketch.from_arrays(*sketch.to_arrays())
+    assert restored.count == data.size
+    assert np.isclose(restored.mean, data.mean())
+    assert restored.min == data.min() and restored.max == data.max()
+    assert np.array_equal(restored.quantile(QUANTILES),
+                          sketch.quantile(QUANTILES))
+    assert np.array_equal(restored.hist.counts, sketch.hist.counts)
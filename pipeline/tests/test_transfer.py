@@ -0,0 +1,184 @@
+"""Tests for :py:mod:`download.transfer` against a local HTTP stand-in"""
+import hashlib
+import http.server
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from download import transfer
+
+
+CONTENT = bytes(range(256)) * 400
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """Serves :py:data:`CONTENT` at every path, honoring Range requests
+
+    Each of the first `failures` requests is answered with the `failure`
+    of the server: a 503, or a chunked body cut off after a few bytes.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        if len(server.requests) <= server.failures:
+            if server.failure == 'truncate':
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                self.wfile.write(b'1000\r\n' + CONTENT[:16])
+                self.wfile.flush()
+                self.connection.shutdown(socket.SHUT_RDWR)
+            else:
+                self.send_error(503)
+            return
+
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.requests = []
+    httpd.failures = 0
+    httpd.failure = '503'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff instead of waiting"""
+    waits = []
+    monkeypatch.setattr(transfer.time, 'sleep', waits.append)
+    return waits
+
+
+def make_transfer(server, tmp_path, **kwargs):
+    url = 'http://127.0.0.1:{}/x_flt.fits'.format(server.server_port)
+    return transfer.Transfer(url, str(tmp_path / 'HST' / 'x_flt.fits'),
+                             **kwargs)
+
+
+def read(fname):
+    with open(fname, 'rb') as fobj:
+        return fobj.read()
+
+
+def test_download_then_skip(server, tmp_path, sleeps):
+    md5 = 'md5:{}'.format(hashlib.md5(CONTENT).hexdigest())
+    summary = transfer.download_files(
+        [make_transfer(server, tmp_path, size=len(CONTENT), checksum=md5)])
+    assert summary['downloaded'] == 1
+    assert summary['nbytes'] == len(CONTENT)
+    assert read(str(tmp_path / 'HST' / 'x_flt.fits')) == CONTENT
+
+    summary = transfer.download_files(
+        [make_transfer(server, tmp_path, size=len(CONTENT), checksum=md5)])
+    assert summary['skipped'] == 1
+    assert len(server.requests) == 1
+
+
+def test_resume_from_partial_file(server, tmp_path, sleeps):
+    t = make_transfer(server, tmp_path, size=len(CONTENT))
+    os.makedirs(os.path.dirname(t.dest))
+    with open(t.part, 'wb') as fobj:
+        fobj.write(CONTENT[:1000])
+
+    transfer.fetch_with_retries(t)
+    assert t.error is None
+    assert server.requests == ['bytes=1000-']
+    assert t.nbytes == len(CONTENT) - 1000
+    assert read(t.dest) == CONTENT
+    assert not os.path.exists(t.part)
+
+
+def test_complete_partial_file_is_not_downloaded_again(server, tmp_path,
+                                                       sleeps):
+    t = make_transfer(server, tmp_path, size=len(CONTENT))
+    os.makedirs(os.path.dirname(t.dest))
+    with open(t.part, 'wb') as fobj:
+        fobj.write(CONTENT)
+
+    transfer.fetch_with_retries(t)
+    assert t.error is None
+    assert server.requests == []
+    assert read(t.dest) == CONTENT
+
+
+def test_retry_with_backoff(server, tmp_path, sleeps):
+    server.failures = 2
+    t = transfer.fetch_with_retries(make_transfer(server, tmp_path),
+                                    max_retries=3, backoff=0.5)
+    assert t.error is None
+    assert t.attempts == 3
+    assert sleeps == [0.5, 1.]
+    assert read(t.dest) == CONTENT
+
+
+def test_incomplete_read_is_retried(server, tmp_path, sleeps):
+    server.failures = 1
+    server.failure = 'truncate'
+    t = transfer.fetch_with_retries(make_transfer(server, tmp_path),
+                                    max_retries=1)
+    assert t.error is None
+    assert t.attempts == 2
+    assert read(t.dest) == CONTENT
+
+
+def test_give_up_after_max_retries(server, tmp_path, sleeps):
+    server.failures = 10
+    summary = transfer.download_files([make_transfer(server, tmp_path)],
+                                      max_retries=2, backoff=1.)
+    assert len(summary['failed']) == 1
+    assert summary['failed'][0].attempts == 3
+    assert sleeps == [1., 2.]
+
+
+def test_checksum_mismatch(server, tmp_path, sleeps):
+    t = transfer.fetch_with_retries(
+        make_transfer(server, tmp_path, checksum='md5:{}'.format('0' * 32)),
+        max_retries=1)
+    assert isinstance(t.error, IOError)
+    assert not os.path.exists(t.dest)
+    assert not os.path.exists(t.part)
+
+
+def test_unverifiable_range_not_satisfiable(server, tmp_path, sleeps):
+    """Without a size or checksum, a partial file the server says is
+    complete is downloaded again rather than trusted"""
+    t = make_transfer(server, tmp_path)
+    os.makedirs(os.path.dirname(t.dest))
+    with open(t.part, 'wb') as fobj:
+        fobj.write(b'\0' * len(CONTENT))
+
+    transfer.fetch_with_retries(t, max_retries=1)
+    assert t.error is None
+    assert server.requests == ['bytes={}-'.format(len(CONTENT)), None]
+    assert read(t.dest) == CONTENT
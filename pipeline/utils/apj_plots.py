@@ -105,27 +105,36 @@ def get_cosmicrayml_pointings(
     return data_dict
 
 
-def read_data(stat='energy_deposited',min_exptime=50, units=None):
-    reader_wfc = dh.DataReader(instr='ACS_WFC', statistic=stat)
-    reader_hrc = dh.DataReader(instr='ACS_HRC', statistic=stat)
-    reader_wfc3 = dh.DataReader(instr='WFC3_UVIS', statistic=stat)
-    reader_wfpc2 = dh.DataReader(instr='WFPC2', statistic=stat)
-    reader_stis = dh.DataReader(instr='STIS_CCD', statistic=stat)
-
-    for r in [reader_wfpc2, reader_stis, reader_wfc, reader_hrc, reader_wfc3]:
-        r.find_hdf5()
-
-    if 'rate' in stat:
-        # flist = glob.glob(
-        #     '../../results/STIS_crrejtab_CRSIGMAS/*cr_rate*hdf5'
-        # )
-        # reader_stis.hdf5_files = flist
-        for r in [reader_wfpc2, reader_stis, reader_wfc, reader_hrc, reader_wfc3]:
-            r.read_cr_rate()
-    else:
-        for r in [reader_wfpc2,reader_stis, reader_wfc, reader_hrc, reader_wfc3]:
-            r.read_cr_stat(units=units, min_exptime=min_exptime)
-    return reader_hrc, reader_stis, reader_wfc, reader_wfpc2, reader_wfc3
+def read_data(stat='energy_deposited',min_exptime=50, units=None,
+              num_workers=None, memory_limit=None):
+    kwargs = {}
+    if 'rate' not in stat:
+        kwargs = {'units': units, 'min_exptime': min_exptime}
+    readers = dh.read_parallel(
+        ['WFPC2', 'STIS_CCD', 'ACS_WFC', 'ACS_HRC', 'WFC3_UVIS'],
+        stat,
+        num_workers=num_workers,
+        memory_limit=memory_limit,
+        **kwargs
+    )
+    # flist = glob.glob(
+    #     '../../results/STIS_crrejtab_CRSIGMAS/*cr_rate*hdf5'
+    # )
+    # readers['STIS_CCD'].hdf5_files = flist
+    return readers['ACS_HRC'], readers['STIS_CCD'], readers['ACS_WFC'], \
+           readers['WFPC2'], readers['WFC3_UVIS']
+
+def read_sketches(stat='energy_deposited', units=None, date_range=None):
+    """Read the sketches of `stat` in the same order as :py:func:`read_data`
+
+    The results can be passed to :py:func:`compute_basic_stats` and
+    `Visualizer.plot_hist` in place of the full arrays.
+    """
+    sketches = []
+    for instr in ['ACS_HRC', 'STIS_CCD', 'ACS_WFC', 'WFPC2', 'WFC3_UVIS']:
+        reader = dh.DataReader(instr=instr, statistic=stat)
+        sketches.append(reader.read_sketch(units=units, date_range=date_range))
+    return tuple(sketches)
 
 def get_solar_min_and_max(noaa_data):
     solar_cycle = {'Cycle 23': None, 'Cycle 24':None}
@@ -341,12 +350,20 @@ def plot_exptime_counts(integration_df, combined_df, N=20, logy=True, logx=True,
 
 
 def compute_basic_stats(hrc, stis, wfc, wfpc2, uvis, use_dask=False):
+    """Print the quartiles for each instrument
+
+    Each input is either an array of values or a sketch returned by
+    `DataReader.read_sketch`, in which case the quartiles are estimated
+    from the sketch.
+    """
     labels=['ACS/HRC', 'STIS/CCD', 'ACS/WFC', 'WFPC2', 'WFC3/UVIS']
     for dset, label in zip([hrc, stis, wfc, wfpc2, uvis],labels):
       #  avg = da.nanmean(dset, axis=0).compute()
        # std = da.nanstd(dset, axis=0).compute()
         #print(f'{label}: {avg}+\-{std}\n')
-        if use_dask:
+        if hasattr(dset, 'percentile'):
+            quantiles = dset.percentile([25, 50, 75])
+        elif use_dask:
             quantiles = da.percentile(dset, q=[25, 50, 75], interpolation='linear').compute()
         else:
             quantiles = np.percentile(dset, q=[25, 50, 75], interpolation='linear')
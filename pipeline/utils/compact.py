@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+This module is used to compact the results generated by the pipeline.
+
+After years of monthly appends, the shard files for each statistic hold their
+datasets in the order they were written and contain dead space left behind by
+failed or replaced writes. Compaction streams every dataset for a given
+instrument and statistic into a new set of shards where:
+
+    * Datasets are sorted by observation date.
+    * Each dataset is stored contiguously, so reading the shards in date
+      order is a sequential scan of each file.
+    * If the results are partitioned by time, each shard only holds
+      datasets from a single partition.
+    * Each shard contains a `date_index` group listing the name, date, and
+      byte offset of every dataset it holds.
+    * The :py:class:`~utils.datahandler.ResultsIndex` is rewritten to point
+      at the new shards.
+
+Only one dataset is held in memory at a time. The new shards are only made
+visible once the :py:class:`~utils.datahandler.ShardManifest` pointing to
+them has been written, which happens in a single atomic rename. The old shards
+are deleted afterwards.
+
+The pipeline should not be writing to the instrument while it is being
+compacted.
+
+"""
+import argparse
+import logging
+import os
+import time
+
+import dask
+import h5py
+import numpy as np
+import yaml
+
+import datahandler as dh
+
+
+logging.basicConfig(format='%(levelname)-4s '
+                           '[%(module)s.%(funcName)s:%(lineno)d]'
+                           ' %(message)s',
+                    )
+LOG = logging.getLogger('compact')
+LOG.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-instr',
+                    type=str,
+                    default='ACS_WFC',
+                    help='Instrument to compact the results for')
+
+parser.add_argument('-statistic',
+                    type=str,
+                    nargs='*',
+                    default=None,
+                    help='Statistics to compact. Defaults to every statistic '
+                         'listed for the instrument in the config file.')
+
+parser.add_argument('-num_workers',
+                    type=int,
+                    default=None,
+                    help='Number of statistics to compact in parallel')
+
+
+def _load_cfg():
+    """Load the pipeline configuration file"""
+    mod_dir = os.path.dirname(os.path.abspath(__file__))
+    base = os.path.join('/', *mod_dir.split('/')[:-2])
+    cfg_file = os.path.join(base, 'CONFIG', 'pipeline_config.yaml')
+    with open(cfg_file, 'r') as fobj:
+        cfg = yaml.safe_load(fobj)
+    return cfg
+
+
+# Attributes needed to build the rows of the ResultsIndex
+_INDEX_KEYS = ['date', 'integration_time', 'latitude', 'longitude', 'altitude']
+
+
+def _write_date_index(fobj, names, dates, offsets):
+    """Write the index of the datasets stored in a compacted shard"""
+    grp = fobj.create_group('date_index')
+    str_dtype = h5py.string_dtype()
+    grp.create_dataset('names', data=np.array(names, dtype=object),
+                       dtype=str_dtype)
+    grp.create_dataset('dates', data=np.array(dates, dtype=object),
+                       dtype=str_dtype)
+    grp.create_dataset('offsets', data=np.asarray(offsets, dtype=np.int64))
+
+
+def scan_dates(manifest):
+    """Find the date of every dataset listed in the `manifest`
+
+    Only the `date` attribute of each dataset is read. If a dataset appears in
+    more than one shard, the first copy found is used.
+
+    Parameters
+    ----------
+    manifest : :py:class:`~utils.datahandler.ShardManifest`
+
+    Returns
+    -------
+    entries : list
+        Sorted list of (date, dataset name, shard file) tuples
+    """
+    entries = {}
+    for fname in manifest.files:
+        if not os.path.isfile(fname):
+            LOG.warning('{} is listed in the manifest but '
+                        'does not exist'.format(fname))
+            continue
+        with h5py.File(fname, 'r') as fobj:
+            grp = fobj[manifest.statistic]
+            for name in grp.keys():
+                if name in entries:
+                    continue
+                date = grp[name].attrs.get('date', '')
+                entries[name] = (str(date), name, fname)
+    return sorted(entries.values())
+
+
+def compact_statistic(instr, statistic, cfg=None):
+    """Compact all of the shards for a single statistic
+
+    Parameters
+    ----------
+    instr : str
+        One of the valid instrument names
+
+    statistic : str
+        One of the valid statistics
+
+    cfg : dict, optional
+        Pipeline configuration object
+
+    Returns
+    -------
+    summary : dict
+        Number of datasets and bytes before and after compaction
+    """
+    if cfg is None:
+        cfg = _load_cfg()
+    start_time = time.time()
+    writer = dh.DataWriter(cfg=cfg, instr=instr)
+    old_manifest = writer.manifest(statistic)
+    old_files = [f for f in old_manifest.files if os.path.isfile(f)]
+    old_nbytes = sum(os.path.getsize(f) for f in old_files)
+
+    entries = scan_dates(old_manifest)
+    LOG.info('Compacting {} datasets for {} {}'.format(len(entries),
+                                                        instr, statistic))
+
+    new_manifest = dh.ShardManifest(writer.results_path(statistic), statistic)
+    src_files = {}
+    index_entries = []
+    try:
+        partition = writer.partition_key(entries[0][0] if entries else None)
+        shard = new_manifest.new_shard(partition=partition)
+        dst = h5py.File(new_manifest.shard_path(shard), 'a', libver='latest')
+        grp = dst[statistic]
+        names, dates, offsets = [], [], []
+        for date, name, fname in entries:
+            num_datasets = len(grp)
+            partition = writer.partition_key(date)
+            if num_datasets and (
+                    partition != shard['partition'] or
+                    num_datasets >= writer.max_shard_datasets or
+                    dst.id.get_filesize() >= writer.max_shard_size):
+                _write_date_index(dst, names, dates, offsets)
+                new_manifest.update_shard(shard, dst, dates)
+                dst.close()
+                shard = new_manifest.new_shard(partition=partition)
+                dst = h5py.File(new_manifest.shard_path(shard), 'a',
+                                libver='latest')
+                grp = dst[statistic]
+                names, dates, offsets = [], [], []
+
+            if fname not in src_files:
+                src_files[fname] = h5py.File(fname, 'r')
+            src = src_files[fname][statistic][name]
+            # Contiguous layout so each dataset is a single sequential read
+            dset = grp.create_dataset(name, data=src[()], dtype=src.dtype)
+            for key, val in src.attrs.items():
+                dset.attrs[key] = val
+            names.append(name)
+            dates.append(date)
+            offsets.append(dset.id.get_offset() or -1)
+            index_entries.append(
+                (name,
+                 {key: src.attrs[key] for key in _INDEX_KEYS
+                  if key in src.attrs},
+                 dh.ResultsIndex.cr_count(statistic, dset),
+                 new_manifest.shard_path(shard),
+                 dset.id.get_offset())
+            )
+
+        _write_date_index(dst, names, dates, offsets)
+        new_manifest.update_shard(shard, dst, dates)
+        dst.close()
+    except Exception:
+        LOG.error('Compaction of {} {} failed, removing the new '
+                  'shards'.format(instr, statistic))
+        for f in new_manifest.files:
+            if f not in old_files and os.path.isfile(f):
+                os.remove(f)
+        raise
+    finally:
+        for fobj in src_files.values():
+            fobj.close()
+
+    # Swap in the new shards. Readers only find shards through the
+    # manifest, so this single rename is the point of no return.
+    new_manifest.save()
+    index = dh.ResultsIndex(writer.results_path(statistic), statistic)
+    index.write(dh.ResultsIndex.make_rows(index_entries))
+    new_files = set(new_manifest.files)
+    for f in old_files:
+        if f not in new_files:
+            os.remove(f)
+    if statistic == 'cr_affected_pixels':
+        dh.SpatialIndex(writer.results_path(statistic)).compact()
+
+    new_nbytes = sum(shard['nbytes'] for shard in new_manifest.shards)
+    summary = {
+        'statistic': statistic,
+        'num_datasets': len(entries),
+        'old_shards': len(old_files),
+        'new_shards': len(new_manifest.shards),
+        'old_nbytes': old_nbytes,
+        'new_nbytes': new_nbytes,
+        'duration': time.time() - start_time
+    }
+    LOG.info(
+        'Compacted {statistic}: {num_datasets} datasets, '
+        '{old_shards} -> {new_shards} shards, '
+        '{old_nbytes} -> {new_nbytes} bytes '
+        'in {duration:.1f}s'.format(**summary)
+    )
+    return summary
+
+
+def compact(instr, statistics=None, num_workers=None):
+    """Compact the results for each statistic of an instrument in parallel
+
+    Parameters
+    ----------
+    instr : str
+        One of the valid instrument names
+
+    statistics : list, optional
+        Statistics to compact. Defaults to all of them.
+
+    num_workers : int, optional
+        Number of processes to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    summaries : list
+        The summary returned by :py:func:`compact_statistic` for each
+        statistic
+    """
+    cfg = _load_cfg()
+    instr = instr.upper()
+    if not statistics:
+        statistics = list(cfg[instr]['hdf5_files'].keys())
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    delayed_objects = [
+        dask.delayed(compact_statistic)(instr, stat, cfg)
+        for stat in statistics
+    ]
+    summaries = list(dask.compute(*delayed_objects,
+                                  scheduler='processes',
+                                  num_workers=num_workers))
+    return summaries
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    compact(args.instr, statistics=args.statistic,
+            num_workers=args.num_workers)
@@ -3,12 +3,19 @@
 A module to facilitate the reading and writing of data generated by the pipeline.
 """
 
-from collections import defaultdict, Iterable
+from collections import defaultdict, OrderedDict
+from collections.abc import Iterable
+import functools
 import glob
+import hashlib
+import json
 import logging
 import os
+import queue
+import threading
 
 from astropy.time import Time
+import dask
 import dask.array as da
 import h5py
 import numpy as np
@@ -16,6 +23,16 @@ import pandas as pd
 
 import yaml
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    from . import sketches
+except ImportError:
+    import sketches
+
 logging.basicConfig(format='%(levelname)-4s '
                            '[%(module)s.%(funcName)s:%(lineno)d]'
                            ' %(message)s',
@@ -26,12 +43,1404 @@ LOG = logging.getLogger('datahandler')
 LOG.setLevel(logging.INFO)
 
 
+@functools.lru_cache(maxsize=None)
+def load_config(cfg_file):
+    """Parse the configuration file, caching the result for each file"""
+    with open(cfg_file, 'r') as fobj:
+        cfg = yaml.safe_load(fobj)
+    return cfg
+
+
+class ShardManifest(object):
+    """
+    A record of the shard files holding the results for a single statistic.
+
+    The manifest is stored as a JSON file alongside the shards. For each shard
+    it keeps the number of datasets, the size of the file in bytes, and the
+    range of observation dates it covers so that readers can find the shards
+    without globbing and skip the ones they don't need.
+
+    Parameters
+    ----------
+    full_path : str
+        Full path to the results file for the statistic as listed in the
+        `hdf5_files` section of the configuration file. The shards are named
+        by appending `_N` to this path.
+
+    statistic : str
+        One of the valid statistics
+    """
+    def __init__(self, full_path, statistic):
+        self._full_path = full_path
+        self._statistic = statistic
+        self._fname = full_path.replace('.hdf5', '_manifest.json')
+        self._results_dir = os.path.dirname(full_path)
+        self._shards = []
+
+    @property
+    def fname(self):
+        """Full path to the JSON file the manifest is stored in"""
+        return self._fname
+
+    @property
+    def files(self):
+        """Full paths to each of the shard files in the order written"""
+        return [self.shard_path(shard) for shard in self.shards]
+
+    @property
+    def shards(self):
+        """A list of `dict` describing each shard"""
+        return self._shards
+
+    @shards.setter
+    def shards(self, value):
+        self._shards = value
+
+    @property
+    def statistic(self):
+        """Statistic the shards contain"""
+        return self._statistic
+
+    def exists(self):
+        """Check if the manifest has been written to disk"""
+        return os.path.isfile(self.fname)
+
+    def load(self):
+        """Read the manifest from disk"""
+        with open(self.fname, 'r') as fobj:
+            self.shards = json.load(fobj)['shards']
+        return self
+
+    def save(self):
+        """Write the manifest to disk
+
+        The manifest is written to a temporary file first and then moved into
+        place so readers never see a partially written manifest.
+        """
+        tmp = '{}.tmp'.format(self.fname)
+        with open(tmp, 'w') as fobj:
+            json.dump({'statistic': self.statistic, 'shards': self.shards},
+                      fobj, indent=2)
+        os.replace(tmp, self.fname)
+
+    def _shard_fname(self, suffix):
+        """Full path to the shard with the given suffix"""
+        return self._full_path.replace('.hdf5', '_{}.hdf5'.format(suffix))
+
+    def shard_path(self, shard):
+        """Full path to the file for the given `shard`"""
+        return os.path.join(self._results_dir, shard['fname'])
+
+    def get_shard(self, fname):
+        """Get the entry for `fname` or None if it isn't in the manifest"""
+        for shard in self.shards:
+            if shard['fname'] == os.path.basename(fname):
+                return shard
+        return None
+
+    def add_shard(self, fname, partition=None):
+        """Add an existing shard file to the manifest"""
+        shard = {
+            'fname': os.path.basename(fname),
+            'partition': partition,
+            'num_datasets': 0,
+            'nbytes': 0,
+            'date_min': None,
+            'date_max': None
+        }
+        if os.path.isfile(fname):
+            shard['nbytes'] = os.path.getsize(fname)
+        self.shards.append(shard)
+        return shard
+
+    def new_shard(self, suffix=None, partition=None):
+        """Create an empty shard file and add it to the manifest
+
+        Parameters
+        ----------
+        suffix : int or str, optional
+            Suffix for the new shard. By default it is the smallest number
+            greater than the number of shards in the partition that isn't
+            already used by a file on disk, prefixed by the partition.
+
+        partition : str, optional
+            Time partition (e.g. `2003-05` or `2003`) the shard belongs to
+
+        Returns
+        -------
+        shard : dict
+            Entry for the new shard
+
+        Raises
+        ------
+        FileExistsError
+            If a file with the same name already exists. Existing shards are
+            never truncated.
+        """
+        if suffix is None:
+            if partition is None:
+                prefix = ''
+            else:
+                prefix = '{}_'.format(partition.replace('-', '_'))
+            num = len(self.partition_shards(partition)) + 1
+            while os.path.isfile(self._shard_fname(prefix + str(num))):
+                num += 1
+            suffix = prefix + str(num)
+        fname = self._shard_fname(suffix)
+        os.makedirs(self._results_dir, exist_ok=True)
+        if os.path.exists(fname):
+            raise FileExistsError('{} already exists'.format(fname))
+        with h5py.File(fname, 'x') as fobj:
+            # Keep the datasets in the order they are written
+            fobj.create_group(self.statistic, track_order=True)
+        existing = self.get_shard(fname)
+        if existing is not None:
+            self.shards.remove(existing)
+        return self.add_shard(fname, partition=partition)
+
+    def partition_shards(self, partition=None):
+        """All of the shards belonging to `partition`"""
+        return [
+            shard for shard in self.shards
+            if shard.get('partition') == partition
+        ]
+
+    def current_shard(self, partition=None):
+        """The shard currently being written to for `partition`"""
+        shards = self.partition_shards(partition)
+        return shards[-1] if shards else None
+
+    def select(self, date_range=None):
+        """Find the shards that may contain data in `date_range`
+
+        Only the date coverage recorded in the manifest is used, so none of
+        the shards are opened.
+
+        Parameters
+        ----------
+        date_range : tuple, optional
+            (start, stop) dates. Anything `astropy.time.Time` accepts. If
+            None, every shard is returned.
+
+        Returns
+        -------
+        shards : list
+        """
+        if date_range is None:
+            return list(self.shards)
+        start, stop = [Time(val).mjd for val in date_range]
+        covered = [
+            shard for shard in self.shards if shard['date_min'] is not None
+        ]
+        if not covered:
+            return []
+        date_min = Time([shard['date_min'] for shard in covered]).mjd
+        date_max = Time([shard['date_max'] for shard in covered]).mjd
+        keep = (date_min <= stop) & (date_max >= start)
+        return [shard for shard, k in zip(covered, keep) if k]
+
+    def update_shard(self, shard, fobj, dates=()):
+        """Update the entry for `shard` after writing to it
+
+        Parameters
+        ----------
+        shard : dict
+            Entry for the shard
+
+        fobj : :py:class:`h5py.File`
+            The open shard file
+
+        dates : list
+            ISO dates of the datasets that were just written
+        """
+        shard['num_datasets'] = len(fobj[self.statistic])
+        shard['nbytes'] = int(fobj.id.get_filesize())
+        dates = [str(d) for d in dates if d is not None]
+        if dates:
+            if shard['date_min'] is not None:
+                dates.append(shard['date_min'])
+            if shard['date_max'] is not None:
+                dates.append(shard['date_max'])
+            shard['date_min'] = min(dates)
+            shard['date_max'] = max(dates)
+
+    def rebuild(self, flist):
+        """Build the manifest by scanning existing shard files
+
+        Used for results written before manifests existed. Only the `date`
+        attribute of each dataset is read.
+
+        Parameters
+        ----------
+        flist : list
+            Full paths to the shard files
+        """
+        LOG.info('Building shard manifest {}'.format(self.fname))
+        self.shards = []
+        for fname in flist:
+            self.scan_shard(fname)
+        return self
+
+    def scan_shard(self, fname, partition=None):
+        """Add an existing shard file to the manifest along with the number
+        of datasets it holds and the range of dates they cover
+
+        Parameters
+        ----------
+        fname : str
+            Full path to the shard file
+
+        partition : str, optional
+            Time partition the shard belongs to
+
+        Returns
+        -------
+        shard : dict
+            Entry for the shard
+        """
+        existing = self.get_shard(fname)
+        if existing is not None:
+            self.shards.remove(existing)
+        shard = self.add_shard(fname, partition=partition)
+        with h5py.File(fname, 'r') as fobj:
+            if self.statistic in fobj:
+                grp = fobj[self.statistic]
+                dates = [grp[name].attrs.get('date') for name in grp.keys()]
+                self.update_shard(shard, fobj, dates)
+        return shard
+
+
+class ResultsIndex(object):
+    """
+    A sidecar index with one row per image for a single statistic.
+
+    Each row holds the information needed to decide whether an image is worth
+    reading without opening the shard it lives in: the observation date and
+    MJD, the integration time, the position of HST at the start and end of
+    the observation, the number of cosmic rays, and the shard and byte offset
+    of the dataset. The index is stored as a table in a small HDF5 file
+    alongside the shards and is updated by the
+    :py:class:`DataWriter` every time it writes.
+
+    Parameters
+    ----------
+    full_path : str
+        Full path to the results file for the statistic as listed in the
+        `hdf5_files` section of the configuration file.
+
+    statistic : str
+        One of the valid statistics
+    """
+    # Shards are stored by filename. Names that don't fit are rejected by
+    # make_rows rather than truncated.
+    dtype = np.dtype([
+        ('name', 'S40'),
+        ('shard', 'S128'),
+        ('offset', 'i8'),
+        ('date', 'S26'),
+        ('mjd', 'f8'),
+        ('integration_time', 'f8'),
+        ('latitude_start', 'f8'),
+        ('latitude_end', 'f8'),
+        ('longitude_start', 'f8'),
+        ('longitude_end', 'f8'),
+        ('altitude_start', 'f8'),
+        ('altitude_end', 'f8'),
+        ('cr_count', 'i8')
+    ])
+
+    def __init__(self, full_path, statistic):
+        # Not named *.hdf5 so it is never mistaken for a shard
+        self._fname = full_path.replace('.hdf5', '_index.h5')
+        self._statistic = statistic
+        self._rows = None
+
+    @property
+    def fname(self):
+        """Full path to the file the index is stored in"""
+        return self._fname
+
+    @property
+    def statistic(self):
+        """Statistic the index describes"""
+        return self._statistic
+
+    def exists(self):
+        """Check if the index has been written to disk"""
+        return os.path.isfile(self.fname)
+
+    @staticmethod
+    def cr_count(statistic, dset):
+        """Number of cosmic rays stored in `dset` for the given `statistic`
+
+        Returns -1 for statistics that don't store one value per cosmic ray.
+        """
+        if statistic in ['energy_deposited', 'shapes']:
+            return dset.shape[0]
+        elif statistic == 'sizes':
+            return dset.shape[-1]
+        return -1
+
+    @classmethod
+    def make_rows(cls, entries):
+        """Build index rows
+
+        Parameters
+        ----------
+        entries : list
+            List of (dataset name, metadata, cosmic ray count, shard file,
+            byte offset) tuples. The metadata can be either the `dict` from
+            :py:class:`~utils.metadata.GenerateMetadata` or the attributes of
+            a stored dataset.
+
+        Returns
+        -------
+        rows : `numpy.ndarray`
+            Structured array with :py:attr:`dtype`
+
+        Raises
+        ------
+        ValueError
+            If a dataset or shard name doesn't fit in its field, since it
+            would be silently truncated
+        """
+        rows = np.zeros(len(entries), dtype=cls.dtype)
+        for i, (name, metadata, cr_count, shard, offset) in enumerate(entries):
+            for field, value in [('name', name),
+                                 ('shard', os.path.basename(shard))]:
+                if len(str(value).encode()) > cls.dtype[field].itemsize:
+                    raise ValueError(
+                        '{} is too long for the {} field of the index '
+                        '({} bytes)'.format(value, field,
+                                            cls.dtype[field].itemsize)
+                    )
+            rows[i]['name'] = name
+            rows[i]['shard'] = os.path.basename(shard)
+            rows[i]['offset'] = -1 if offset is None else offset
+            date = metadata.get('date', '')
+            if isinstance(date, Time):
+                date = date.iso
+            rows[i]['date'] = date
+            rows[i]['integration_time'] = metadata.get('integration_time',
+                                                       np.nan)
+            for key in ['latitude', 'longitude', 'altitude']:
+                val = metadata.get(key, np.nan)
+                try:
+                    start, end = val[0], val[-1]
+                except (IndexError, TypeError):
+                    start, end = val, val
+                rows[i]['{}_start'.format(key)] = start
+                rows[i]['{}_end'.format(key)] = end
+            rows[i]['cr_count'] = cr_count
+
+        # Convert all of the dates at once
+        rows['mjd'] = np.nan
+        has_date = rows['date'] != b''
+        if has_date.any():
+            dates = rows['date'][has_date].astype(str)
+            rows['mjd'][has_date] = Time(dates, format='iso').mjd
+        return rows
+
+    def load(self):
+        """Read the index from disk
+
+        Returns
+        -------
+        rows : `numpy.ndarray`
+        """
+        if self._rows is None:
+            if self.exists():
+                with h5py.File(self.fname, 'r') as fobj:
+                    # Older indexes have narrower fields
+                    self._rows = fobj['index'][:].astype(self.dtype)
+            else:
+                self._rows = np.zeros(0, dtype=self.dtype)
+        return self._rows
+
+    def write(self, rows):
+        """Replace the entire index with `rows`
+
+        The index is written to a temporary file first and moved into place.
+        """
+        tmp = '{}.tmp'.format(self.fname)
+        with h5py.File(tmp, 'w') as fobj:
+            fobj.create_dataset('index', data=rows, maxshape=(None,),
+                                chunks=True)
+        os.replace(tmp, self.fname)
+        self._rows = rows
+
+    def upsert(self, rows):
+        """Add `rows` to the index, replacing any rows for the same images
+
+        Parameters
+        ----------
+        rows : `numpy.ndarray`
+            Structured array with :py:attr:`dtype`
+        """
+        if not rows.size:
+            return
+        if not self.exists():
+            self.write(rows)
+            return
+        with h5py.File(self.fname, 'r') as fobj:
+            migrate = fobj['index'].dtype != self.dtype
+        if migrate:
+            # Rewritten with the current fields so no value is truncated
+            self._rows = None
+            self.write(self.load())
+
+        with h5py.File(self.fname, 'a') as fobj:
+            dset = fobj['index']
+            positions = {
+                name: i for i, name in enumerate(dset.fields('name')[:])
+            }
+            new_rows = []
+            for row in rows:
+                if row['name'] in positions:
+                    dset[positions[row['name']]] = row
+                else:
+                    positions[row['name']] = None
+                    new_rows.append(row)
+            if new_rows:
+                num = dset.shape[0]
+                dset.resize((num + len(new_rows),))
+                dset[num:] = np.asarray(new_rows, dtype=self.dtype)
+        self._rows = None
+
+    def rebuild(self, manifest, save=True):
+        """Build the index by scanning the attributes of every dataset
+
+        Parameters
+        ----------
+        manifest : :py:class:`ShardManifest`
+            Manifest listing the shards to scan
+
+        save : bool
+            If True, write the index to disk
+        """
+        LOG.info('Building sidecar index {}'.format(self.fname))
+        entries = []
+        for fname in manifest.files:
+            if not os.path.isfile(fname):
+                continue
+            with h5py.File(fname, 'r') as fobj:
+                grp = fobj[self.statistic]
+                for name in grp.keys():
+                    dset = grp[name]
+                    entries.append(
+                        (name, dict(dset.attrs),
+                         self.cr_count(self.statistic, dset),
+                         fname, dset.id.get_offset())
+                    )
+        rows = self.make_rows(entries)
+        if save:
+            try:
+                self.write(rows)
+            except OSError as e:
+                LOG.warning('Unable to save the index\n{}'.format(e))
+        self._rows = rows
+        return rows
+
+    @staticmethod
+    def filter(rows, date_range=None, min_exptime=None, max_exptime=None,
+               lat_range=None, lon_range=None):
+        """Select the rows matching all of the given predicates
+
+        Parameters
+        ----------
+        rows : `numpy.ndarray`
+            Index rows
+
+        date_range : tuple, optional
+            (start, stop) dates. Anything `astropy.time.Time` accepts.
+
+        min_exptime : float, optional
+            Only keep images with an integration time greater than this
+
+        max_exptime : float, optional
+            Only keep images with an integration time less than or equal
+            to this
+
+        lat_range : tuple, optional
+            (min, max) latitude in degrees
+
+        lon_range : tuple, optional
+            (min, max) longitude in degrees. If min > max the range wraps
+            around 360 degrees.
+
+        For the latitude and longitude box, an image matches if HST was inside
+        the box at either the start or the end of the observation.
+
+        Returns
+        -------
+        rows : `numpy.ndarray`
+            The matching rows
+        """
+        mask = np.ones(rows.shape, dtype=bool)
+        if date_range is not None:
+            start, stop = [Time(val).mjd for val in date_range]
+            mask &= (rows['mjd'] >= start) & (rows['mjd'] <= stop)
+        if min_exptime is not None:
+            mask &= rows['integration_time'] > min_exptime
+        if max_exptime is not None:
+            mask &= rows['integration_time'] <= max_exptime
+        if lat_range is not None or lon_range is not None:
+            in_box = np.zeros(rows.shape, dtype=bool)
+            for end in ['start', 'end']:
+                inside = np.ones(rows.shape, dtype=bool)
+                if lat_range is not None:
+                    lat = rows['latitude_{}'.format(end)]
+                    inside &= (lat >= lat_range[0]) & (lat <= lat_range[1])
+                if lon_range is not None:
+                    lon = rows['longitude_{}'.format(end)]
+                    if lon_range[0] <= lon_range[1]:
+                        inside &= (lon >= lon_range[0]) & \
+                                  (lon <= lon_range[1])
+                    else:
+                        inside &= (lon >= lon_range[0]) | \
+                                  (lon <= lon_range[1])
+                in_box |= inside
+            mask &= in_box
+        return rows[mask]
+
+    def query(self, **predicates):
+        """Select the rows in the index matching the `predicates`
+
+        See :py:meth:`filter` for the accepted predicates.
+        """
+        return self.filter(self.load(), **predicates)
+
+
+class SketchStore(object):
+    """
+    Mergeable sketches of the distribution of a per cosmic ray statistic.
+
+    For each quantity (energy deposited, size in sigmas, size in pixels, and
+    shape) a :py:class:`~sketches.Sketch` is kept for every month of
+    observations and one for all of them together. The sketches are stored
+    in a small HDF5 file alongside the shards and are updated by the
+    :py:class:`DataWriter` every time it writes.
+
+    The sketches can't remove values, so the months holding an image that is
+    written again with the `replace` duplicate policy are rebuilt from the
+    shards with :py:meth:`rebuild_months` instead of being updated.
+
+    Parameters
+    ----------
+    full_path : str
+        Full path to the results file for the statistic as listed in the
+        `hdf5_files` section of the configuration file.
+
+    statistic : str
+        One of the valid statistics
+    """
+    statistics = ('energy_deposited', 'sizes', 'shapes')
+
+    def __init__(self, full_path, statistic):
+        # Not named *.hdf5 so it is never mistaken for a shard
+        self._fname = full_path.replace('.hdf5', '_sketches.h5')
+        self._statistic = statistic
+
+    @property
+    def fname(self):
+        """Full path to the file the sketches are stored in"""
+        return self._fname
+
+    @property
+    def statistic(self):
+        """Statistic the sketches describe"""
+        return self._statistic
+
+    def exists(self):
+        """Check if any sketches have been written to disk"""
+        return os.path.isfile(self.fname)
+
+    def quantities(self, data):
+        """Split the data for a single image into the sketched quantities"""
+        if self.statistic == 'sizes':
+            data = np.asarray(data)
+            return {'sigmas': data[0], 'pixels': data[1]}
+        return {self.statistic: data}
+
+    @staticmethod
+    def _read(grp):
+        arrays = {key: grp[key][()] for key in grp.keys()}
+        return sketches.Sketch.from_arrays(arrays, grp.attrs)
+
+    @staticmethod
+    def _write(fobj, path, sketch):
+        if path in fobj:
+            del fobj[path]
+        grp = fobj.create_group(path)
+        arrays, attrs = sketch.to_arrays()
+        for key, val in arrays.items():
+            grp.create_dataset(key, data=val)
+        for key, val in attrs.items():
+            grp.attrs[key] = val
+
+    @staticmethod
+    def month(date):
+        """Month partition (e.g. `2003-05`) of an observation date"""
+        return str(date)[:7] if date else 'unknown'
+
+    def _month_sketches(self, items):
+        """Sketch the data for a batch of images by month"""
+        months = defaultdict(dict)
+        for date, data in items:
+            month = self.month(date)
+            for quantity, values in self.quantities(data).items():
+                if quantity not in months[month]:
+                    months[month][quantity] = sketches.Sketch()
+                months[month][quantity].update(values)
+        return months
+
+    def update(self, items):
+        """Add the data for a batch of images to the sketches
+
+        Parameters
+        ----------
+        items : list
+            List of (observation date, data) tuples, one per image
+        """
+        months = self._month_sketches(items)
+        if not months:
+            return
+
+        totals = {}
+        with h5py.File(self.fname, 'a') as fobj:
+            for month, month_sketches in months.items():
+                for quantity, sketch in month_sketches.items():
+                    path = '{}/{}'.format(quantity, month)
+                    if path in fobj:
+                        merged = self._read(fobj[path])
+                        merged.merge(sketch)
+                    else:
+                        merged = sketch
+                    self._write(fobj, path, merged)
+                    if quantity not in totals:
+                        totals[quantity] = sketches.Sketch()
+                    totals[quantity].merge(sketch)
+
+            for quantity, sketch in totals.items():
+                path = '{}/all'.format(quantity)
+                if path in fobj:
+                    merged = self._read(fobj[path])
+                    merged.merge(sketch)
+                    sketch = merged
+                self._write(fobj, path, sketch)
+
+    def months(self, quantity):
+        """List the months with a sketch for `quantity`"""
+        if not self.exists():
+            return []
+        with h5py.File(self.fname, 'r') as fobj:
+            if quantity not in fobj:
+                return []
+            return sorted(key for key in fobj[quantity].keys() if key != 'all')
+
+    def load(self, quantity=None, date_range=None):
+        """Load the merged sketch for `quantity`
+
+        Parameters
+        ----------
+        quantity : str, optional
+            `sigmas` or `pixels` for the sizes. Defaults to the statistic.
+
+        date_range : tuple, optional
+            (start, stop) dates. The sketches of every month overlapping the
+            range are merged. By default the sketch of all observations is
+            returned.
+
+        Returns
+        -------
+        sketch : :py:class:`~sketches.Sketch` or None
+        """
+        if quantity is None:
+            quantity = self.statistic
+        if not self.exists():
+            return None
+        with h5py.File(self.fname, 'r') as fobj:
+            if quantity not in fobj:
+                return None
+            grp = fobj[quantity]
+            if date_range is None:
+                return self._read(grp['all'])
+            start, stop = [Time(val).iso[:7] for val in date_range]
+            merged = None
+            for month in grp.keys():
+                if month in ('all', 'unknown') or not start <= month <= stop:
+                    continue
+                sketch = self._read(grp[month])
+                if merged is None:
+                    merged = sketch
+                else:
+                    merged.merge(sketch)
+            return merged
+
+    def rebuild_months(self, manifest, months):
+        """Rebuild the sketches of some months from the shards
+
+        Used after datasets have been replaced, since their old values can't
+        be removed from the sketches. Only the shards whose date coverage in
+        the manifest overlaps the months are read. The sketch of all
+        observations is then merged again from the sketches of every month.
+
+        Parameters
+        ----------
+        manifest : :py:class:`ShardManifest`
+            Manifest listing the shards
+
+        months : iterable
+            Months (e.g. `2003-05`, or `unknown`) to rebuild
+        """
+        months = set(months)
+        if not months:
+            return
+        LOG.info('Rebuilding the sketches of {} in {}'.format(
+            ', '.join(sorted(months)), self.fname))
+        items = []
+        for shard in manifest.shards:
+            fname = manifest.shard_path(shard)
+            if not os.path.isfile(fname):
+                continue
+            if shard['date_min'] is not None and 'unknown' not in months:
+                first, last = shard['date_min'][:7], shard['date_max'][:7]
+                if not any(first <= month <= last for month in months):
+                    continue
+            with h5py.File(fname, 'r') as fobj:
+                grp = fobj[self.statistic]
+                for name in grp.keys():
+                    date = grp[name].attrs.get('date', '')
+                    if self.month(date) in months:
+                        items.append((date, grp[name][()]))
+        rebuilt = self._month_sketches(items)
+
+        with h5py.File(self.fname, 'a') as fobj:
+            for quantity in list(fobj.keys()):
+                for month in months:
+                    path = '{}/{}'.format(quantity, month)
+                    if path in fobj:
+                        del fobj[path]
+            for month, month_sketches in rebuilt.items():
+                for quantity, sketch in month_sketches.items():
+                    self._write(fobj, '{}/{}'.format(quantity, month), sketch)
+
+            for quantity in list(fobj.keys()):
+                total = sketches.Sketch()
+                for month in fobj[quantity].keys():
+                    if month != 'all':
+                        total.merge(self._read(fobj[quantity][month]))
+                self._write(fobj, '{}/all'.format(quantity), total)
+
+    def rebuild(self, manifest):
+        """Rebuild the sketches from all of the shards in `manifest`"""
+        LOG.info('Building sketches {}'.format(self.fname))
+        if self.exists():
+            os.remove(self.fname)
+        for fname in manifest.files:
+            if not os.path.isfile(fname):
+                continue
+            with h5py.File(fname, 'r') as fobj:
+                grp = fobj[self.statistic]
+                self.update([
+                    (grp[name].attrs.get('date', ''), grp[name][()])
+                    for name in grp.keys()
+                ])
+
+
+def cr_bounding_boxes(pixels, npix):
+    """Compute the bounding box and centroid of each cosmic ray
+
+    The affected pixels of every cosmic ray in an image are stored one after
+    the other as (y, x) pairs, so they are split using the size of each
+    cosmic ray in pixels.
+
+    Parameters
+    ----------
+    pixels : array_like
+        (N, 2) array with the (y, x) position of each affected pixel
+
+    npix : array_like
+        Number of pixels affected by each cosmic ray
+
+    Returns
+    -------
+    boxes : dict
+        `y_min`, `y_max`, `x_min`, `x_max`, `y_centroid`, and `x_centroid`
+        arrays, or None if the pixels and sizes are inconsistent. The
+        centroid is the mean position of the affected pixels.
+    """
+    npix = np.asarray(npix).astype(np.int64)
+    pixels = np.asarray(pixels)
+    if not npix.size or (npix <= 0).any() or \
+            pixels.ndim != 2 or len(pixels) != npix.sum():
+        return None
+    starts = np.concatenate([[0], np.cumsum(npix)[:-1]])
+    boxes = {}
+    for i, axis in enumerate(['y', 'x']):
+        coords = pixels[:, i]
+        boxes['{}_min'.format(axis)] = \
+            np.minimum.reduceat(coords, starts).astype(np.int32)
+        boxes['{}_max'.format(axis)] = \
+            np.maximum.reduceat(coords, starts).astype(np.int32)
+        boxes['{}_centroid'.format(axis)] = \
+            (np.add.reduceat(coords, starts) / npix).astype(np.float32)
+    return boxes
+
+
+class SpatialIndex(object):
+    """
+    A grid index of the bounding boxes of every cosmic ray of an instrument.
+
+    The detector is divided into square cells of `cell_size` pixels. Every
+    cosmic ray is listed in each cell its bounding box overlaps, and the rows
+    are stored sorted by cell along with the offset of the first row of each
+    cell. A query only reads the rows of the cells it overlaps, and never
+    touches the per pixel data.
+
+    Each update is appended to the file as a separate segment with its own
+    rows and cell offsets, and rows of images which were written again are
+    only marked as stale. :py:meth:`compact` merges the segments back into
+    one, and is run by `compact.py`.
+
+    Positions are in the frame of the labeled image. For instruments with
+    more than one chip, the chips are stacked along y (e.g. for ACS/WFC the
+    second chip starts at y = 2048).
+
+    The index is updated by the :py:class:`DataWriter` whenever it writes the
+    `cr_affected_pixels` statistic.
+
+    Parameters
+    ----------
+    full_path : str
+        Full path to the results file for the `cr_affected_pixels`
+        statistic as listed in the `hdf5_files` section of the
+        configuration file.
+
+    cell_size : int
+        Width of each grid cell in pixels
+
+    max_size : int
+        Largest detector dimension covered by the grid. Positions beyond it
+        are placed in the last row or column of cells.
+    """
+    dtype = np.dtype([
+        ('image', 'S40'),
+        ('cr_index', 'i4'),
+        ('y_min', 'i4'),
+        ('y_max', 'i4'),
+        ('x_min', 'i4'),
+        ('x_max', 'i4')
+    ])
+    # Lists the images stored in each segment of the index
+    segment_dtype = np.dtype([
+        ('image', 'S40'),
+        ('segment', 'i4')
+    ])
+
+    def __init__(self, full_path, cell_size=64, max_size=8192):
+        # Not named *.hdf5 so it is never mistaken for a shard
+        self._fname = full_path.replace('.hdf5', '_spatial.h5')
+        self._cell_size = cell_size
+        self._ncells = -(-max_size // cell_size)
+
+    @property
+    def cell_size(self):
+        """Width of each grid cell in pixels"""
+        return self._cell_size
+
+    @property
+    def fname(self):
+        """Full path to the file the index is stored in"""
+        return self._fname
+
+    def exists(self):
+        """Check if the index has been written to disk"""
+        return os.path.isfile(self.fname)
+
+    def _cell_range(self, lo, hi):
+        lo = np.clip(np.asarray(lo) // self.cell_size, 0, self._ncells - 1)
+        hi = np.clip(np.asarray(hi) // self.cell_size, 0, self._ncells - 1)
+        return lo, hi
+
+    @classmethod
+    def make_rows(cls, name, pixels, npix):
+        """Build the rows for the cosmic rays of a single image"""
+        boxes = cr_bounding_boxes(pixels, npix)
+        if boxes is None:
+            return np.zeros(0, dtype=cls.dtype)
+        rows = np.zeros(len(boxes['y_min']), dtype=cls.dtype)
+        rows['image'] = name
+        rows['cr_index'] = np.arange(rows.size)
+        for key in ['y_min', 'y_max', 'x_min', 'x_max']:
+            rows[key] = boxes[key]
+        return rows
+
+    def _explode(self, rows):
+        """Repeat each row for every cell its bounding box overlaps"""
+        y_lo, y_hi = self._cell_range(rows['y_min'], rows['y_max'])
+        x_lo, x_hi = self._cell_range(rows['x_min'], rows['x_max'])
+        ny = y_hi - y_lo + 1
+        nx = x_hi - x_lo + 1
+        repeats = ny * nx
+        idx = np.repeat(np.arange(rows.size), repeats)
+        # Position of each repeat within its row's block of cells
+        within = np.arange(idx.size) - np.repeat(np.cumsum(repeats) - repeats,
+                                                 repeats)
+        cells = (y_lo[idx] + within // nx[idx]) * self._ncells + \
+            x_lo[idx] + within % nx[idx]
+        return rows[idx], cells
+
+    def _csr(self, rows, cells):
+        """Sort rows by cell and find the offset of the first row of each"""
+        order = np.argsort(cells, kind='stable')
+        rows, cells = rows[order], cells[order]
+        offsets = np.searchsorted(
+            cells, np.arange(self._ncells ** 2 + 1), side='left'
+        ).astype(np.int64)
+        return rows, offsets
+
+    def _init_file(self, fobj):
+        if 'segments' in fobj:
+            return
+        fobj.attrs['cell_size'] = self.cell_size
+        fobj.attrs['ncells'] = self._ncells
+        fobj.attrs['next_segment'] = 0
+        fobj.create_group('segments')
+        for key in ['images', 'stale']:
+            fobj.create_dataset(key, shape=(0,), maxshape=(None,),
+                                dtype=self.segment_dtype, chunks=(4096,))
+
+    @staticmethod
+    def _append(dset, rows):
+        if rows.size:
+            dset.resize((dset.shape[0] + rows.size,))
+            dset[-rows.size:] = rows
+
+    def _stale(self, fobj):
+        """Map each segment to the images whose rows in it were replaced"""
+        stale = defaultdict(list)
+        for image, segment in fobj['stale'][()]:
+            stale[int(segment)].append(image)
+        return stale
+
+    def update(self, entries, replaced=None):
+        """Add the cosmic rays of a batch of images to the index
+
+        The rows are appended to the file as a new segment, so the cost of an
+        update only depends on the size of the batch. Any rows already stored
+        for the images are marked as stale and dropped by :py:meth:`compact`.
+
+        Parameters
+        ----------
+        entries : list
+            List of (image name, affected pixels, size in pixels of each
+            cosmic ray) tuples
+
+        replaced : list, optional
+            Names of the images in `entries` which may already be in the
+            index. Defaults to all of them, which requires reading the list of
+            every image in the index.
+        """
+        if not entries:
+            return
+        new = [self.make_rows(*entry) for entry in entries]
+        new = np.concatenate(new)
+        names = np.array([str(entry[0]).encode() for entry in entries],
+                         dtype='S40')
+        if replaced is None:
+            replaced = names
+        else:
+            replaced = np.array([str(name).encode() for name in replaced],
+                                dtype='S40')
+        rows, offsets = self._csr(*self._explode(new))
+        with h5py.File(self.fname, 'a') as fobj:
+            self._init_file(fobj)
+            segment = int(fobj.attrs['next_segment'])
+            if replaced.size:
+                images = fobj['images'][()]
+                self._append(fobj['stale'],
+                             images[np.isin(images['image'], replaced)])
+            grp = fobj['segments'].create_group('{:06d}'.format(segment))
+            grp.create_dataset('crs', data=rows,
+                               chunks=True if rows.size else None)
+            grp.create_dataset('cell_offsets', data=offsets)
+            listed = np.zeros(names.size, dtype=self.segment_dtype)
+            listed['image'] = names
+            listed['segment'] = segment
+            self._append(fobj['images'], listed)
+            fobj.attrs['next_segment'] = segment + 1
+
+    def compact(self):
+        """Merge every segment of the index into one, dropping stale rows
+
+        The segments are merged one row of grid cells at a time, so only a
+        small part of the index is ever held in memory.
+        """
+        if not self.exists():
+            return
+        tmp = '{}.tmp'.format(self.fname)
+        ncells = self._ncells
+        with h5py.File(self.fname, 'r') as src, h5py.File(tmp, 'w') as dst:
+            stale = self._stale(src)
+            segments = [(int(key), src['segments'][key])
+                        for key in sorted(src['segments'].keys())]
+            self._init_file(dst)
+            grp = dst['segments'].create_group('{:06d}'.format(0))
+            out = grp.create_dataset('crs', shape=(0,), maxshape=(None,),
+                                     dtype=self.dtype, chunks=(4096,))
+            offsets = np.zeros(ncells ** 2 + 1, dtype=np.int64)
+            for cy in range(ncells):
+                lo, hi = cy * ncells, (cy + 1) * ncells
+                rows, cells = [], []
+                for segment, seg in segments:
+                    start, stop = seg['cell_offsets'][[lo, hi]]
+                    if stop == start:
+                        continue
+                    seg_offsets = seg['cell_offsets'][lo:hi + 1]
+                    seg_rows = seg['crs'][start:stop]
+                    seg_cells = np.repeat(np.arange(lo, hi),
+                                          np.diff(seg_offsets))
+                    keep = ~np.isin(seg_rows['image'], stale[segment])
+                    rows.append(seg_rows[keep])
+                    cells.append(seg_cells[keep])
+                counts = np.zeros(ncells, dtype=np.int64)
+                if rows:
+                    rows, cells = np.concatenate(rows), np.concatenate(cells)
+                    order = np.argsort(cells, kind='stable')
+                    self._append(out, rows[order])
+                    counts = np.bincount(cells - lo, minlength=ncells)
+                offsets[lo + 1:hi + 1] = offsets[lo] + np.cumsum(counts)
+            grp.create_dataset('cell_offsets', data=offsets)
+
+            images = src['images'][()]
+            for segment, names in stale.items():
+                images = images[~((images['segment'] == segment) &
+                                  np.isin(images['image'], names))]
+            images['segment'] = 0
+            self._append(dst['images'], images)
+            dst.attrs['next_segment'] = 1
+        os.replace(tmp, self.fname)
+
+    def rebuild(self, pixel_manifest, size_manifest):
+        """Rebuild the index from the `cr_affected_pixels` and `sizes` shards
+
+        The shards are read one at a time, so only the images of a single
+        shard are held in memory.
+        """
+        LOG.info('Building spatial index {}'.format(self.fname))
+        size_files = {}
+        for fname in size_manifest.files:
+            if not os.path.isfile(fname):
+                continue
+            with h5py.File(fname, 'r') as fobj:
+                for name in fobj[size_manifest.statistic].keys():
+                    size_files[name] = fname
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+        for fname in pixel_manifest.files:
+            if not os.path.isfile(fname):
+                continue
+            with h5py.File(fname, 'r') as fobj:
+                grp = fobj[pixel_manifest.statistic]
+                by_file = defaultdict(list)
+                for name in grp.keys():
+                    if name in size_files:
+                        by_file[size_files[name]].append(name)
+                entries = []
+                for size_fname, names in by_file.items():
+                    with h5py.File(size_fname, 'r') as size_fobj:
+                        size_grp = size_fobj[size_manifest.statistic]
+                        entries.extend(
+                            (name, grp[name][()], size_grp[name][1])
+                            for name in names
+                        )
+            self.update(entries, replaced=[])
+        self.compact()
+
+    def query(self, y_range=None, x_range=None):
+        """Find the cosmic rays whose bounding box overlaps a region
+
+        Parameters
+        ----------
+        y_range : tuple, optional
+            Inclusive (min, max) rows. Defaults to every row.
+
+        x_range : tuple, optional
+            Inclusive (min, max) columns. Defaults to every column.
+
+        Returns
+        -------
+        rows : :py:class:`numpy.ndarray`
+            One row per cosmic ray with the image, the index of the cosmic
+            ray in the image, and its bounding box
+        """
+        if not self.exists():
+            return np.zeros(0, dtype=self.dtype)
+        big = self._ncells * self.cell_size
+        y0, y1 = y_range if y_range is not None else (0, big)
+        x0, x1 = x_range if x_range is not None else (0, big)
+        cy0, cy1 = self._cell_range(y0, y1)
+        cx0, cx1 = self._cell_range(x0, x1)
+        found = []
+        with h5py.File(self.fname, 'r') as fobj:
+            stale = self._stale(fobj)
+            for key, seg in fobj['segments'].items():
+                offsets = seg['cell_offsets']
+                dset = seg['crs']
+                for cy in range(int(cy0), int(cy1) + 1):
+                    # Cells in the same row of the grid are stored together
+                    start = offsets[cy * self._ncells + int(cx0)]
+                    stop = offsets[cy * self._ncells + int(cx1) + 1]
+                    if stop > start:
+                        rows = dset[start:stop]
+                        found.append(
+                            rows[~np.isin(rows['image'], stale[int(key)])]
+                        )
+        if not found:
+            return np.zeros(0, dtype=self.dtype)
+        rows = np.concatenate(found)
+        hit = (rows['y_max'] >= y0) & (rows['y_min'] <= y1) & \
+              (rows['x_max'] >= x0) & (rows['x_min'] <= x1)
+        return np.unique(rows[hit])
+
+    def query_pixel(self, y, x):
+        """Find the cosmic rays whose bounding box contains pixel (y, x)"""
+        return self.query(y_range=(y, y), x_range=(x, x))
+
+    def images_hitting(self, y_range=None, x_range=None):
+        """List the images with a cosmic ray overlapping a region
+
+        For example, `images_hitting(x_range=(512, 512))` finds every image
+        with a cosmic ray in column 512.
+        """
+        rows = self.query(y_range=y_range, x_range=x_range)
+        return sorted(set(rows['image'].astype(str)))
+
+
+def load_frame(selected, group, value=None, attributes=True,
+               orbit_fmt='{}_{}', mjd_keys=None):
+    """Load many datasets and their attributes into a DataFrame in bulk
+
+    The values are collected as raw arrays and all of the dates are converted
+    at once with a single :py:class:`astropy.time.Time` call per date
+    attribute, rather than one per dataset.
+
+    Parameters
+    ----------
+    selected : dict
+        Maps each HDF5 file to the names of the datasets to read from it. If
+        the names are None, every dataset in `group` is read.
+
+    group : str
+        Name of the group holding the datasets in each file
+
+    value : callable, optional
+        Called with each :py:class:`h5py.Dataset`. It must return a dict of
+        additional columns for the row.
+
+    attributes : bool
+        If True, the attributes of each dataset are added as columns and the
+        DataFrame is indexed by the observation date. Otherwise, only the
+        dataset name and the columns returned by `value` are loaded.
+
+    orbit_fmt : str
+        Format used to name the columns holding the value of the latitude,
+        longitude, and altitude at the start and end of the observation. It
+        is called with the attribute name and either `start` or `end`.
+
+    mjd_keys : dict, optional
+        Maps each date attribute to the name of the column to store its MJD
+        in. Defaults to `{'date': 'mjd'}`.
+
+    Returns
+    -------
+    df : :py:class:`pandas.DataFrame`
+    """
+    if mjd_keys is None:
+        mjd_keys = {'date': 'mjd'}
+
+    records = []
+    for f, names in selected.items():
+        with h5py.File(f, mode='r') as fobj:
+            grp = fobj[group]
+            if names is None:
+                names = list(grp.keys())
+            for name in names:
+                dset = grp[name]
+                row = {'obsname': name}
+                if value is not None:
+                    row.update(value(dset))
+                if attributes:
+                    for key, val in dset.attrs.items():
+                        if key in ('altitude', 'latitude', 'longitude'):
+                            val = np.atleast_1d(val)
+                            if not val.size:
+                                val = np.array([np.nan])
+                            row[orbit_fmt.format(key, 'start')] = val[0]
+                            row[orbit_fmt.format(key, 'end')] = val[-1]
+                        else:
+                            row[key] = val
+                records.append(row)
+
+    df = pd.DataFrame.from_records(records)
+    if not attributes or df.empty:
+        return df
+
+    for key, column in mjd_keys.items():
+        if key not in df:
+            continue
+        dates = np.asarray(df[key].fillna(''), dtype=str)
+        has_date = dates != ''
+        mjd = np.full(dates.shape, np.nan)
+        if has_date.any():
+            mjd[has_date] = Time(dates[has_date], format='iso').mjd
+        df[column] = mjd
+
+    if 'date' in df:
+        df.index = pd.DatetimeIndex(
+            pd.to_datetime(np.asarray(df['date'], dtype=str), errors='coerce')
+        )
+        df.sort_index(inplace=True)
+    return df
+
+
+class FrameCache(object):
+    """
+    A persistent cache of the DataFrames built from the results shards.
+
+    One Parquet file is stored per shard and set of reader parameters. The
+    cache key is built from the shard's path, size, and modification time, so
+    only shards that changed since the last time they were read are read
+    again. The least recently used files are removed once the cache grows
+    past `max_bytes`.
+
+    Requires `pyarrow`. Without it the cache is disabled and every read goes
+    to the shards.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory to store the cached DataFrames in
+
+    max_bytes : int, optional
+        Disk budget for the cache. By default the cache isn't limited.
+    """
+    # Bump this when the layout of the cached DataFrames changes
+    version = 1
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        if pyarrow is None:
+            LOG.warning('pyarrow is not installed, the DataFrame cache '
+                        'in {} is disabled'.format(cache_dir))
+
+    @property
+    def cache_dir(self):
+        """Directory the cached DataFrames are stored in"""
+        return self._cache_dir
+
+    @property
+    def enabled(self):
+        """Whether the cache can be used"""
+        return pyarrow is not None
+
+    @property
+    def max_bytes(self):
+        """Disk budget for the cache"""
+        return self._max_bytes
+
+    def key(self, fname, **params):
+        """Build the cache key for the DataFrame read from `fname`
+
+        Parameters
+        ----------
+        fname : str
+            Shard the DataFrame is read from
+
+        params : dict
+            Parameters that change the contents of the DataFrame
+
+        Returns
+        -------
+        key : str
+        """
+        stat = os.stat(fname)
+        fingerprint = json.dumps(
+            [self.version, os.path.abspath(fname), stat.st_size,
+             stat.st_mtime_ns, params],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '{}.parquet'.format(key))
+
+    def get(self, key):
+        """Get the cached DataFrame for `key`, or None if it isn't cached"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            LOG.warning('Could not read {}: {}'.format(path, e))
+            return None
+        # Mark it as recently used
+        os.utime(path)
+        return df
+
+    def put(self, key, df):
+        """Store `df` in the cache under `key`"""
+        if not self.enabled:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp = '{}.tmp'.format(path)
+        try:
+            df.to_parquet(tmp)
+        except Exception as e:
+            LOG.warning('Could not cache DataFrame: {}'.format(e))
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until within the budget"""
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+        files = [
+            (os.stat(f).st_mtime, os.path.getsize(f), f)
+            for f in glob.glob(os.path.join(self.cache_dir, '*.parquet'))
+        ]
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, f in files:
+            if total <= self.max_bytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def clear(self):
+        """Remove every file from the cache"""
+        for f in glob.glob(os.path.join(self.cache_dir, '*.parquet')):
+            os.remove(f)
+
+
 class DataWriter(object):
     """
     A class for writing out the results computed for each dataset.
     """
+    duplicate_policies = ('skip', 'replace', 'error')
+    partition_options = (None, 'year', 'month')
+
     def __init__(self, cfg=None, chunk_num=None, cr_stats=None,
-                 file_metadata=None, instr=None):
+                 file_metadata=None, instr=None, on_duplicate='skip'):
         """
 
         Parameters
@@ -42,19 +1451,52 @@ class DataWriter(object):
         cr_stats : list
             List of `dict` containing of cosmic ray statistics to write out
 
-        chunk_num : int
-            Chunk number that the processed dataset belongs to (1 - 4)
+        chunk_num : int, optional
+            Chunk number that the processed dataset belongs to (1 - 4). If
+            None, the datasets are written to the current shard listed in the
+            :py:class:`ShardManifest` and a new shard is started whenever the
+            current one exceeds the limits set in the `results` section of
+            the configuration file.
 
         file_metadata : list
             List of file metadata objects
 
+        on_duplicate : {'skip', 'replace', 'error'}
+            What to do when a dataset has already been written to any of the
+            chunk files for a statistic. `skip` leaves the stored dataset
+            untouched, `replace` overwrites it in the chunk file where it is
+            currently stored, and `error` raises a `ValueError` before
+            anything is written.
+
         """
+        if on_duplicate not in self.duplicate_policies:
+            raise ValueError(
+                'on_duplicate must be one of {}, got {}'.format(
+                    self.duplicate_policies, on_duplicate)
+            )
 
         self._cfg = cfg
         self._cr_stats = cr_stats
         self._file_metadata = file_metadata
         self._chunk_num = chunk_num
         self._instr = instr
+        self._on_duplicate = on_duplicate
+
+        # Maps statistic -> {dataset name: chunk file containing it}
+        self._existing_dsets = {}
+        self._indexes = {}
+        self._manifests = {}
+
+        results_cfg = self.cfg.get('results', {})
+        self._max_shard_size = results_cfg.get('max_shard_size', 2e9)
+        self._max_shard_datasets = results_cfg.get('max_shard_datasets',
+                                                   25000)
+        self._partition = results_cfg.get('partition', None)
+        if self._partition not in self.partition_options:
+            raise ValueError(
+                'partition must be one of {}, got {}'.format(
+                    self.partition_options, self._partition)
+            )
 
         self._mod_dir = os.path.dirname(os.path.abspath(__file__))
         self._base = os.path.join('/', *self._mod_dir.split('/')[:-2])
@@ -117,6 +1559,388 @@ class DataWriter(object):
         """One of the valid instrument names"""
         return self._instr
 
+    @property
+    def max_shard_datasets(self):
+        """Number of datasets at which a new shard is started"""
+        return self._max_shard_datasets
+
+    @property
+    def max_shard_size(self):
+        """Size in bytes at which a new shard is started"""
+        return self._max_shard_size
+
+    @property
+    def on_duplicate(self):
+        """Policy for handling datasets that have already been written"""
+        return self._on_duplicate
+
+    @property
+    def partition(self):
+        """Time partitioning used for new shards (None, 'year' or 'month')"""
+        return self._partition
+
+    def partition_key(self, date):
+        """Get the partition an observation taken on `date` belongs to
+
+        Parameters
+        ----------
+        date : str
+            Date of the observation in ISO format
+
+        Returns
+        -------
+        partition : str or None
+            `YYYY` or `YYYY-MM` depending on :py:attr:`partition`, or None
+            if the results are not partitioned
+        """
+        if self.partition is None:
+            return None
+        if not date:
+            return 'unknown'
+        if isinstance(date, Time):
+            date = date.iso
+        if self.partition == 'year':
+            return str(date)[:4]
+        return str(date)[:7]
+
+    def results_path(self, statistic):
+        """Full path to the results file for `statistic` from the config"""
+        rel_path = self.cfg[self.instr]['hdf5_files'][statistic]
+        return os.path.join(self.base, *rel_path.split('/'))
+
+    def manifest(self, statistic):
+        """Get the :py:class:`ShardManifest` for `statistic`
+
+        If no manifest has been written yet, one is built from the chunk
+        files that already exist.
+        """
+        if statistic in self._manifests:
+            return self._manifests[statistic]
+
+        full_path = self.results_path(statistic)
+        manifest = ShardManifest(full_path, statistic)
+        if manifest.exists():
+            manifest.load()
+        else:
+            flist = glob.glob(full_path.replace('.hdf5', '_*.hdf5'))
+            flist.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
+            manifest.rebuild(flist)
+            manifest.save()
+        self._manifests[statistic] = manifest
+        return manifest
+
+    def index(self, statistic):
+        """Get the :py:class:`ResultsIndex` for `statistic`
+
+        If no index has been written yet, one is built from the datasets that
+        already exist so that it always covers every image.
+        """
+        if statistic in self._indexes:
+            return self._indexes[statistic]
+
+        index = ResultsIndex(self.results_path(statistic), statistic)
+        if not index.exists():
+            index.rebuild(self.manifest(statistic))
+        self._indexes[statistic] = index
+        return index
+
+    def _chunk_files(self, statistic):
+        """Find all of the chunk files that exist for `statistic`"""
+        return [f for f in self.manifest(statistic).files if os.path.isfile(f)]
+
+    def _shard_is_full(self, fobj, statistic):
+        """Check if the open shard has reached either of the size limits"""
+        num_datasets = len(fobj[statistic])
+        if not num_datasets:
+            # Always allow at least one dataset per shard
+            return False
+        return (num_datasets >= self.max_shard_datasets or
+                fobj.id.get_filesize() >= self.max_shard_size)
+
+    def _write_to_shards(self, statistic, datasets, fname=None):
+        """Write `datasets` to `fname` or to the current shard
+
+        Parameters
+        ----------
+        statistic : str
+            One of the valid statistics
+
+        datasets : list
+            List of (dataset name, file metadata, statistics) tuples
+
+        fname : str, optional
+            Chunk file to write to. If None, the current shard of each
+            dataset's partition is used and new shards are started as it
+            fills up.
+
+        Returns
+        -------
+        written : dict
+            Maps each dataset name to the file it was written to
+        """
+        manifest = self.manifest(statistic)
+        index = self.index(statistic)
+        written = {}
+        index_entries = []
+        sketch_items = []
+        replaced_months = set()
+        spatial_entries = []
+        spatial_replaced = []
+
+        if fname is None:
+            partitions = defaultdict(list)
+            for item in datasets:
+                key = self.partition_key(item[1].metadata.get('date'))
+                partitions[key].append(item)
+        else:
+            partitions = {None: datasets}
+
+        for partition, remaining in partitions.items():
+            remaining = list(remaining)
+            while remaining:
+                if fname is not None:
+                    shard = manifest.get_shard(fname)
+                    if shard is None:
+                        shard = manifest.add_shard(fname)
+                else:
+                    shard = manifest.current_shard(partition)
+                    if shard is None or (
+                            shard['num_datasets'] and
+                            (shard['num_datasets'] >= self.max_shard_datasets
+                             or shard['nbytes'] >= self.max_shard_size)):
+                        # Don't touch a full shard so cached reads of it
+                        # stay valid
+                        shard = manifest.new_shard(partition=partition)
+
+                path = manifest.shard_path(shard)
+                dates = []
+                with h5py.File(path, 'a', libver='latest') as f:
+                    grp = f.require_group(statistic)
+                    if 'date_index' in f:
+                        # The index written by compact.py is only valid for
+                        # shards that haven't been modified since
+                        del f['date_index']
+                    while remaining:
+                        if fname is None and \
+                                self._shard_is_full(f, statistic):
+                            break
+                        dset_name, file_info, stats = remaining.pop(0)
+                        date = file_info.metadata.get('date')
+                        replaced = dset_name in grp
+                        if replaced:
+                            # The months holding the old and the new values
+                            # are rebuilt below
+                            replaced_months.add(SketchStore.month(
+                                grp[dset_name].attrs.get('date')))
+                            replaced_months.add(SketchStore.month(date))
+                            del grp[dset_name]
+                        dset = self._write_dataset(
+                            grp, dset_name,
+                            data=stats[statistic],
+                            metadata=file_info.metadata
+                        )
+                        dates.append(date)
+                        if statistic == 'cr_affected_pixels' and \
+                                'sizes' in stats:
+                            spatial_entries.append(
+                                (dset_name, stats[statistic],
+                                 np.asarray(stats['sizes'])[1])
+                            )
+                            if replaced:
+                                spatial_replaced.append(dset_name)
+                        if not replaced:
+                            sketch_items.append((date, stats[statistic]))
+                        written[dset_name] = path
+                        if 'energy_deposited' in stats:
+                            cr_count = len(stats['energy_deposited'])
+                        else:
+                            cr_count = ResultsIndex.cr_count(statistic, dset)
+                        index_entries.append(
+                            (dset_name, file_info.metadata, cr_count, path,
+                             dset.id.get_offset())
+                        )
+                    manifest.update_shard(shard, f, dates)
+
+                if remaining:
+                    shard = manifest.new_shard(partition=partition)
+                    LOG.info('Starting new shard {}'.format(shard['fname']))
+        manifest.save()
+        index.upsert(ResultsIndex.make_rows(index_entries))
+        if statistic in SketchStore.statistics:
+            store = SketchStore(self.results_path(statistic), statistic)
+            store.update([
+                item for item in sketch_items
+                if SketchStore.month(item[0]) not in replaced_months
+            ])
+            store.rebuild_months(manifest, replaced_months)
+        if spatial_entries:
+            SpatialIndex(self.results_path(statistic)).update(
+                spatial_entries, replaced=spatial_replaced)
+        return written
+
+    def existing_datasets(self, statistic):
+        """Get the names of every dataset already written for `statistic`
+
+        The chunk files are only scanned the first time this is called for a
+        given statistic, after which the in-memory copy is kept up to date as
+        datasets are written.
+
+        Parameters
+        ----------
+        statistic : str
+            One of the valid statistics
+
+        Returns
+        -------
+        existing : dict
+            Maps each dataset name to the chunk file that contains it
+        """
+        if statistic in self._existing_dsets:
+            return self._existing_dsets[statistic]
+
+        existing = {}
+        for fname in self._chunk_files(statistic):
+            with h5py.File(fname, 'r') as fobj:
+                if statistic not in fobj:
+                    continue
+                for dset_name in fobj[statistic].keys():
+                    if dset_name in existing:
+                        LOG.warning(
+                            '{} is stored in both {} and {}, run '
+                            'remove_duplicates() to repair'.format(
+                                dset_name, existing[dset_name], fname)
+                        )
+                        continue
+                    existing[dset_name] = fname
+        self._existing_dsets[statistic] = existing
+        return existing
+
+    def remove_duplicates(self, statistic):
+        """Delete datasets that are stored in more than one chunk file
+
+        The copy in the lowest numbered chunk file is kept.
+
+        Parameters
+        ----------
+        statistic : str
+            One of the valid statistics
+
+        Returns
+        -------
+        num_removed : int
+            Number of duplicate datasets deleted
+        """
+        manifest = self.manifest(statistic)
+        seen = set()
+        num_removed = 0
+        for fname in self._chunk_files(statistic):
+            with h5py.File(fname, 'a', libver='latest') as fobj:
+                if statistic not in fobj:
+                    continue
+                grp = fobj[statistic]
+                for dset_name in list(grp.keys()):
+                    if dset_name in seen:
+                        del grp[dset_name]
+                        num_removed += 1
+                    else:
+                        seen.add(dset_name)
+                manifest.update_shard(manifest.get_shard(fname), fobj)
+        manifest.save()
+        if num_removed:
+            # Make sure the index points at the copies that were kept
+            self.index(statistic).rebuild(manifest)
+        LOG.info('Removed {} duplicate datasets from {}'.format(num_removed,
+                                                               statistic))
+        # Force the existing datasets to be reloaded on the next write
+        self._existing_dsets.pop(statistic, None)
+        return num_removed
+
+    def _write_dataset(self, grp, dset_name, data, metadata):
+        """Write a single dataset and its metadata to `grp`"""
+        dset = grp.create_dataset(name=dset_name,
+                                  data=data,
+                                  dtype=np.float32)
+        return self._write_attrs(dset, metadata)
+
+    def _write_attrs(self, dset, metadata):
+        """Store `metadata` as the attributes of `dset`"""
+        for (key, val) in metadata.items():
+            # Check the datatype and save it accordingly
+            if isinstance(val, np.ndarray):
+                dset.attrs.create(name=key,
+                                  data=val,
+                                  shape=val.shape,
+                                  dtype=np.float32)
+
+            elif isinstance(val, Time):
+                dset.attrs[key] = val.iso
+            else:
+                dset.attrs[key] = val
+        return dset
+
+    def refresh_statistic(self, statistic):
+        """Replace the metadata of datasets that have already been written
+
+        Only the attributes of each dataset are rewritten, the statistics
+        themselves are left untouched. Datasets that have not been written
+        yet are skipped. The :py:class:`ResultsIndex` and the date range of
+        each shard in the :py:class:`ShardManifest` are updated to match.
+
+        Parameters
+        ----------
+        statistic : str
+            One of the valid statistics
+
+        Returns
+        -------
+        num_updated : int
+            Number of datasets whose metadata was replaced
+        """
+        existing = self.existing_datasets(statistic)
+        by_shard = defaultdict(list)
+        for file_info in self.file_metadata:
+            dset_name = os.path.basename(file_info.fname)
+            if dset_name in existing:
+                by_shard[existing[dset_name]].append((dset_name, file_info))
+        num_missing = len(self.file_metadata) - \
+            sum(len(items) for items in by_shard.values())
+        if num_missing:
+            LOG.info('{} datasets have not been written for {}, '
+                     'skipping them'.format(num_missing, statistic))
+
+        manifest = self.manifest(statistic)
+        index_entries = []
+        for fname, items in by_shard.items():
+            with h5py.File(fname, 'a', libver='latest') as fobj:
+                grp = fobj[statistic]
+                dates = []
+                for dset_name, file_info in items:
+                    dset = grp[dset_name]
+                    for key in list(dset.attrs.keys()):
+                        if key in file_info.metadata:
+                            del dset.attrs[key]
+                    self._write_attrs(dset, file_info.metadata)
+                    dates.append(dset.attrs.get('date'))
+                    index_entries.append(
+                        (dset_name, file_info.metadata,
+                         ResultsIndex.cr_count(statistic, dset),
+                         fname, dset.id.get_offset())
+                    )
+                shard = manifest.get_shard(fname)
+                if shard is not None:
+                    manifest.update_shard(shard, fobj, dates)
+        manifest.save()
+        self.index(statistic).upsert(ResultsIndex.make_rows(index_entries))
+        LOG.info('Refreshed the metadata of {} datasets for {}'.format(
+            len(index_entries), statistic))
+        return len(index_entries)
+
+    def refresh_metadata(self):
+        """Replace the metadata of every statistic without rewriting the
+        statistics, see :py:meth:`refresh_statistic`"""
+        for statistic in self.cfg[self.instr]['hdf5_files'].keys():
+            self.refresh_statistic(statistic)
+
     def write_statistic(self, statistic):
         """Convenience method for writing out the statistics
 
@@ -136,34 +1960,51 @@ class DataWriter(object):
                                                  self._msg_div))
         LOG.info(msg)
 
-        rel_path = self.cfg[self.instr]['hdf5_files'][statistic]
-        full_path = os.path.join(self.base, *rel_path.split('/'))
-
-        fout = full_path.replace('.hdf5', '_{}.hdf5'.format(self.chunk_num))
-
-        with h5py.File(fout, 'a', libver='latest') as f:
-            grp = f[statistic]
-            for file_info, stats in zip(self.file_metadata, self.cr_stats):
-                dset_name = os.path.basename(file_info.fname)
-                try:
-                    dset = grp.create_dataset(name=dset_name,
-                                              data=stats[statistic],
-                                              dtype=np.float32)
-                except Exception as e:
-                    LOG.info(e)
-                else:
-                    for (key, val) in file_info.metadata.items():
-                        # Check the datatype and save it accordingly
-                        if isinstance(val, np.ndarray):
-                            dset.attrs.create(name=key,
-                                              data=val,
-                                              shape=val.shape,
-                                              dtype=np.float32)
-
-                        elif isinstance(val, Time):
-                            dset.attrs[key] = val.iso
-                        else:
-                            dset.attrs[key] = val
+        if self.chunk_num is not None:
+            fout = self.results_path(statistic).replace(
+                '.hdf5', '_{}.hdf5'.format(self.chunk_num)
+            )
+        else:
+            fout = None
+
+        existing = self.existing_datasets(statistic)
+
+        # Decide where every dataset goes before touching any of the files so
+        # that a duplicate under the `error` policy leaves everything as is.
+        # New datasets are keyed by `fout`, which is None when the shard is
+        # chosen by the manifest.
+        to_write = defaultdict(list)
+        planned = {}
+        num_skipped = 0
+        for file_info, stats in zip(self.file_metadata, self.cr_stats):
+            dset_name = os.path.basename(file_info.fname)
+            if dset_name in existing or dset_name in planned:
+                if self.on_duplicate == 'error':
+                    raise ValueError('{} already exists in {}'.format(
+                        dset_name, existing.get(dset_name, 'this batch'))
+                    )
+                elif self.on_duplicate == 'skip':
+                    num_skipped += 1
+                    continue
+            if dset_name in planned:
+                # Only the last copy within a single batch is kept
+                target = planned[dset_name]
+                to_write[target] = [
+                    item for item in to_write[target] if item[0] != dset_name
+                ]
+            # When replacing, the dataset is rewritten in the file that
+            # already holds it so it only ever lives in a single chunk file
+            target = existing.get(dset_name, fout)
+            to_write[target].append((dset_name, file_info, stats))
+            planned[dset_name] = target
+
+        if num_skipped:
+            LOG.info('Skipped {} datasets that were already '
+                     'written for {}'.format(num_skipped, statistic))
+
+        for fname, datasets in to_write.items():
+            written = self._write_to_shards(statistic, datasets, fname=fname)
+            existing.update(written)
 
     def write_results(self):
         """Write out all the results for the analyzed dataset
@@ -177,9 +2018,18 @@ class DataWriter(object):
 
 #TODO: finish data reader. Need to figure out an efficient way to do this
 class DataReader(object):
-    """ A class for reading the results stored in the generated HDF5 files. """
+    """ A class for reading the results stored in the generated HDF5 files.
+
+    Files are opened read-only and kept in a small pool of open handles, so
+    repeated lookups in the same shards don't reopen them. Use the reader as
+    a context manager, or call :py:meth:`close`, to release the handles.
 
-    def __init__(self, instr, statistic, cfg=None):
+    >>> with DataReader(instr='stis_ccd', statistic='sizes') as reader:
+    ...     data = reader.read_many(['o3st01abq_flt.fits'])
+    """
+
+    def __init__(self, instr, statistic, cfg=None, max_open_files=8,
+                 use_cache=True):
         """
 
         Parameters
@@ -194,6 +2044,14 @@ class DataReader(object):
             The results configuration object obtained by parsing the
             pipeline_config.yaml file
 
+        max_open_files : int
+            Maximum number of files kept open in the handle pool
+
+        use_cache : bool
+            If True, the DataFrames built by :py:meth:`read_cr_rate` are
+            cached on disk in the `cache_dir` listed in the `results`
+            section of the configuration file.
+
         """
 
         self._instr = instr.upper()
@@ -213,11 +2071,16 @@ class DataReader(object):
         self._pixels_affected = None
         self._metadata = None
         self._dataset_keys = None
+        self._max_open_files = max_open_files
+        self._handles = OrderedDict()
+        self._pinned = set()
+        self._use_cache = use_cache
+        self._frame_cache = None
 
         if cfg is None:
             # Load the CONFIG file
-            with open(self._cfg_file, 'r') as fobj:
-                self._cfg = yaml.load(fobj)
+            cfg = load_config(self._cfg_file)
+        self._cfg = cfg
 
         self._instr_cfg = self.cfg[self._instr]
 
@@ -283,17 +2146,114 @@ class DataReader(object):
         """Statistic to be read in"""
         return self._statistic
 
-    def find_hdf5(self):
+    def results_path(self):
+        """Full path to the results file for :py:attr:`statistic`"""
+        rel_path = self.instr_cfg['hdf5_files'][self.statistic]
+        return os.path.join(self.base, *rel_path.split('/'))
+
+    @property
+    def frame_cache(self):
+        """The :py:class:`FrameCache` used by :py:meth:`read_cr_rate`
+
+        None if caching is turned off or no `cache_dir` is configured.
+        """
+        if self._frame_cache is None and self._use_cache:
+            results_cfg = self.cfg.get('results', {})
+            cache_dir = results_cfg.get('cache_dir')
+            if cache_dir:
+                self._frame_cache = FrameCache(
+                    os.path.join(self.base, *cache_dir.split('/')),
+                    max_bytes=results_cfg.get('cache_max_bytes')
+                )
+        return self._frame_cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self, fname, pin=False):
+        """Get a read-only handle for `fname` from the pool
+
+        The least recently used handle is closed once there are more than
+        `max_open_files` open. Pinned handles back lazily evaluated arrays
+        and stay open until :py:meth:`close` is called.
+
+        Parameters
+        ----------
+        fname : str
+            HDF5 file to open
+
+        pin : bool
+            If True, the handle is never closed by the pool
+
+        Returns
+        -------
+        fobj : :py:class:`h5py.File`
+        """
+        if fname in self._handles:
+            self._handles.move_to_end(fname)
+        else:
+            self._handles[fname] = h5py.File(fname, mode='r')
+        if pin and fname not in self._pinned:
+            self._pinned.add(fname)
+            if len(self._pinned) > self._max_open_files:
+                LOG.warning(
+                    '{} files are pinned open by lazily evaluated arrays, '
+                    'more than max_open_files={}. Call close() once the '
+                    'arrays have been computed.'.format(
+                        len(self._pinned), self._max_open_files)
+                )
+
+        # Never evict the handle that is being returned
+        unpinned = [
+            f for f in self._handles if f not in self._pinned and f != fname
+        ]
+        while len(self._handles) > self._max_open_files and unpinned:
+            self._handles.pop(unpinned.pop(0)).close()
+        return self._handles[fname]
+
+    def close(self):
+        """Close all of the open file handles"""
+        while self._handles:
+            _, fobj = self._handles.popitem()
+            fobj.close()
+        self._pinned.clear()
+
+    def find_hdf5(self, date_range=None):
         """ Find the HDF5 files for the given py:attr:`statistic`
 
+        The files are taken from the :py:class:`ShardManifest` for the
+        statistic. Results written before manifests existed are found by
+        globbing for the chunk files instead.
+
+        Parameters
+        ----------
+        date_range : tuple, optional
+            (start, stop) dates. If given, shards whose date coverage in the
+            manifest doesn't overlap the range are skipped without being
+            opened.
+
         Returns
         -------
 
         """
-        rel_path = self.instr_cfg['hdf5_files'][self.statistic]
-        full_path = os.path.join(self.base, *rel_path.split('/'))
-        hdf5_files = glob.glob(full_path.replace('.hdf5', '*'))
-        hdf5_files.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
+        full_path = self.results_path()
+        manifest = ShardManifest(full_path, self.statistic)
+        if manifest.exists():
+            manifest.load()
+            hdf5_files = [
+                manifest.shard_path(shard)
+                for shard in manifest.select(date_range)
+            ]
+        else:
+            LOG.warning('No shard manifest found, '
+                        'searching for chunk files instead')
+            hdf5_files = glob.glob(full_path.replace('.hdf5', '_*.hdf5'))
+            hdf5_files.sort(
+                key=lambda f: int(''.join(filter(str.isdigit, f)))
+            )
         msg = (
             'Found the following data files\n {} \n{}'.format(
                 '\n'.join(hdf5_files), self._msg_div)
@@ -301,21 +2261,338 @@ class DataReader(object):
         LOG.info(msg)
         self.hdf5_files = hdf5_files
 
+    def _select_files(self, date_range=None):
+        """Get the files in :py:attr:`hdf5_files` that may hold data in
+        `date_range`
+
+        :py:attr:`hdf5_files` is found first if it hasn't been yet. Shards
+        whose date coverage in the manifest doesn't overlap `date_range` are
+        skipped, even if :py:meth:`find_hdf5` was called without one. Files
+        that aren't listed in the manifest are always kept.
+        """
+        if self.hdf5_files is None:
+            self.find_hdf5(date_range=date_range)
+        if date_range is None:
+            return self.hdf5_files
+        manifest = ShardManifest(self.results_path(), self.statistic)
+        if not manifest.exists():
+            return self.hdf5_files
+        manifest.load()
+        keep = set(
+            manifest.shard_path(shard) for shard in manifest.select(date_range)
+        )
+        managed = set(manifest.files)
+        return [
+            f for f in self.hdf5_files if f in keep or f not in managed
+        ]
+
+    def _index_rows(self, hdf5_files=None):
+        """Get the rows of the :py:class:`ResultsIndex` for the files to read
+
+        Returns None if the index can't be used, i.e. when the files to read
+        (:py:attr:`hdf5_files` by default) contain files that aren't listed
+        in the shard manifest.
+        """
+        if hdf5_files is None:
+            hdf5_files = self.hdf5_files
+        full_path = self.results_path()
+        manifest = ShardManifest(full_path, self.statistic)
+        if not manifest.exists():
+            return None
+        if not set(hdf5_files).issubset(manifest.load().files):
+            return None
+
+        index = ResultsIndex(full_path, self.statistic)
+        if index.exists():
+            rows = index.load()
+        else:
+            rows = index.rebuild(manifest)
+
+        # Only keep the requested shards and sort the rows so each shard is
+        # read front to back
+        shard_order = {
+            os.path.basename(f).encode(): i
+            for i, f in enumerate(hdf5_files)
+        }
+        rows = rows[np.isin(rows['shard'], list(shard_order.keys()))]
+        order = np.lexsort(
+            (rows['offset'], [shard_order[shard] for shard in rows['shard']])
+        )
+        return rows[order]
+
+    def select_datasets(self, instr=None, **predicates):
+        """Find the datasets matching the given predicates
+
+        The predicates are resolved against the :py:class:`ResultsIndex` so
+        the shards themselves are never opened. If the index can't be used
+        for the files in :py:attr:`hdf5_files`, the attributes of each dataset
+        are read instead.
+
+        Parameters
+        ----------
+        instr : str or list, optional
+            Only return datasets if :py:attr:`instr` is one of these
+            instruments
+
+        predicates : dict
+            Any of the keyword arguments accepted by
+            :py:meth:`ResultsIndex.filter`
+
+        Returns
+        -------
+        selected : dict
+            Maps each file to the list of dataset names to read from it
+        """
+        if instr is not None:
+            if isinstance(instr, str):
+                instr = [instr]
+            if self.instr not in [val.upper() for val in instr]:
+                return {}
+
+        # Skip the shards the manifest says are outside the date range
+        hdf5_files = self._select_files(predicates.get('date_range'))
+
+        selected = defaultdict(list)
+        rows = self._index_rows(hdf5_files)
+        if rows is not None:
+            rows = ResultsIndex.filter(rows, **predicates)
+            shards = {os.path.basename(f): f for f in hdf5_files}
+            for row in rows:
+                selected[shards[row['shard'].decode()]].append(
+                    row['name'].decode()
+                )
+            return selected
+
+        LOG.info('No index available, scanning the dataset attributes')
+        for f in hdf5_files:
+            with h5py.File(f, mode='r') as fobj:
+                grp = fobj[self.statistic]
+                entries = [
+                    (name, dict(grp[name].attrs), -1, f, None)
+                    for name in grp.keys()
+                ]
+            rows = ResultsIndex.filter(ResultsIndex.make_rows(entries),
+                                       **predicates)
+            selected[f] = [name.decode() for name in rows['name']]
+        return selected
+
+    def _date_order(self, **predicates):
+        """List the (file, dataset name) of the selected images by date"""
+        selected = self.select_datasets(**predicates)
+        rows = self._index_rows()
+        if rows is not None:
+            mjd = dict(zip(rows['name'], rows['mjd']))
+            entries = [
+                (mjd.get(name.encode(), np.nan), f, name)
+                for f, names in selected.items() for name in names
+            ]
+        else:
+            entries = []
+            for f, names in selected.items():
+                grp = self._open(f)[self.statistic]
+                dates = [str(grp[name].attrs.get('date', '')) for name in names]
+                entries.extend(zip(dates, [f] * len(names), names))
+        entries.sort(key=lambda entry: entry[0])
+        return [(f, name) for _, f, name in entries]
+
+    def iter_images(self, prefetch=16, **predicates):
+        """Lazily iterate over the selected images in date order
+
+        The images are read one at a time by a background thread that stays
+        at most `prefetch` images ahead, so memory use doesn't grow with the
+        number of images.
+
+        >>> reader = DataReader(instr='acs_wfc', statistic='sizes')
+        >>> for metadata, data in reader.iter_images(min_exptime=200):
+        ...     print(metadata['name'], data.shape)
+
+        Parameters
+        ----------
+        prefetch : int
+            Maximum number of images read ahead of the consumer
+
+        predicates : dict
+            Predicates used to select the images to read (e.g. `date_range`,
+            `min_exptime`, `lat_range`, `lon_range`, `instr`). See
+            :py:meth:`select_datasets`.
+
+        Yields
+        ------
+        metadata : dict
+            The attributes of the dataset plus its `name`
+
+        data : :py:class:`numpy.ndarray`
+            The data for :py:attr:`statistic`
+        """
+        order = self._date_order(**predicates)
+        items = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            # The producer keeps its own handles so the pool is only ever
+            # used from the consumer's thread
+            handles = OrderedDict()
+            try:
+                for f, name in order:
+                    if f in handles:
+                        handles.move_to_end(f)
+                    else:
+                        handles[f] = h5py.File(f, mode='r')
+                        if len(handles) > self._max_open_files:
+                            handles.popitem(last=False)[1].close()
+                    dset = handles[f][self.statistic][name]
+                    metadata = dict(dset.attrs)
+                    metadata['name'] = name
+                    if not put((metadata, dset[()])):
+                        return
+            except Exception as e:
+                put(e)
+            finally:
+                for fobj in handles.values():
+                    fobj.close()
+                put(done)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def find_crs(self, y_range=None, x_range=None):
+        """Find the cosmic rays whose bounding box overlaps a detector region
+
+        Uses the :py:class:`SpatialIndex` of the instrument, so none of the
+        per pixel data is read.
+
+        Parameters
+        ----------
+        y_range, x_range : tuple, optional
+            Inclusive (min, max) rows and columns of the region. Pass the
+            same value twice to select a single row, column or pixel.
+
+        Returns
+        -------
+        df : :py:class:`pandas.DataFrame`
+            One row per cosmic ray with the image, the index of the cosmic
+            ray within the image, and its bounding box
+        """
+        rel_path = self.instr_cfg['hdf5_files']['cr_affected_pixels']
+        index = SpatialIndex(os.path.join(self.base, *rel_path.split('/')))
+        if not index.exists():
+            LOG.info('No spatial index found in {}'.format(index.fname))
+        df = pd.DataFrame(index.query(y_range=y_range, x_range=x_range))
+        if not df.empty:
+            df['image'] = df['image'].str.decode('utf-8')
+        return df
+
+    def read_sketch(self, units=None, date_range=None):
+        """Load the merged sketch of the distribution of :py:attr:`statistic`
+
+        The sketches are computed when the results are written, so this
+        doesn't read any of the shards. See :py:class:`SketchStore`.
+
+        Parameters
+        ----------
+        units : {'pixels', 'sigmas'}
+            Specifies the units for the sizes statistics.
+
+        date_range : tuple, optional
+            (start, stop) dates. Only the months overlapping the range are
+            included.
+
+        Returns
+        -------
+        sketch : :py:class:`~sketches.Sketch` or None
+        """
+        store = SketchStore(self.results_path(), self.statistic)
+        quantity = units if self.statistic == 'sizes' else self.statistic
+        sketch = store.load(quantity, date_range=date_range)
+        if sketch is None:
+            LOG.info('No sketches found in {}'.format(store.fname))
+        return sketch
+
     def read_single_dst(self, fname, dset):
-        fobj = h5py.File(fname, mode='r')
-        grp = fobj[self.statistic]
-        dsets = list(grp.keys())
-        if dset in dsets:
+        grp = self._open(fname)[self.statistic]
+        if dset in grp:
             data = grp[dset]
             affected_pixels = data[:]
-            metadata = data.attrs
+            metadata = dict(data.attrs)
         else:
             LOG.info(f'Nothing found for {dset}')
             return None, None
 
         return affected_pixels, metadata
 
-    def read_cr_stat(self, fill_value=-999, units=None, min_exptime=200):
+    def read_many(self, dset_names):
+        """Read a batch of datasets by name
+
+        The datasets are located using the :py:class:`ResultsIndex` when
+        possible, otherwise each file in :py:attr:`hdf5_files` is checked.
+        They are then read file by file in the order they are stored on disk,
+        reusing the open handles in the pool.
+
+        Parameters
+        ----------
+        dset_names : list
+            Names of the datasets to read
+
+        Returns
+        -------
+        results : dict
+            Maps the name of each dataset found to a (data, metadata) tuple
+        """
+        if self.hdf5_files is None:
+            self.find_hdf5()
+
+        wanted = set(dset_names)
+        locations = []
+        rows = self._index_rows()
+        if rows is not None:
+            shards = {os.path.basename(f): f for f in self.hdf5_files}
+            for row in rows[np.isin(rows['name'],
+                                    [name.encode() for name in wanted])]:
+                locations.append(
+                    (shards[row['shard'].decode()], row['name'].decode())
+                )
+        else:
+            for f in self.hdf5_files:
+                grp = self._open(f)[self.statistic]
+                found = [name for name in wanted if name in grp]
+                found.sort(key=lambda name: grp[name].id.get_offset() or 0)
+                locations.extend((f, name) for name in found)
+
+        results = {}
+        for f, name in locations:
+            if name in results:
+                continue
+            dset = self._open(f)[self.statistic][name]
+            results[name] = (dset[()], dict(dset.attrs))
+
+        missing = wanted.difference(results)
+        if missing:
+            LOG.info('Nothing found for {}'.format(', '.join(sorted(missing))))
+        return results
+
+    def read_cr_stat(self, fill_value=-999, units=None, min_exptime=200,
+                     block_size=2**22, **predicates):
         """Read in all the data for the specified :py:attr:`statistic`
 
         This method should only be used to read in the following statistics:
@@ -337,29 +2614,91 @@ class DataReader(object):
         units : {'pixels', 'sigmas'}
             Specifies the units for the sizes statistics.
 
+        min_exptime : float
+            Only read images with an integration time greater than this
+
+        block_size : int
+            Approximate number of values per chunk of the dask array. The
+            datasets are read in blocks of this size rather than one at a
+            time.
+
+        predicates : dict
+            Additional predicates used to select the images to read (e.g.
+            `date_range`, `lat_range`, `lon_range`, `instr`). See
+            :py:meth:`select_datasets`.
+
         Returns
         -------
         None
             Populate the given statistics corresponding attribute with a
             masked `dask.array`
         """
+        tmp = self._stat_arrays(units=units, min_exptime=min_exptime,
+                                block_size=block_size, **predicates)
+        x = da.concatenate(tmp, axis=0)
+        self._set_stat(x, fill_value=fill_value, units=units)
+
+    def _stat_arrays(self, units=None, block_size=2**22, **predicates):
+        """Build dask arrays for the selected datasets
+
+        Adjacent datasets in each shard are coalesced into blocks of about
+        `block_size` values that are read in a single task, which keeps the
+        task graph small no matter how many images are selected.
+        """
+        return [
+            self._block_array(*block)
+            for block in self._stat_blocks(units=units,
+                                           block_size=block_size,
+                                           **predicates)
+        ]
+
+    def _stat_blocks(self, units=None, block_size=2**22, **predicates):
+        """Plan the blocks read by :py:meth:`_stat_arrays`
+
+        Returns
+        -------
+        blocks : list
+            (fname, names, row, shape, dtype) of each block, in the order
+            the blocks are stored on disk
+        """
+        if not units:
+            row = None
+        elif units == 'sigmas':
+            row = 0
+        else:
+            #self.instr_cfg['instr_params']['pixel_size']**2*dset[:][1]
+            row = 1
+
         tmp = []
-        for f in self.hdf5_files:
-            fobj = h5py.File(f, mode='r')
-            # print(list(fobj.keys()))
-            grp = fobj[self.statistic]
-            for name in grp.keys():
+        selected = self.select_datasets(**predicates)
+        for f, names in selected.items():
+            grp = self._open(f)[self.statistic]
+            block, block_shape, dtype = [], None, None
+            for name in names:
                 dset = grp[name]
-                if not units and dset.attrs['integration_time'] > min_exptime:
-                    tmp.append(da.from_array(dset, chunks=(25000)))
-                elif units == 'sigmas' and dset.attrs['integration_time'] > min_exptime:
-                    tmp.append(da.from_array(dset[:][0], chunks=(25000)))
-                elif units == 'pixels' and dset.attrs['integration_time'] > min_exptime:
-                    #tmp.append(da.from_array(self.instr_cfg['instr_params']['pixel_size']**2*dset[:][1], chunks=(15000)))
-                    tmp.append(da.from_array(dset[:][1], chunks=(25000)))
-                elif dset.attrs['integration_time'] > min_exptime:
-                    tmp.append(da.from_array(dset[:][1], chunks=(25000)))
-        x = da.concatenate(tmp, axis=0)
+                shape = dset.shape if row is None else dset.shape[1:]
+                if block and (shape[1:] != block_shape[1:] or
+                              block_shape[0] + shape[0] > block_size):
+                    tmp.append((f, block, row, block_shape, dtype))
+                    block, block_shape = [], None
+                if block_shape is None:
+                    block_shape, dtype = shape, dset.dtype
+                else:
+                    block_shape = (block_shape[0] + shape[0],) + shape[1:]
+                block.append(name)
+            if block:
+                tmp.append((f, block, row, block_shape, dtype))
+        return tmp
+
+    def _block_array(self, fname, names, row, shape, dtype):
+        """Wrap a delayed read of a block of datasets in a dask array"""
+        return da.from_delayed(
+            dask.delayed(_read_block)(fname, self.statistic, names, row),
+            shape=shape, dtype=dtype
+        )
+
+    def _set_stat(self, x, fill_value=-999, units=None):
+        """Mask the invalid values of `x` and store it for the statistic"""
         # Remove an NaN's and replace them with the fill value
         data = da.ma.fix_invalid(x, fill_value=fill_value)
         LOG.info('Final array {}'.format(x.shape))
@@ -384,7 +2723,7 @@ class DataReader(object):
             self._pixels_affected = data
 
 
-    def read_cr_rate(self):
+    def read_cr_rate(self, **predicates):
         """ Method for reading in the incident cosmic ray rate.
 
         This method will generate a :py:class:`pandas.DataFrame` containing
@@ -402,48 +2741,282 @@ class DataReader(object):
         Finally, the :py:class:`pandas.DataFrame` generated is indexed using
         a :py:class:`pandas.DatetimeIndex` to facilitate time-series anaylses.
 
+        The DataFrame read from each shard is stored in the
+        :py:attr:`frame_cache`, so only the shards that changed since the last
+        read are opened.
+
+        Parameters
+        ----------
+        predicates : dict
+            Predicates used to select the observations to read (e.g.
+            `date_range`, `min_exptime`, `lat_range`, `lon_range`, `instr`).
+            See :py:meth:`select_datasets`.
+
         Returns
         -------
 
         """
-        data = defaultdict(list)
-        for f in self.hdf5_files:
-            fobj = h5py.File(f, mode='r')
-            grp = fobj[self.statistic]
-            for name in grp.keys():
-                data['obsname'].append(name)
+        def value(dset):
+            return {self.statistic: dset[()]}
+
+        cache = self.frame_cache
+        if cache is None or not cache.enabled:
+            selected = self.select_datasets(**predicates)
+            self.data_df = load_frame(selected, self.statistic, value=value)
+            return
+
+        hdf5_files = self._select_files(predicates.get('date_range'))
+        frames = {}
+        keys = {}
+        for f in hdf5_files:
+            keys[f] = cache.key(f, statistic=self.statistic, **predicates)
+            frames[f] = cache.get(keys[f])
+        missing = [f for f in hdf5_files if frames[f] is None]
+        LOG.info('{} of {} shards found in the cache'.format(
+            len(hdf5_files) - len(missing), len(hdf5_files)))
+
+        if missing:
+            all_files = self.hdf5_files
+            self.hdf5_files = missing
+            try:
+                selected = self.select_datasets(**predicates)
+            finally:
+                self.hdf5_files = all_files
+            for f in missing:
+                frames[f] = load_frame({f: selected.get(f, [])},
+                                       self.statistic, value=value)
+                cache.put(keys[f], frames[f])
+
+        parts = [frames[f] for f in hdf5_files if not frames[f].empty]
+        if parts:
+            df = pd.concat(parts)
+            df.sort_index(inplace=True)
+        else:
+            df = pd.DataFrame()
+        self.data_df = df
 
-                # Get the data for the current dataset
-                dset = grp[name]
 
-                # Record the data for the given statistic
-                data[self.statistic].append(dset.value)
-
-                # Get the attributes stored with the data
-                attrs = dset.attrs
-                for key in attrs.keys():
-                    val = attrs[key]
-                    if key == 'date':
-                        val = Time(val, format='iso')
-                        data[key].append(val)
-                    elif key in ['altitude','latitude','longitude']:
-                        try:
-                            data['{}_start'.format(key)].append(val[0])
-                            data['{}_end'.format(key)].append(val[-1])
-                        except IndexError:
-                            # If for some reason the IndexError is raised, save
-                            # the value in both the start and end times.
-                            # Otherwise we will get a ValueError when creating
-                            # the pd.DataFrame
-                            data['{}_start'.format(key)].append(val)
-                            data['{}_end'.format(key)].append(val)
-                    else:
-                        data[key].append(val)
-
-        data['mjd'] = [val.mjd for val in data['date']]
-        date_index = pd.DatetimeIndex([val.iso for val in data['date']])
-        # # LOG.info(len(date_index))
-        # for key in data.keys():
-        #     LOG.info('key: {} shape: {}'.format(key, len(data[key])))
-        self.data_df = pd.DataFrame(data, index = date_index)
-        self.data_df.sort_index(inplace=True)
+def _read_block(fname, statistic, names, row=None):
+    """Read a block of datasets from a shard and concatenate them
+
+    Parameters
+    ----------
+    fname : str
+        Shard to read from
+
+    statistic : str
+        One of the valid statistics
+
+    names : list
+        Names of the datasets, in the order they are stored on disk
+
+    row : int, optional
+        If given, only this row of each dataset is kept (e.g. the sizes in
+        sigmas or pixels)
+
+    Returns
+    -------
+    data : :py:class:`numpy.ndarray`
+    """
+    with h5py.File(fname, mode='r') as fobj:
+        grp = fobj[statistic]
+        data = []
+        for name in names:
+            values = grp[name][()]
+            data.append(values if row is None else values[row])
+    return np.concatenate(data, axis=0)
+
+
+def _read_shard(instr, statistic, fname, cfg, rate, kwargs):
+    """Read the results stored in a single shard
+
+    Runs in a worker process of :py:func:`read_parallel`, so it returns plain
+    in-memory objects rather than anything backed by an open file. For the
+    incident cosmic ray rate this is the DataFrame of the shard. For the per
+    cosmic ray statistics only the blocks to read are planned (see
+    :py:meth:`DataReader._stat_blocks`). They are read by
+    :py:func:`_read_blocks` in a second pass.
+    """
+    with DataReader(instr=instr, statistic=statistic, cfg=cfg) as reader:
+        reader.hdf5_files = [fname]
+        if rate:
+            reader.read_cr_rate(**kwargs)
+            return reader.data_df
+        kwargs = dict(kwargs)
+        kwargs.setdefault('min_exptime', 200)
+        return reader._stat_blocks(**kwargs) or None
+
+
+def _read_blocks(statistic, blocks):
+    """Read blocks planned by :py:meth:`DataReader._stat_blocks`
+
+    Runs in a worker process of :py:func:`read_parallel`.
+    """
+    return [_read_block(fname, statistic, names, row)
+            for fname, names, row, _, _ in blocks]
+
+
+def _block_nbytes(block):
+    """Size in bytes of a block planned by
+    :py:meth:`DataReader._stat_blocks`"""
+    return int(np.prod(block[3])) * np.dtype(block[4]).itemsize
+
+
+def read_parallel(instruments, statistic, num_workers=None, memory_limit=None,
+                  cfg=None, fill_value=-999, **kwargs):
+    """Read the results for several instruments in parallel
+
+    Every shard of every instrument is read in its own task in a pool of
+    processes. The results are combined into one :py:class:`DataReader` per
+    instrument, populated exactly as if :py:meth:`DataReader.read_cr_rate`
+    (for the incident cosmic ray rate) or :py:meth:`DataReader.read_cr_stat`
+    had been called on it.
+
+    For the per cosmic ray statistics, the workers first plan the blocks of
+    datasets to read in each shard. If the planned blocks fit within
+    `memory_limit`, they are then read by the workers as well, and the
+    statistic is a dask array over the blocks already in memory. Otherwise
+    it is left as the lazy array :py:meth:`DataReader.read_cr_stat` builds,
+    read block by block whenever it is computed, so the limit is never
+    exceeded.
+
+    Parameters
+    ----------
+    instruments : list
+        Valid instrument names
+
+    statistic : str
+        One of the valid statistics
+
+    num_workers : int, optional
+        Number of processes to use. Defaults to the number of CPUs.
+
+    memory_limit : int, optional
+        Maximum number of bytes to load. For the incident cosmic ray rate,
+        the shards are read in batches whose sizes, as recorded in the
+        manifest, fit in the limit. Any shard larger than the limit is read
+        on its own. For the per cosmic ray statistics, it caps the total size
+        of the blocks read by the workers, see above. By default there is no
+        limit.
+
+    cfg : dict, optional
+        The configuration object obtained by parsing pipeline_config.yaml
+
+    fill_value : int
+        Value to replace NaNs with for the per cosmic ray statistics
+
+    kwargs : dict
+        Additional arguments passed to the read method of each reader (e.g.
+        `units`, `min_exptime`, `date_range`)
+
+    Returns
+    -------
+    readers : dict
+        Maps each instrument to its populated :py:class:`DataReader`
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    rate = 'rate' in statistic
+    units = kwargs.get('units')
+
+    readers = {}
+    tasks = []
+    for instr in instruments:
+        reader = DataReader(instr=instr, statistic=statistic, cfg=cfg)
+        reader.find_hdf5(date_range=kwargs.get('date_range'))
+        readers[instr] = reader
+        manifest = ShardManifest(reader.results_path(), statistic)
+        sizes = {}
+        if manifest.exists():
+            manifest.load()
+            sizes = {
+                manifest.shard_path(shard): shard['nbytes']
+                for shard in manifest.shards
+            }
+        for fname in reader.hdf5_files:
+            nbytes = sizes.get(fname)
+            if nbytes is None:
+                nbytes = os.path.getsize(fname)
+            tasks.append((instr, fname, nbytes))
+
+    # Pack the shards into batches that fit within the memory limit
+    batches = []
+    batch, batch_bytes = [], 0
+    for task in tasks:
+        if batch and memory_limit is not None and \
+                batch_bytes + task[2] > memory_limit:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(task)
+        batch_bytes += task[2]
+    if batch:
+        batches.append(batch)
+
+    results = defaultdict(list)
+    for i, batch in enumerate(batches):
+        LOG.info('Reading batch {} of {} ({} shards, {} bytes)'.format(
+            i + 1, len(batches), len(batch), sum(t[2] for t in batch)))
+        delayed_objects = [
+            dask.delayed(_read_shard)(instr, statistic, fname,
+                                      readers[instr].cfg, rate, kwargs)
+            for instr, fname, _ in batch
+        ]
+        output = dask.compute(*delayed_objects,
+                              scheduler='processes',
+                              num_workers=num_workers)
+        for (instr, _, _), result in zip(batch, output):
+            if result is None:
+                continue
+            if rate:
+                results[instr].append(result)
+            else:
+                results[instr].extend(result)
+
+    loaded = {}
+    if not rate:
+        nbytes = sum(_block_nbytes(block)
+                     for parts in results.values() for block in parts)
+        if memory_limit is None or nbytes <= memory_limit:
+            # One task per shard, keeping the blocks in order
+            tasks = []
+            for instr, parts in results.items():
+                by_file = OrderedDict()
+                for block in parts:
+                    by_file.setdefault(block[0], []).append(block)
+                tasks.extend((instr, blocks) for blocks in by_file.values())
+            LOG.info('Reading {} blocks ({} bytes) from {} shards'.format(
+                sum(len(parts) for parts in results.values()), nbytes,
+                len(tasks)))
+            output = dask.compute(
+                *[dask.delayed(_read_blocks)(statistic, blocks)
+                  for _, blocks in tasks],
+                scheduler='processes',
+                num_workers=num_workers
+            )
+            for (instr, _), arrays in zip(tasks, output):
+                loaded.setdefault(instr, []).extend(arrays)
+        else:
+            LOG.info('The {} bytes of {} exceed the memory limit, reading '
+                     'them lazily'.format(nbytes, statistic))
+
+    for instr, reader in readers.items():
+        parts = results[instr]
+        if rate:
+            if parts:
+                df = pd.concat(parts)
+                df.sort_index(inplace=True, kind='stable')
+            else:
+                df = pd.DataFrame()
+            reader.data_df = df
+        elif instr in loaded:
+            x = da.concatenate([da.from_array(values, chunks=values.shape)
+                                for values in loaded[instr]], axis=0)
+            reader._set_stat(x, fill_value=fill_value, units=units)
+        elif parts:
+            # Lazily read block by block, as in DataReader.read_cr_stat
+            x = da.concatenate([reader._block_array(*block)
+                                for block in parts], axis=0)
+            reader._set_stat(x, fill_value=fill_value, units=units)
+        else:
+            LOG.info('No data found for {}'.format(instr))
+    return readers
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import argparse
-from collections import defaultdict
 import glob
+import json
+import os
+import shutil
 import sys
 
 
@@ -12,46 +14,101 @@ import h5py
 import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument('-instr',
                     type=str,
                     default='ACS_WFC')
 
-def mk_catalog(instr):
-    """Generate a catalog of CR data extracted from each image
+parser.add_argument('-per_cr',
+                    action='store_true',
+                    help='Write a Parquet catalog with one row per cosmic ray '
+                         'instead of one row per image')
+
+def _fingerprint(fname):
+    """Size and modification time of a shard"""
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _segment_reductions(arrays):
+    """Sum, mean, and median of each array, computed in one pass
+
+    NaNs are ignored by the mean and median. Empty arrays give a sum of zero
+    and a NaN mean and median.
     """
-    # Desired information
-    metadata_keywords = [
-        'date',
-        'expend',
-        'integration_time',
-        'altitude',
-        'latitude',
-        'longitude',
-    ]
+    lengths = np.array([a.size for a in arrays], dtype=np.int64)
+    if not lengths.sum():
+        nans = np.full(len(arrays), np.nan)
+        return np.zeros(len(arrays)), nans, nans.copy()
+    values = np.concatenate([np.ravel(a) for a in arrays]).astype(np.float64)
+    segment = np.repeat(np.arange(len(arrays)), lengths)
 
-    keyword_out = [
-        'date_start',
-        'date_end'
-        'mjd_start',
-        'mjd_end',
-        'altitude_start',
-        'altitude_end',
-        'latitude_start',
-        'latitude_end',
-        'longitude_start',
-        'longitude_end',
-        'integration_time',
-        'incident_cr_rate',
-        'cumulative_energy_deposited',
-        'energy_per_area',
-        'energy_per_area_per_time',
-        'average_size_pixels',
-        'obs_id'
-    ]
+    sums = np.zeros(len(arrays))
+    np.add.at(sums, segment, np.nan_to_num(values))
+    grouped = pd.Series(values).groupby(segment)
+    means = grouped.mean().reindex(range(len(arrays))).values
+    medians = grouped.median().reindex(range(len(arrays))).values
+    return sums, means, medians
+
+
+def mk_catalog(instr, outdir=None, rebuild=False):
+    """Generate a catalog of CR data extracted from each image
+
+    The catalog is stored as a directory of Parquet files. Each run only
+    adds the images written since the last one:
+
+    * A watermark file records the size and modification time of every
+      incident cosmic ray rate shard at the time of the last run. Shards
+      that haven't changed since then are skipped without being opened.
+    * Every dataset in the changed shards is read and its rows are
+      appended as a new part file. Rows already in older part files for
+      the same images are removed from them, so images whose results or
+      metadata were rewritten (e.g. by `refresh_metadata.py`) are updated.
+    * A shard is only marked as done in the watermark once all of its
+      images have been catalogued. Images whose energy or size results
+      haven't been written yet are picked up by a later run.
+
+    Pass `rebuild=True` to start the catalog over.
+
+    The catalog can be read with `pandas.read_parquet(outdir)`.
 
-    output_data = defaultdict(list)
+    Parameters
+    ----------
+    instr : str
+        One of the valid instrument names
+
+    outdir : str, optional
+        Directory to store the catalog in. Defaults to `<instr>_catalog`.
+
+    rebuild : bool
+        If True, remove the existing catalog first
+    """
+    if pa is None:
+        raise ImportError('pyarrow is required to write the catalog')
+    if outdir is None:
+        outdir = '{}_catalog'.format(instr)
+    if rebuild and os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir, exist_ok=True)
+    watermark_file = os.path.join(outdir, '_watermark.json')
+    parts = sorted(glob.glob(os.path.join(outdir, 'part-*.parquet')))
+
+    watermark = {}
+    if os.path.isfile(watermark_file):
+        with open(watermark_file, 'r') as fobj:
+            watermark = json.load(fobj)
+    catalogued = set()
+    if parts:
+        catalogued = set(
+            pd.read_parquet(parts, columns=['obs_id'])['obs_id']
+        )
 
     rates = dh.DataReader(instr=instr.upper(), statistic='incident_cr_rate')
     size = dh.DataReader(instr=instr.upper(), statistic='sizes')
@@ -63,104 +120,295 @@ def mk_catalog(instr):
     #     for r in [rates, size, energy]:
     #         for i,f in enumerate(r.hdf5_files):
     #             r.hdf5_files[i] = f.replace('STIS','STIS/stis_saa_results/')
-    
-    print(rates.hdf5_files)
-    print(size.hdf5_files)
-    print(energy.hdf5_files)
-    #sys.exit()
     area = rates.instr_cfg['instr_params']['detector_size']
 
-    flist_tuple = zip(rates.hdf5_files, size.hdf5_files, energy.hdf5_files)
-    for (f1, f2, f3) in flist_tuple:
-        fobj1 = h5py.File(f1, mode='r')
-        grp1 = fobj1['/incident_cr_rate']
-        
-        fobj2 = h5py.File(f2, mode='r')
-        grp2 = fobj2['sizes']
-        
-        fobj3 = h5py.File(f3, mode='r')
-        grp3 = fobj3['energy_deposited']
-        print(len(list(grp1.keys())))
-        for key in grp1.keys():
-
-            rate_dset = grp1[key]
-            missing = False
-            try:
-                size_dset = grp2[key]
-            except Exception as e:
-                print(e)
-                missing=True
-        
-            try:
-                energy_dset = grp3[key]
-            except Exception as e:
-                print(e)
-                missing=True
-        
-            if missing:
-                print(missing)
-                continue
-        
-            output_data['obs_id'].append(key)
-            # get the meta data for the dataset
-            metadata = rate_dset.attrs
-            start_date = Time(metadata['date'], format='iso')
-            end_date = Time(metadata['expend'], format='iso')
-            output_data['date_start'].append(start_date)
-            output_data['mjd_start'].append(start_date.mjd)
-
-            output_data['date_end'].append(end_date)
-            output_data['mjd_end'].append(end_date.mjd)
-
-            output_data['integration_time'].append(metadata['integration_time'])
-
-
-            altitude = metadata['altitude']
-            try:
-                output_data['altitude_start'].append(altitude[0])
-                output_data['altitude_end'].append(altitude[-1])
-            except IndexError:
-                output_data['altitude_start'].append(altitude)
-                output_data['altitude_end'].append(altitude)
-
-
-            latitude = metadata['latitude']
-            try:
-                output_data['latitude_start'].append(latitude[0])
-                output_data['latitude_end'].append(latitude[-1])
-            except IndexError:
-                output_data['latitude_start'].append(latitude)
-                output_data['latitude_end'].append(latitude)
-
-            longitude = metadata['longitude']
-            try:
-                output_data['longitude_start'].append(longitude[0])
-                output_data['longitude_end'].append(longitude[-1])
-            except IndexError:
-                output_data['longitude_start'].append(longitude)
-                output_data['longitude_end'].append(longitude)
-
-            output_data['incident_cr_rate'].append(rate_dset[()])
-
-            output_data['cumulative_energy'].append(energy_dset.value.sum())
-            output_data['cumulative_energy_per_area'].append(
-                energy_dset.value.sum()/area
-            )
-            output_data['cumulative_energy_per_area_per_time'].append(
-                energy_dset.value.sum()/area/metadata['integration_time']
-            )
+    fingerprints = {f: _fingerprint(f) for f in rates.hdf5_files}
+    changed = [
+        f for f in rates.hdf5_files if watermark.get(f) != fingerprints[f]
+    ]
+    print('{} of {} shards changed since the last build'.format(
+        len(changed), len(rates.hdf5_files)))
+
+    selected = {}
+    for f in changed:
+        with h5py.File(f, mode='r') as fobj:
+            selected[f] = list(fobj['incident_cr_rate'].keys())
+    shard_of = {name: f for f, names in selected.items() for name in names}
+    complete = set(changed)
 
-            output_data['mean_size_pixels'].append(np.nanmean(size_dset[:][1]))
-            output_data['median_size_pixels'].append(np.nanmedian(size_dset[:][1]))
+    def rate_value(dset):
+        return {'incident_cr_rate': dset[()]}
 
-    print('Number of datasets: {}'.format(len(output_data['date_start'])))
-    date_index = pd.DatetimeIndex(
-        [val.iso for val in output_data['date_start']]
+    df = dh.load_frame(
+        selected, 'incident_cr_rate',
+        value=rate_value,
+        mjd_keys={'date': 'mjd_start', 'expend': 'mjd_end'}
     )
-    df = pd.DataFrame(output_data, index=date_index)
-    df.sort_index(inplace=True)
-    df.to_csv('{}_catalog.txt'.format(instr), header=True, index=False)
+
+    num_new = num_updated = 0
+    if not df.empty:
+        # Only keep the observations with all three statistics
+        names = list(df['obsname'])
+        energies = energy.read_many(names)
+        sizes = size.read_many(names)
+        written = df['obsname'].isin(energies) & df['obsname'].isin(sizes)
+        # Check the shards again on the next run
+        complete -= set(shard_of[name] for name in df['obsname'][~written])
+        df = df[written]
+        names = list(df['obsname'])
+
+        sums, _, _ = _segment_reductions(
+            [energies[name][0] for name in names]
+        )
+        _, means, medians = _segment_reductions(
+            [np.asarray(sizes[name][0])[1] for name in names]
+        )
+        df = df.assign(cumulative_energy=sums,
+                       mean_size_pixels=means,
+                       median_size_pixels=medians)
+        df = df.rename(columns={'obsname': 'obs_id',
+                                'date': 'date_start',
+                                'expend': 'date_end'})
+
+        df['cumulative_energy_per_area'] = df['cumulative_energy'] / area
+        df['cumulative_energy_per_area_per_time'] = \
+            df['cumulative_energy_per_area'] / df['integration_time']
+
+        columns = [
+            'obs_id', 'date_start', 'mjd_start', 'date_end', 'mjd_end',
+            'integration_time', 'altitude_start', 'altitude_end',
+            'latitude_start', 'latitude_end', 'longitude_start',
+            'longitude_end', 'incident_cr_rate', 'cumulative_energy',
+            'cumulative_energy_per_area',
+            'cumulative_energy_per_area_per_time', 'mean_size_pixels',
+            'median_size_pixels'
+        ]
+        num_new = len(df)
+        if num_new:
+            num = 1 + max(
+                [int(os.path.basename(f)[5:10]) for f in parts] + [-1]
+            )
+            fout = os.path.join(outdir, 'part-{:05d}.parquet'.format(num))
+            df[columns].to_parquet(fout, index=False)
+            # Drop the rows superseded by the new part from the older ones
+            emitted = set(df['obs_id'])
+            for part in parts:
+                old_df = pd.read_parquet(part)
+                keep = ~old_df['obs_id'].isin(emitted)
+                if keep.all():
+                    continue
+                if keep.any():
+                    tmp = '{}.tmp'.format(part)
+                    old_df[keep].to_parquet(tmp, index=False)
+                    os.replace(tmp, part)
+                else:
+                    os.remove(part)
+            num_new = len(emitted - catalogued)
+            num_updated = len(emitted & catalogued)
+
+    for r in [rates, size, energy]:
+        r.close()
+
+    # Only advance the watermark once the new rows are safely written
+    watermark.update({f: fingerprints[f] for f in complete})
+    tmp = '{}.tmp'.format(watermark_file)
+    with open(tmp, 'w') as fobj:
+        json.dump(watermark, fobj, indent=1)
+    os.replace(tmp, watermark_file)
+    print('Added {} and updated {} datasets in {} ({} total)'.format(
+        num_new, num_updated, outdir, len(catalogued) + num_new))
+
+def _orbit_position(metadata, key):
+    """Value of an orbital parameter halfway through the observation"""
+    val = np.atleast_1d(metadata.get(key, np.nan))
+    if not val.size:
+        return np.nan
+    return val[val.size // 2]
+
+
+def _cr_columns(name, metadata, energy, sizes, shapes, pixels):
+    """Build the per cosmic ray columns for a single image
+
+    The affected pixels of every cosmic ray are stored one after the other,
+    so they are split using the size of each cosmic ray in pixels. The
+    centroid is the mean position of the affected pixels, since the
+    flux-weighted centroid isn't stored. For instruments with more than one
+    chip the y positions are in the frame of the stacked chips.
+    """
+    num_crs = energy.size
+    sizes = np.asarray(sizes)
+    if sizes.shape[-1] != num_crs or \
+            (shapes is not None and shapes.size != num_crs):
+        return None
+
+    npix = sizes[1].astype(np.int64)
+    columns = {
+        'image_id': np.full(num_crs, name, dtype=object),
+        'cr_index': np.arange(num_crs, dtype=np.int32),
+        'energy': energy.astype(np.float32),
+        'size_sigmas': sizes[0].astype(np.float32),
+        'size_pixels': npix.astype(np.int32),
+        'shape': (np.full(num_crs, np.nan, dtype=np.float32)
+                  if shapes is None else shapes.astype(np.float32)),
+    }
+
+    boxes = None
+    if pixels is not None:
+        boxes = dh.cr_bounding_boxes(pixels, npix)
+    if boxes is not None:
+        columns.update(boxes)
+    else:
+        for axis in ['y', 'x']:
+            columns['{}_centroid'.format(axis)] = \
+                np.full(num_crs, np.nan, dtype=np.float32)
+            for key in ['min', 'max']:
+                columns['{}_{}'.format(axis, key)] = \
+                    np.full(num_crs, -1, dtype=np.int32)
+
+    columns['date'] = np.full(num_crs, str(metadata.get('date', '')),
+                              dtype=object)
+    for key in ['latitude', 'longitude', 'altitude']:
+        columns[key] = np.full(num_crs, _orbit_position(metadata, key),
+                               dtype=np.float32)
+    return columns
+
+
+_CR_SCHEMA = None if pa is None else pa.schema([
+    ('image_id', pa.string()),
+    ('cr_index', pa.int32()),
+    ('date', pa.timestamp('us')),
+    ('mjd', pa.float64()),
+    ('latitude', pa.float32()),
+    ('longitude', pa.float32()),
+    ('altitude', pa.float32()),
+    ('energy', pa.float32()),
+    ('size_sigmas', pa.float32()),
+    ('size_pixels', pa.int32()),
+    ('shape', pa.float32()),
+    ('y_centroid', pa.float32()),
+    ('x_centroid', pa.float32()),
+    ('y_min', pa.int32()),
+    ('y_max', pa.int32()),
+    ('x_min', pa.int32()),
+    ('x_max', pa.int32()),
+])
+
+
+def _cr_table(parts):
+    """Combine the columns of several images into a single table"""
+    columns = {
+        key: np.concatenate([part[key] for part in parts])
+        for key in parts[0].keys()
+    }
+    dates = columns['date'].astype(str)
+    columns['mjd'] = np.full(dates.size, np.nan)
+    has_date = dates != ''
+    if has_date.any():
+        columns['mjd'][has_date] = Time(dates[has_date], format='iso').mjd
+    columns['date'] = pd.to_datetime(dates, errors='coerce').values
+    # The bounding box is unknown for images whose affected pixels are
+    # missing or inconsistent with the sizes
+    arrays = []
+    for field in _CR_SCHEMA:
+        values = columns[field.name]
+        mask = values == -1 if field.name[1:] in ('_min', '_max') else None
+        arrays.append(pa.array(values, type=field.type, mask=mask))
+    return pa.Table.from_arrays(arrays, schema=_CR_SCHEMA)
+
+
+def mk_cr_catalog(instr, fout=None, row_group_size=1000000, batch_size=500):
+    """Generate a catalog with one row for every cosmic ray
+
+    The catalog is written as Parquet, sorted by observation date. Each row
+    group holds `row_group_size` cosmic rays and has min/max statistics for
+    every column, so other tools can skip row groups when filtering by date,
+    energy, or position.
+
+    Parameters
+    ----------
+    instr : str
+        One of the valid instrument names
+
+    fout : str, optional
+        Output file. Defaults to `<instr>_cr_catalog.parquet`.
+
+    row_group_size : int
+        Number of cosmic rays per row group
+
+    batch_size : int
+        Number of images whose statistics are looked up at once
+    """
+    if pa is None:
+        raise ImportError('pyarrow is required to write the per CR catalog')
+    instr = instr.upper()
+    if fout is None:
+        fout = '{}_cr_catalog.parquet'.format(instr.lower())
+
+    energy = dh.DataReader(instr=instr, statistic='energy_deposited')
+    others = {
+        stat: dh.DataReader(instr=instr, statistic=stat)
+        for stat in ['sizes', 'shapes', 'cr_affected_pixels']
+        if stat in energy.instr_cfg['hdf5_files']
+    }
+    for r in [energy] + list(others.values()):
+        r.find_hdf5()
+
+    num_crs, num_images, skipped = 0, 0, 0
+    parts, buffered = [], 0
+
+    with pq.ParquetWriter(fout, _CR_SCHEMA) as writer:
+        def flush(parts):
+            table = _cr_table(parts)
+            writer.write_table(table, row_group_size=row_group_size)
+
+        def process(batch):
+            nonlocal num_crs, num_images, skipped, buffered
+            names = [metadata['name'] for metadata, _ in batch]
+            data = {
+                stat: r.read_many(names) for stat, r in others.items()
+            }
+            for metadata, energies in batch:
+                name = metadata['name']
+                if name not in data.get('sizes', {}):
+                    skipped += 1
+                    continue
+                shapes = data.get('shapes', {}).get(name, (None,))[0]
+                pixels = data.get('cr_affected_pixels', {}).get(
+                    name, (None,))[0]
+                columns = _cr_columns(name, metadata, energies,
+                                      data['sizes'][name][0], shapes, pixels)
+                if columns is None:
+                    skipped += 1
+                    continue
+                parts.append(columns)
+                buffered += energies.size
+                num_crs += energies.size
+                num_images += 1
+                if buffered >= row_group_size:
+                    flush(parts)
+                    parts.clear()
+                    buffered = 0
+
+        batch = []
+        for item in energy.iter_images():
+            batch.append(item)
+            if len(batch) == batch_size:
+                process(batch)
+                batch = []
+        if batch:
+            process(batch)
+        if parts:
+            flush(parts)
+
+    for r in [energy] + list(others.values()):
+        r.close()
+    print('Wrote {} cosmic rays from {} images to {} ({} images skipped)'
+          ''.format(num_crs, num_images, fout, skipped))
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    mk_catalog(args.instr)
+    if args.per_cr:
+        mk_cr_catalog(args.instr)
+    else:
+        mk_catalog(args.instr)
@@ -11,17 +11,17 @@ pipeline. In short it will perform the following:
 
 """
 
-from collections import defaultdict
 import logging
 import os
 import warnings
 import yaml
 
 from astropy.time import Time
-import h5py
 from numpy import array
 from pandas import date_range
 
+from utils import datahandler
+
 
 logging.basicConfig(format='%(levelname)-4s '
                            '[%(module)s:%(funcName)s:%(lineno)d]'
@@ -264,32 +264,42 @@ class Initializer(object):
         For example, if we were to keep our HDF5 file open during the entire
         pipeline and it faile
 
+        If `chunks` is None, only the first shard is created and the
+        :py:class:`~utils.datahandler.DataWriter` starts new shards as each
+        one fills up. In every case a fresh
+        :py:class:`~utils.datahandler.ShardManifest` is written listing the
+        files that were created. Shard files that already exist are kept as
+        they are and added to the manifest.
+
         """
         hdf5_files = self.instr_cfg['hdf5_files']
-        new_flist = defaultdict(list)
         for key in hdf5_files.keys():
             rel_path = hdf5_files[key]
             full_path = os.path.join(self.base, *rel_path.split('/'))
+            manifest = datahandler.ShardManifest(full_path,
+                                                 self.cfg['grp_names'][key])
+            LOG.info(
+                'File structure: /{}'.format(self.cfg['grp_names'][key])
+            )
             if isinstance(chunks, str):
-                fnew = full_path.replace('.hdf5', '_{}.hdf5'.format(chunks))
-                new_flist[key].append(fnew)
-                continue
-            i = 0
-            while i < chunks:
-                fnew = full_path.replace('.hdf5', '_{}.hdf5'.format(i + 1))
-                i += 1
-                new_flist[key].append(fnew)
-
-        for key in new_flist.keys():
-            for f in new_flist[key]:
-                if not os.path.isdir(os.path.dirname(f)):
-                    os.makedirs(os.path.dirname(f), exist_ok=True)
-
-                LOG.info(
-                    'File structure: /{}'.format(self.cfg['grp_names'][key])
-                )
-                with h5py.File(f, 'w') as fobj:
-                    grp = fobj.create_group(self.cfg['grp_names'][key])
+                # Add a single named chunk to the existing set of shards
+                if manifest.exists():
+                    manifest.load()
+                suffixes = [chunks]
+            elif chunks is None:
+                suffixes = [1]
+            else:
+                suffixes = range(1, chunks + 1)
+            for suffix in suffixes:
+                try:
+                    manifest.new_shard(suffix=suffix)
+                except FileExistsError as e:
+                    # Never truncate results that have already been written
+                    LOG.warning('{}, keeping it'.format(e))
+                    manifest.scan_shard(
+                        full_path.replace('.hdf5', '_{}.hdf5'.format(suffix))
+                    )
+            manifest.save()
 
     def get_processed_ranges(self):
         """ Get the previously processed date ranges
@@ -13,7 +13,6 @@ from collections.abc import Iterable
 import logging
 import os
 
-from astropy.io import fits
 from astropy.time import Time
 from astropy.wcs import WCS
 from astropy.constants import R_earth
@@ -22,6 +21,11 @@ from calcos.timeline import gmst, DEGtoRAD, rectToSph
 import numpy as np
 import yaml
 
+try:
+    from . import remote
+except ImportError:
+    import remote
+
 
 logging.basicConfig(format='%(levelname)-4s '
                            '[%(module)s.%(funcName)s:%(lineno)d]'
@@ -47,9 +51,14 @@ class GenerateMetadata(object):
     instr_cfg : dict
         Instrument specific configuration object
 
+    storage_options : dict, optional
+        Options for reading `fname` and its SPT file when they are URLs, see
+        :py:func:`utils.remote.storage_options`
+
     """
-    def __init__(self, fname, instr, instr_cfg=None):
+    def __init__(self, fname, instr, instr_cfg=None, storage_options=None):
         self._fname = fname # file name will always be the FLT
+        self._storage_options = storage_options
 
         self._mod_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -135,7 +144,8 @@ class GenerateMetadata(object):
         -------
 
         """
-        with fits.open(self.fname) as hdu:
+        with remote.open_fits(self.fname,
+                              storage_options=self._storage_options) as hdu:
             try:
                 wcs_obj = WCS(fobj = hdu, header = hdu[1].header)
             except (MemoryError, ValueError, KeyError) as e:
@@ -175,7 +185,8 @@ class GenerateMetadata(object):
                        'flashdur': 0,
                        'time-obs': None}
 
-        with fits.open(self.fname) as hdu:
+        with remote.open_fits(self.fname,
+                              storage_options=self._storage_options) as hdu:
             prhdr = hdu[0].header
             scihdr = hdu[1].header
             for key in header_data.keys():
@@ -248,8 +259,12 @@ class GenerateMetadata(object):
         # Generate the path to the engineering file
         self._engineering_file()
         # Using the telemetry data for the SPT file, compute HST (lon, lat, z)
-        if os.path.isfile(self.telemetry_file):
-            orbital_params = orbit.HSTOrbit(self.telemetry_file)
+        if remote.exists(self.telemetry_file, self._storage_options):
+            spt = self.telemetry_file
+            if remote.is_remote(spt):
+                # The SPT files are small, so read them in one request
+                spt = remote.read_bytes(spt, self._storage_options)
+            orbital_params = orbit.HSTOrbit(spt)
             # compute coords at beginning and end of exposure
             for t in time_intervals:
                 rect, vel = orbital_params.getPos(t)
@@ -7,6 +7,7 @@ from astropy.visualization import ImageNormalize, LinearStretch, \
     LogStretch, ZScaleInterval, SqrtStretch
 import dask.array as da
 import costools
+import datahandler as dh
 from collections import Iterable
 import h5py
 import numpy as np
@@ -52,45 +53,27 @@ class PlotData(object):
                                   'WFPC2': 60./2.}
 
     def read_rate(self):
-        data_out = defaultdict(list)
-        for f in self.flist:
-            print('Analyzing {}'.format(f))
-            fobj = h5py.File(f, mode='r')
-            sgrp = fobj[self.instr.upper()+'/'+self.subgrp]
-            for key in sgrp.keys():
-                data_out['obs_name'].append(key)
-                dset = sgrp[key].value
-                attrs = sgrp[key].attrs
-                exptime = attrs['exptime']
-                factor = (exptime + self.detector_readtime[self.instr.upper()]) \
-                        / exptime
-                if isinstance(dset, Iterable):
-                    dset = np.nanmedian(dset)
-
-                # Multiply by correction factor to account for various instrument
-                # readouts
-                data_out[self.subgrp].append(factor * dset /
-                                             self.detector_size[self.instr])
-                for at_key in attrs.keys():
-                    val = attrs[at_key]
-                    if at_key == 'date':
-                        val = Time(val, format='iso')
-                    elif at_key == 'latitude' or at_key == 'longitude' \
-                        or at_key == 'altitude':
-                        try:
-                            data_out['start_{}'.format(at_key)].append(val[0])
-                        except IndexError as e:
-                            data_out['start_{}'.format(at_key)].append(val)
-                        try:
-                            data_out['end_{}'.format(at_key)].append(val[-1])
-                        except IndexError as e:
-                            data_out['end_{}'.format(at_key)].append(val)
-                        continue
-                    data_out['{}'.format(at_key)].append(val)
-        data_out['mjd'] = [val.mjd for val in data_out['date']]
-        date_index = pd.DatetimeIndex([val.iso for val in data_out['date']])
-        self.data_df = pd.DataFrame(data_out, index = date_index)
-        self.data_df.sort_index(inplace=True)
+        print('Analyzing {}'.format(', '.join(self.flist)))
+
+        def rate_value(dset):
+            data = dset[()]
+            exptime = dset.attrs['exptime']
+            factor = (exptime + self.detector_readtime[self.instr.upper()]) \
+                    / exptime
+            if isinstance(data, Iterable):
+                data = np.nanmedian(data)
+
+            # Multiply by correction factor to account for various instrument
+            # readouts
+            return {self.subgrp: factor * data /
+                                 self.detector_size[self.instr]}
+
+        self.data_df = dh.load_frame(
+            {f: None for f in self.flist},
+            self.instr.upper() + '/' + self.subgrp,
+            value=rate_value,
+            orbit_fmt='{1}_{0}'
+        ).rename(columns={'obsname': 'obs_name'})
     
 
     def perform_SAA_cut(self):
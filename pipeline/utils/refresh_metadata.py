@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+This module is used to refresh the metadata stored with the results of the
+pipeline without rerunning it.
+
+The metadata of each image (date, integration time, WCS, and the position of
+HST during the exposure) only depends on the headers of the FLT file and on
+the telemetry stored in the SPT file. After a change to
+:py:class:`~utils.metadata.GenerateMetadata`, the metadata of every image that
+has already been processed is recomputed from those alone:
+
+    * If the FLT file is still in the download directory, it is used as is.
+      Otherwise only its primary and first extension headers are read with
+      HTTP Range requests (see :py:func:`~download.prefetch.read_headers`)
+      and written to a header-only FITS file.
+    * The SPT file, which is small, is downloaded next to it.
+    * The metadata is recomputed in parallel and written with
+      :py:meth:`~utils.datahandler.DataWriter.refresh_metadata`, which only
+      rewrites the attributes of the stored datasets. The cosmic ray
+      statistics are never modified.
+
+The pipeline should not be writing to the instrument while its metadata is
+being refreshed.
+
+"""
+import argparse
+import fnmatch
+import glob
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from astropy.io import fits
+import dask
+import yaml
+
+import datahandler as dh
+import metadata
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from download import cache, prefetch, transfer
+
+
+logging.basicConfig(format='%(levelname)-4s '
+                           '[%(module)s.%(funcName)s:%(lineno)d]'
+                           ' %(message)s',
+                    )
+LOG = logging.getLogger('refresh_metadata')
+LOG.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('-instr',
+                    type=str,
+                    default='ACS_WFC',
+                    help='Instrument to refresh the metadata for')
+
+parser.add_argument('-datasets',
+                    type=str,
+                    nargs='*',
+                    default=None,
+                    help='Names of the FLT files to refresh. Defaults to '
+                         'every image that has already been processed.')
+
+parser.add_argument('-num_workers',
+                    type=int,
+                    default=None,
+                    help='Number of images to process in parallel')
+
+
+# Keywords pointing at the distortion lookup tables stored in extensions
+# that are not kept in the header-only files
+_LOOKUP_KEYS = ['D2IM*', 'CPDIS*', 'CPERR*', 'DP1*', 'DP2*', 'NPOLEXT',
+                'D2IMEXT', 'WCSDVARR']
+
+
+def _load_cfg():
+    """Load the pipeline configuration file"""
+    mod_dir = os.path.dirname(os.path.abspath(__file__))
+    base = os.path.join('/', *mod_dir.split('/')[:-2])
+    cfg_file = os.path.join(base, 'CONFIG', 'pipeline_config.yaml')
+    with open(cfg_file, 'r') as fobj:
+        cfg = yaml.safe_load(fobj)
+    return cfg, base
+
+
+def processed_datasets(writer, instr_cfg):
+    """List every image with results for at least one statistic
+
+    Parameters
+    ----------
+    writer : :py:class:`~utils.datahandler.DataWriter`
+
+    instr_cfg : dict
+        Instrument specific configuration object
+
+    Returns
+    -------
+    names : list
+        Sorted list of FLT filenames
+    """
+    names = set()
+    for statistic in instr_cfg['hdf5_files'].keys():
+        names.update(writer.existing_datasets(statistic).keys())
+    return sorted(names)
+
+
+def write_header_file(fname, prhdr, scihdr):
+    """Write a FITS file holding only the primary and first extension headers
+
+    The keywords referring to the distortion lookup tables are removed, since
+    the extensions holding them are not written.
+    """
+    scihdr = scihdr.copy()
+    for key in set(scihdr.keys()):
+        # Record-valued keywords (e.g. DP1.EXTVER) are matched by name
+        if any(fnmatch.fnmatch(key.split('.')[0], pattern)
+               for pattern in _LOOKUP_KEYS):
+            scihdr.remove(key, remove_all=True)
+    hdulist = fits.HDUList([fits.PrimaryHDU(header=prhdr),
+                            fits.ImageHDU(header=scihdr)])
+    hdulist.writeto(fname, overwrite=True)
+
+
+def stage_image(name, download_dir, work_dir, instr_cfg, download_cfg):
+    """Gather the files needed to compute the metadata of an image
+
+    Parameters
+    ----------
+    name : str
+        Filename of the FLT file
+
+    download_dir : str
+        Download directory of the instrument. FLT and SPT files still in it
+        are used instead of fetching them.
+
+    work_dir : str
+        Directory to write the header-only FLT and the SPT files to
+
+    instr_cfg : dict
+        Instrument specific configuration object
+
+    download_cfg : dict
+        The `download` section of the configuration file
+
+    Returns
+    -------
+    fname : str or None
+        Full path of the FLT file to pass to
+        :py:class:`~utils.metadata.GenerateMetadata`, or None if it could not
+        be retrieved
+    """
+    input_suffix, telemetry_suffix = [
+        str(s).lower()
+        for s in instr_cfg['astroquery']['SubGroupDescription'][:2]
+    ]
+    spt_name = name.replace(input_suffix, telemetry_suffix)
+    local = glob.glob(os.path.join(download_dir, 'mastDownload', 'HST', '*',
+                                   name))
+    if local and os.path.isfile(local[0].replace(input_suffix,
+                                                 telemetry_suffix)):
+        return local[0]
+
+    base_url = download_cfg.get('base_url',
+                                'https://mast.stsci.edu/api/v0.1/Download/'
+                                'file?uri=')
+    timeout = download_cfg.get('timeout', 60)
+    fname = os.path.join(work_dir, name)
+    try:
+        if local:
+            cache.link_or_copy(local[0], fname)
+        else:
+            (prhdr, scihdr), _ = prefetch.read_headers(
+                '{}mast:HST/product/{}'.format(base_url, name),
+                timeout=timeout
+            )
+            write_header_file(fname, prhdr, scihdr)
+        spt = transfer.fetch_with_retries(
+            transfer.Transfer('{}mast:HST/product/{}'.format(base_url,
+                                                            spt_name),
+                              os.path.join(work_dir, spt_name)),
+            max_retries=download_cfg.get('max_retries', 5),
+            backoff=download_cfg.get('backoff', 2.),
+            timeout=timeout
+        )
+    except (IOError, OSError) as e:
+        LOG.warning('Unable to retrieve the headers of {}: {}'.format(name, e))
+        return None
+    if spt.error is not None:
+        # The observatory info is stored as NaNs, as in the pipeline
+        LOG.warning('Unable to retrieve {}: {}'.format(spt_name, spt.error))
+    return fname
+
+
+def compute_metadata(name, instr, download_dir, work_dir, instr_cfg,
+                     download_cfg):
+    """Recompute the metadata of a single image
+
+    Returns
+    -------
+    file_metadata : :py:class:`~utils.metadata.GenerateMetadata` or None
+        None if the files could not be retrieved
+    """
+    fname = stage_image(name, download_dir, work_dir, instr_cfg,
+                        download_cfg)
+    if fname is None:
+        return None
+    file_metadata = metadata.GenerateMetadata(fname, instr=instr,
+                                              instr_cfg=instr_cfg)
+    file_metadata.get_image_data()
+    file_metadata.get_wcs_info()
+    file_metadata.get_observatory_info()
+    return file_metadata
+
+
+def refresh_metadata(instr, datasets=None, num_workers=None):
+    """Recompute and rewrite the metadata of processed images
+
+    Parameters
+    ----------
+    instr : str
+        One of the valid instrument names
+
+    datasets : list, optional
+        Filenames of the FLT files to refresh. Defaults to every image that
+        has already been processed.
+
+    num_workers : int, optional
+        Number of processes to use. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    num_refreshed : int
+        Number of images whose metadata was rewritten
+    """
+    cfg, base = _load_cfg()
+    instr = instr.upper()
+    instr_cfg = cfg[instr]
+    download_cfg = cfg.get('download') or {}
+    download_dir = os.path.join(
+        base, *instr_cfg['astroquery']['download_dir'].split('/')
+    )
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    writer = dh.DataWriter(cfg=cfg, instr=instr)
+    if not datasets:
+        datasets = processed_datasets(writer, instr_cfg)
+    LOG.info('Refreshing the metadata of {} images\n{}'.format(
+        len(datasets), '-'*79))
+
+    start_time = time.time()
+    work_dir = tempfile.mkdtemp(prefix='refresh_', dir=download_dir)
+    try:
+        delayed_objects = [
+            dask.delayed(compute_metadata)(name, instr, download_dir,
+                                           work_dir, instr_cfg, download_cfg)
+            for name in datasets
+        ]
+        results = dask.compute(*delayed_objects,
+                               scheduler='processes',
+                               num_workers=num_workers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    file_metadata = [m for m in results if m is not None]
+    if len(file_metadata) < len(datasets):
+        LOG.warning('Skipped {} images whose files could not be '
+                    'retrieved'.format(len(datasets) - len(file_metadata)))
+    LOG.info('Computed the metadata of {} images in {:.1f}s'.format(
+        len(file_metadata), time.time() - start_time))
+
+    writer = dh.DataWriter(cfg=cfg, file_metadata=file_metadata, instr=instr)
+    writer.refresh_metadata()
+    return len(file_metadata)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    refresh_metadata(args.instr, datasets=args.datasets,
+                     num_workers=args.num_workers)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+This module lets the pipeline read FITS files straight from object storage.
+
+When the pipeline is run with `-stream`, the files in the
+:py:attr:`~pipeline.CosmicRayPipeline.flist` are URLs into the HST public
+dataset on S3 (e.g. `s3://stpubdata/hst/public/j8xy/j8xyz1abq/...`) instead of
+local paths. :py:func:`open_fits` opens them through `fsspec` with a block
+cache, so only the blocks of the file that are actually read are fetched and
+nothing is written to disk.
+
+Reading from S3 requires `s3fs`, and reading over HTTP requires `aiohttp`.
+Neither is needed to process local files.
+"""
+import io
+import os
+
+from astropy.io import fits
+
+
+def is_remote(fname):
+    """Check if `fname` is a URL rather than a local path"""
+    return '://' in str(fname) and not str(fname).startswith('file://')
+
+
+def storage_options(download_cfg=None, protocol='s3'):
+    """Build the `fsspec` options for reading remote files
+
+    Parameters
+    ----------
+    download_cfg : dict, optional
+        The `download` section of the configuration file. Uses the
+        `s3_anon`, `s3_endpoint_url`, and `stream_block_size` settings.
+
+    protocol : str
+        Protocol of the URLs that will be opened
+
+    Returns
+    -------
+    options : dict
+        Keyword arguments for `fsspec.open`
+    """
+    download_cfg = download_cfg or {}
+    block_size = download_cfg.get('stream_block_size', 2**21)
+    if protocol == 's3':
+        options = {
+            'anon': download_cfg.get('s3_anon', True),
+            'default_cache_type': 'blockcache',
+            'default_block_size': block_size
+        }
+        # e.g. a local S3 compatible server for testing
+        endpoint_url = download_cfg.get('s3_endpoint_url')
+        if endpoint_url:
+            options['client_kwargs'] = {'endpoint_url': endpoint_url}
+    else:
+        options = {'cache_type': 'blockcache', 'block_size': block_size}
+    return options
+
+
+def _options(fname, options):
+    if options is None:
+        options = storage_options(protocol=str(fname).split('://')[0])
+    return options
+
+
+def open_fits(fname, storage_options=None, **kwargs):
+    """Open a local or remote FITS file
+
+    Parameters
+    ----------
+    fname : str
+        Local path or URL
+
+    storage_options : dict, optional
+        Options returned by :py:func:`storage_options`. Only used for URLs.
+
+    kwargs
+        Passed to `astropy.io.fits.open`
+
+    Returns
+    -------
+    hdulist : `astropy.io.fits.HDUList`
+    """
+    if not is_remote(fname):
+        return fits.open(fname, **kwargs)
+    return fits.open(fname, use_fsspec=True,
+                     fsspec_kwargs=_options(fname, storage_options),
+                     **kwargs)
+
+
+def exists(fname, storage_options=None):
+    """Check if a local or remote file exists"""
+    if not is_remote(fname):
+        return os.path.isfile(fname)
+    import fsspec
+    fs, path = fsspec.core.url_to_fs(fname,
+                                     **_options(fname, storage_options))
+    return fs.exists(path)
+
+
+def read_bytes(fname, storage_options=None):
+    """Read a whole local or remote file into memory
+
+    Used for small files, like the SPT files, that are read by code that
+    needs a file object rather than a URL.
+
+    Returns
+    -------
+    fobj : `io.BytesIO`
+    """
+    if not is_remote(fname):
+        with open(fname, 'rb') as fobj:
+            return io.BytesIO(fobj.read())
+    import fsspec
+    with fsspec.open(fname, 'rb',
+                     **_options(fname, storage_options)) as fobj:
+        return io.BytesIO(fobj.read())
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+"""
+Fixed-size, mergeable summaries of the cosmic ray statistics.
+
+A :py:class:`Sketch` combines a :py:class:`LogHistogram` and a
+:py:class:`KLLSketch`. Sketches are computed for each image when the results
+are written and merged per month and per instrument, so distributions and
+percentiles can be produced without reading every cosmic ray back in.
+
+>>> sketch = Sketch()
+>>> sketch.update(energy_deposited)
+>>> sketch.quantile([0.25, 0.5, 0.75])
+"""
+
+import numpy as np
+
+
+class LogHistogram(object):
+    """
+    A histogram with a fixed set of logarithmically spaced bins.
+
+    Values below `lo` (including zero and negative values) are counted in an
+    underflow bin and values above `hi` in an overflow bin. Two histograms
+    with the same binning are merged by adding their counts.
+
+    Parameters
+    ----------
+    lo : float
+        Lower edge of the first bin
+
+    hi : float
+        Upper edge of the last bin
+
+    bins_per_decade : int
+        Number of bins per factor of 10
+    """
+
+    def __init__(self, lo=1e-3, hi=1e8, bins_per_decade=50):
+        self._lo = lo
+        self._hi = hi
+        self._bins_per_decade = bins_per_decade
+        nbins = int(round(np.log10(hi / lo) * bins_per_decade))
+        self._edges = np.logspace(np.log10(lo), np.log10(hi), nbins + 1)
+        # The first and last entries are the underflow and overflow bins
+        self._counts = np.zeros(nbins + 2, dtype=np.int64)
+
+    @property
+    def bins_per_decade(self):
+        """Number of bins per factor of 10"""
+        return self._bins_per_decade
+
+    @property
+    def counts(self):
+        """Counts in each bin, including the underflow and overflow bins"""
+        return self._counts
+
+    @counts.setter
+    def counts(self, value):
+        value = np.asarray(value, dtype=np.int64)
+        if value.shape != self._counts.shape:
+            raise ValueError(
+                'Expected {} counts, got {}'.format(self._counts.size,
+                                                    value.size)
+            )
+        self._counts = value
+
+    @property
+    def edges(self):
+        """Edges of the bins, excluding the underflow and overflow bins"""
+        return self._edges
+
+    @property
+    def hi(self):
+        """Upper edge of the last bin"""
+        return self._hi
+
+    @property
+    def lo(self):
+        """Lower edge of the first bin"""
+        return self._lo
+
+    def update(self, values):
+        """Add `values` to the histogram, ignoring NaNs and infs"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        idx = np.searchsorted(self.edges, values, side='right')
+        self._counts += np.bincount(idx, minlength=self._counts.size)
+
+    def merge(self, other):
+        """Add the counts of `other` to this histogram"""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge histograms with different bins')
+        self._counts += other.counts
+
+    def histogram(self, bins=None, range=None, density=False):
+        """Get the histogram
+
+        Parameters
+        ----------
+        bins : int or array_like, optional
+            If given, the counts are rebinned onto these bins by assigning
+            each native bin to the bin containing its geometric center. The
+            result is only approximate for bins narrower than the native
+            ones. By default the native bins are used.
+
+        range : tuple, optional
+            (min, max) of the bins. With the native bins, only the bins
+            inside the range are returned.
+
+        density : bool
+            If True, normalize the histogram so that it integrates to 1
+
+        Returns
+        -------
+        hist : :py:class:`numpy.ndarray`
+
+        edges : :py:class:`numpy.ndarray`
+        """
+        counts = self.counts[1:-1].astype(np.float64)
+        edges = self.edges
+        if bins is None:
+            if range is not None:
+                keep = (edges[:-1] >= range[0]) & (edges[1:] <= range[1])
+                counts = counts[keep]
+                edges = np.append(edges[:-1][keep], edges[1:][keep][-1:])
+        else:
+            if np.ndim(bins) == 0:
+                if range is None:
+                    range = (edges[0], edges[-1])
+                bins = np.linspace(range[0], range[1], int(bins) + 1)
+            centers = np.sqrt(edges[:-1] * edges[1:])
+            counts, edges = np.histogram(centers, bins=bins, weights=counts)
+        if density and counts.sum():
+            counts = counts / counts.sum() / np.diff(edges)
+        return counts, edges
+
+
+class KLLSketch(object):
+    """
+    A KLL quantile sketch.
+
+    The sketch keeps a hierarchy of compactors. Each item at level `h`
+    represents `2**h` of the original values. When a level overflows it is
+    sorted and every other item, starting at a random offset, is promoted to
+    the next level. The size of the sketch is roughly `3 * k` items no matter
+    how many values it has seen, and the rank error is about `1.7 / k`.
+
+    Parameters
+    ----------
+    k : int
+        Size of the largest compactor. Larger values are more accurate.
+
+    seed : int, optional
+        Seed for the random offsets used during compaction
+    """
+
+    def __init__(self, k=200, seed=None):
+        self._k = k
+        self._n = 0
+        self._compactors = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def k(self):
+        """Size of the largest compactor"""
+        return self._k
+
+    @property
+    def n(self):
+        """Number of values added to the sketch"""
+        return self._n
+
+    @property
+    def compactors(self):
+        """Items stored at each level of the sketch"""
+        return self._compactors
+
+    def _capacity(self, level):
+        height = len(self._compactors)
+        return max(2, int(np.ceil(self.k * (2. / 3.) ** (height - level - 1))))
+
+    def _compress(self):
+        level = 0
+        while level < len(self._compactors):
+            items = self._compactors[level]
+            if items.size > self._capacity(level):
+                if level + 1 == len(self._compactors):
+                    self._compactors.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item out stays at this level
+                leftover = items[items.size - items.size % 2:]
+                items = items[:items.size - items.size % 2]
+                promoted = items[self._rng.integers(2)::2]
+                self._compactors[level] = leftover
+                self._compactors[level + 1] = np.concatenate(
+                    [self._compactors[level + 1], promoted]
+                )
+            level += 1
+
+    def update(self, values):
+        """Add `values` to the sketch, ignoring NaNs and infs"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        self._n += values.size
+        self._compactors[0] = np.concatenate([self._compactors[0], values])
+        self._compress()
+
+    def merge(self, other):
+        """Merge `other` into this sketch"""
+        while len(self._compactors) < len(other.compactors):
+            self._compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self._compactors[level] = np.concatenate(
+                [self._compactors[level], items]
+            )
+        self._n += other.n
+        self._compress()
+
+    def items(self):
+        """All of the stored items and their levels"""
+        items = np.concatenate(self._compactors)
+        levels = np.concatenate([
+            np.full(c.size, level, dtype=np.int8)
+            for level, c in enumerate(self._compactors)
+        ])
+        return items, levels
+
+    @classmethod
+    def from_items(cls, items, levels, n, k=200, seed=None):
+        """Rebuild a sketch from the output of :py:meth:`items`"""
+        sketch = cls(k=k, seed=seed)
+        height = int(levels.max()) + 1 if levels.size else 1
+        sketch._compactors = [items[levels == level] for level in range(height)]
+        sketch._n = int(n)
+        return sketch
+
+    def quantile(self, q):
+        """Estimate the quantiles `q` (between 0 and 1) of the values"""
+        items, levels = self.items()
+        if not items.size:
+            return np.full(np.shape(q), np.nan)
+        order = np.argsort(items)
+        items = items[order]
+        weights = np.cumsum(2. ** levels[order])
+        idx = np.searchsorted(weights, np.asarray(q) * weights[-1])
+        return items[np.clip(idx, 0, items.size - 1)]
+
+
+class Sketch(object):
+    """
+    A histogram and quantile sketch of a single statistic.
+
+    Parameters
+    ----------
+    k : int
+        Size parameter of the :py:class:`KLLSketch`
+
+    lo, hi, bins_per_decade
+        Binning of the :py:class:`LogHistogram`
+    """
+
+    def __init__(self, k=200, lo=1e-3, hi=1e8, bins_per_decade=50):
+        self._hist = LogHistogram(lo=lo, hi=hi,
+                                  bins_per_decade=bins_per_decade)
+        self._kll = KLLSketch(k=k)
+        self._sum = 0.
+        self._min = np.inf
+        self._max = -np.inf
+
+    @property
+    def count(self):
+        """Number of values in the sketch"""
+        return self._kll.n
+
+    @property
+    def hist(self):
+        """The :py:class:`LogHistogram` of the values"""
+        return self._hist
+
+    @property
+    def kll(self):
+        """The :py:class:`KLLSketch` of the values"""
+        return self._kll
+
+    @property
+    def max(self):
+        return self._max
+
+    @property
+    def mean(self):
+        return self._sum / self.count if self.count else np.nan
+
+    @property
+    def min(self):
+        return self._min
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def update(self, values):
+        """Add `values` to the sketch, ignoring NaNs and infs"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return
+        self._hist.update(values)
+        self._kll.update(values)
+        self._sum += values.sum()
+        self._min = min(self._min, values.min())
+        self._max = max(self._max, values.max())
+
+    def merge(self, other):
+        """Merge `other` into this sketch"""
+        self._hist.merge(other.hist)
+        self._kll.merge(other.kll)
+        self._sum += other.sum
+        self._min = min(self._min, other.min)
+        self._max = max(self._max, other.max)
+
+    def quantile(self, q):
+        """Estimate the quantiles `q` (between 0 and 1) of the values"""
+        return self._kll.quantile(q)
+
+    def percentile(self, q):
+        """Estimate the percentiles `q` (between 0 and 100) of the values"""
+        return self.quantile(np.asarray(q) / 100.)
+
+    def histogram(self, bins=None, range=None, density=False):
+        """Get the histogram of the values
+
+        See :py:meth:`LogHistogram.histogram`
+        """
+        return self._hist.histogram(bins=bins, range=range, density=density)
+
+    def to_arrays(self):
+        """Get the arrays and attributes needed to store the sketch
+
+        Returns
+        -------
+        arrays : dict
+            Named arrays
+
+        attrs : dict
+            Named scalars
+        """
+        items, levels = self._kll.items()
+        arrays = {
+            'hist_counts': self._hist.counts,
+            'kll_items': items,
+            'kll_levels': levels
+        }
+        attrs = {
+            'k': self._kll.k,
+            'n': self._kll.n,
+            'lo': self._hist.lo,
+            'hi': self._hist.hi,
+            'bins_per_decade': self._hist.bins_per_decade,
+            'sum': self._sum,
+            'min': self._min,
+            'max': self._max
+        }
+        return arrays, attrs
+
+    @classmethod
+    def from_arrays(cls, arrays, attrs):
+        """Rebuild a sketch from the output of :py:meth:`to_arrays`"""
+        sketch = cls(k=int(attrs['k']), lo=float(attrs['lo']),
+                     hi=float(attrs['hi']),
+                     bins_per_decade=int(attrs['bins_per_decade']))
+        sketch._hist.counts = arrays['hist_counts']
+        sketch._kll = KLLSketch.from_items(
+            np.asarray(arrays['kll_items'], dtype=np.float64),
+            np.asarray(arrays['kll_levels']),
+            n=attrs['n'], k=int(attrs['k'])
+        )
+        sketch._sum = float(attrs['sum'])
+        sketch._min = float(attrs['min'])
+        sketch._max = float(attrs['max'])
+        return sketch
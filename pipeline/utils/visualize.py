@@ -130,10 +130,13 @@ class Visualizer(object):
 
         Parameters
         ----------
-        data : :py:class:`dask.array`
-            THe dask array to use to generate a histogram
+        data : :py:class:`dask.array` or :py:class:`~sketches.Sketch`
+            THe dask array to use to generate a histogram. If a sketch is
+            given (e.g. from :py:meth:`DataReader.read_sketch`), the
+            histogram is taken from it without reading the data.
         bins: int
-            The number of bins to use
+            The number of bins to use. Pass None with a sketch to use its
+            native logarithmic bins.
 
         ax : :py:class:`matplotlib.axes.Axes`
             If passed, the histogram will be added to the plot contained by
@@ -157,12 +160,16 @@ class Visualizer(object):
        # if logx:
        #     data = da.log10(data)
         
-        if range is not None:
+        if hasattr(data, 'histogram'):
+            hist, edges = data.histogram(bins=bins, range=range,
+                                         density=normalize)
+        elif range is not None:
             h, edges = da.histogram(data, bins=bins,
                                     range=range, density=normalize)
+            hist = h.compute()
         else:
             h, edges = da.histogram(data, bins=bins)
-        hist = h.compute()
+            hist = h.compute()
         
         #if normalize:
         #    hist = hist/hist.max()